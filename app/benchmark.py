@@ -0,0 +1,600 @@
+from pyVmomi import vim, vmodl
+import itertools
+import datetime
+import http.client
+import random
+import multiprocessing
+import resource
+import argparse
+import logging
+import json
+import time
+import sys
+import os
+import subprocess
+import tempfile
+import psycopg2.extensions
+import database_functions
+import vm_properties_collector as collector
+from database_functions import VM_TABLE, RUNS_TABLE, get_engine, delete_missing_rows, create_engine
+
+# Benchmark the collector against a simulated vCenter and a scratch PostgreSQL database
+# Every phase runs in its own process and reports wall time, SOAP calls, database statements and peak memory,
+# so a change can be measured on any Linux box without a real vCenter
+
+# Counters shared with every process a phase starts, so pool workers add to them too
+soap_calls = multiprocessing.Value("q", 0)
+db_statements = multiprocessing.Value("q", 0)
+
+# A function to add one to a shared counter
+def count(counter: multiprocessing.Value):
+    with counter.get_lock():
+        counter.value += 1
+
+# A psycopg2 cursor that counts every statement and COPY sent to the database
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        count(db_statements)
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        count(db_statements)
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        count(db_statements)
+        return super().copy_expert(sql, file, size)
+
+# A simulated vCenter with num_vms VMs spread across datacenters, nested folders, clusters and hosts
+# Nothing is stored per VM, each VM's properties are built from its number when they are asked for,
+# so the fake doesn't add to the memory being measured
+class FakeVCenter():
+    def __init__(self, num_vms: int, latency: float = 0.0, fault_rate: float = 0.0, folder_depth: int = 4):
+        self.num_vms = num_vms
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.views = {}
+        self.results = {}
+
+        # Roughly 30 VMs per host, 8 hosts per cluster and 10,000 VMs per datacenter
+        self.topology = {"group-d1": (vim.Folder, "Datacenters", None)}
+        self.hosts = []
+        self.vm_folders = {}
+        num_datacenters = max(1, num_vms // 10000)
+        num_hosts = max(1, num_vms // 30)
+        for d in range(num_datacenters):
+            self.topology[f"datacenter-{d}"] = (vim.Datacenter, f"DC{d}", "group-d1")
+            self.topology[f"group-h{d}"] = (vim.Folder, "host", f"datacenter-{d}")
+            parent = f"datacenter-{d}"
+            for depth in range(folder_depth):
+                self.topology[f"group-v{d}-{depth}"] = (vim.Folder, "vm" if depth == 0 else f"folder{depth}", parent)
+                parent = f"group-v{d}-{depth}"
+            self.vm_folders[d] = [parent]
+            self.topology[f"group-n{d}"] = (vim.Folder, "network", f"datacenter-{d}")
+            self.topology[f"dvportgroup-{d}"] = (vim.dvs.DistributedVirtualPortgroup, f"dvpg-app{d}", f"group-n{d}")
+            for leaf in range(8):
+                self.topology[f"group-v{d}-leaf{leaf}"] = (vim.Folder, f"app{leaf}", parent)
+                self.vm_folders[d].append(f"group-v{d}-leaf{leaf}")
+        for h in range(num_hosts):
+            d = h % num_datacenters
+            cluster = f"domain-c{d}-{h // 8 // num_datacenters}"
+            if cluster not in self.topology:
+                self.topology[cluster] = (vim.ClusterComputeResource, f"cluster{d}-{h // 8 // num_datacenters}", f"group-h{d}")
+            self.topology[f"host-{h}"] = (vim.HostSystem, f"esx{h}.example.com", cluster)
+            self.hosts.append((f"host-{h}", d))
+
+        # A handful of device and extraConfig layouts, shared between VMs like the real ones mostly are
+        self.device_templates = [get_fake_devices(variant) for variant in range(6)]
+        self.extra_config_templates = [get_fake_extra_config(variant) for variant in range(4)]
+        self.fields = [
+            vim.CustomFieldsManager.FieldDef(key=101, name="cloud_instance_name"),
+            vim.CustomFieldsManager.FieldDef(key=102, name="owner"),
+            vim.CustomFieldsManager.FieldDef(key=103, name="backup_policy"),
+        ]
+
+    # Every call a real vCenter would answer over SOAP goes through here
+    def call(self):
+        count(soap_calls)
+        if self.latency:
+            time.sleep(self.latency)
+
+    # A function to build a VM's properties from its number
+    def get_vm_properties(self, i: int) -> dict:
+        host, d = self.hosts[i % len(self.hosts)]
+        folders = self.vm_folders[d]
+        path = f"[ds{i % 20}] {i:08x}-0000-4000-8000-{i:012x}/vm{i}.vmx"
+        return {
+            "parent":                               vim.Folder(folders[i % len(folders)]),
+            "customValue":                          vim.CustomFieldsManager.Value.Array([
+                vim.CustomFieldsManager.StringValue(key=101, value=f"cloud-{i % 50}"),
+                vim.CustomFieldsManager.StringValue(key=102, value=f"team{i % 30}"),
+            ]),
+            "rootSnapshot":                         vim.vm.Snapshot.Array([vim.vm.Snapshot(f"snapshot-{i}")]) if i % 10 == 0 else vim.vm.Snapshot.Array(),
+            "guest.guestFamily":                    "linuxGuest" if i % 3 else "windowsGuest",
+            "summary.config.name":                  f"vm{i:06d}",
+            "summary.config.uuid":                  f"4210{i:04x}-0000-4000-8000-{i:012x}",
+            "summary.config.instanceUuid":          f"5010{i:04x}-0000-4000-8000-{i:012x}",
+            "summary.config.numCpu":                2 + i % 4 * 2,
+            "summary.config.cpuReservation":        0,
+            "summary.config.memorySizeMB":          4096 * (1 + i % 4),
+            "summary.config.memoryReservation":     0,
+            "summary.config.vmPathName":            path,
+            "summary.config.guestFullName":         "Red Hat Enterprise Linux 8 (64-bit)" if i % 3 else "Microsoft Windows Server 2019 (64-bit)",
+            "summary.config.guestId":               "rhel8_64Guest" if i % 3 else "windows2019srv_64Guest",
+            "summary.config.numEthernetCards":      1 + i % 2,
+            "summary.config.numVirtualDisks":       2 + i % 3,
+            "summary.runtime.host":                 vim.HostSystem(host),
+            "summary.runtime.powerState":           "poweredOn" if i % 20 else "poweredOff",
+            "summary.runtime.connectionState":      "connected",
+            "summary.runtime.dasVmProtection":      vim.vm.RuntimeInfo.DasProtectionState(dasProtected=bool(i % 5)),
+            "summary.runtime.consolidationNeeded":  False,
+            "summary.guest.hostName":               f"vm{i:06d}.example.com",
+            "summary.guest.toolsStatus":            "toolsOk",
+            "summary.guest.ipAddress":              f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}",
+            "summary.storage.committed":            (40 + i % 200) * 1024 ** 3,
+            "summary.storage.uncommitted":          (i % 100) * 1024 ** 3,
+            "config.datastoreUrl":                  vim.vm.ConfigInfo.DatastoreUrlPair.Array([
+                vim.vm.ConfigInfo.DatastoreUrlPair(name=f"ds{i % 20}", url=f"ds:///vmfs/volumes/ds{i % 20}/"),
+            ]),
+            "config.extraConfig":                   self.extra_config_templates[i % len(self.extra_config_templates)],
+            "config.managedBy":                     vim.ext.ManagedByInfo(extensionKey="com.vmware.vcDr", type="placeholderVm") if i % 500 == 0 else None,
+            "config.cpuAllocation":                 vim.ResourceAllocationInfo(limit=-1, shares=vim.SharesInfo(level="normal", shares=1000)),
+            "config.memoryAllocation":              vim.ResourceAllocationInfo(limit=-1, shares=vim.SharesInfo(level="normal", shares=10240)),
+            "config.cpuHotAddEnabled":              bool(i % 2),
+            "config.memoryHotAddEnabled":           bool(i % 2),
+            "config.version":                       "vmx-19",
+            "config.tools.toolsVersion":            12352,
+            "config.hardware.device":               self.device_templates[i % len(self.device_templates)],
+        }
+
+    # A function to turn a managed object into the ObjectContent RetrievePropertiesEx would return
+    def get_object_content(self, managed_object, property_specs: list) -> vmodl.query.PropertyCollector.ObjectContent:
+        path_set = [path for spec in property_specs if isinstance(managed_object, spec.type) for path in spec.pathSet]
+        moid = managed_object._moId
+        if isinstance(managed_object, vim.VirtualMachine):
+            i = int(moid.split("-")[1])
+            props = self.get_vm_properties(i) if i < self.num_vms else None
+        elif moid in self.topology:
+            kind, name, parent = self.topology[moid]
+            props = {"name": name, "parent": self.topology[parent][0](parent) if parent else None}
+        else:
+            props = None
+
+        if props is None:
+            missing = vmodl.query.PropertyCollector.MissingProperty(path="", fault=vmodl.fault.ManagedObjectNotFound(obj=managed_object))
+            return vmodl.query.PropertyCollector.ObjectContent(obj=managed_object, propSet=[], missingSet=[missing])
+        return vmodl.query.PropertyCollector.ObjectContent(
+            obj=managed_object,
+            propSet=[vmodl.DynamicProperty(name=path, val=props[path]) for path in path_set if props.get(path) is not None],
+        )
+
+    # A function to work out which objects a FilterSpec selects
+    def select_objects(self, object_specs: list):
+        seen = set()
+        for object_spec in object_specs:
+            managed_object = object_spec.obj
+            if isinstance(managed_object, vim.view.ContainerView):
+                yield from self.views[managed_object._moId]()
+                continue
+            # Objects picked directly, plus everything above them if the spec traverses parent
+            moid = managed_object._moId
+            walk_parents = any(getattr(select, "path", None) == "parent" for select in object_spec.selectSet or [])
+            while moid and moid not in seen:
+                seen.add(moid)
+                yield managed_object if moid == managed_object._moId else self.topology[moid][0](moid)
+                if not walk_parents or moid not in self.topology:
+                    break
+                moid = self.topology[moid][2]
+
+    # Container views of every VM, or of the folders, datacenters, clusters and hosts
+    def create_view(self, view_type: list) -> vim.view.ContainerView:
+        moid = f"session[bench]view-{len(self.views)}"
+        if vim.VirtualMachine in view_type:
+            self.views[moid] = lambda: (vim.VirtualMachine(f"vm-{i}") for i in range(self.num_vms))
+        else:
+            self.views[moid] = lambda: (kind(moid) for moid, (kind, name, parent) in self.topology.items() if moid != "group-d1")
+        return vim.view.ContainerView(moid)
+
+    # A function to return the next page of a RetrievePropertiesEx result, keeping a token if there's more
+    def get_page(self, objects, property_specs: list, max_objects: int):
+        page = [self.get_object_content(managed_object, property_specs) for managed_object in itertools.islice(objects, max_objects)]
+        token = None
+        next_object = next(objects, None)
+        if next_object is not None:
+            token = str(len(self.results))
+            self.results[token] = (itertools.chain([next_object], objects), property_specs, max_objects)
+        return FakeRetrieveResult(objects=page, token=token)
+
+# What RetrievePropertiesEx hands back, the two attributes retrieve_properties reads
+class FakeRetrieveResult():
+    def __init__(self, objects: list, token: str):
+        self.objects = objects
+        self.token = token
+
+# The PropertyCollector calls the collector uses, answered from a FakeVCenter
+class FakePropertyCollector():
+    def __init__(self, vcenter: FakeVCenter):
+        self.vcenter = vcenter
+
+    def RetrievePropertiesEx(self, specSet, options):
+        self.vcenter.call()
+        filter_spec = specSet[0]
+        # Fail some fetches of picked VMs like a busy vCenter would, but never discovery
+        picked_vms = not isinstance(filter_spec.objectSet[0].obj, vim.view.ContainerView)
+        if picked_vms and random.random() < self.vcenter.fault_rate:
+            raise http.client.HTTPException("503 Service Unavailable")
+        objects = self.vcenter.select_objects(filter_spec.objectSet)
+        return self.vcenter.get_page(objects, filter_spec.propSet, options.maxObjects or 1000)
+
+    def ContinueRetrievePropertiesEx(self, token):
+        self.vcenter.call()
+        objects, property_specs, max_objects = self.vcenter.results.pop(token)
+        return self.vcenter.get_page(objects, property_specs, max_objects)
+
+    def CancelRetrievePropertiesEx(self, token):
+        self.vcenter.call()
+        self.vcenter.results.pop(token, None)
+
+class FakeViewManager():
+    def __init__(self, vcenter: FakeVCenter):
+        self.vcenter = vcenter
+
+    def CreateContainerView(self, container, type, recursive):
+        self.vcenter.call()
+        return self.vcenter.create_view(type)
+
+class FakeSessionManager():
+    def __init__(self, vcenter: FakeVCenter):
+        self.vcenter = vcenter
+
+    def AcquireCloneTicket(self):
+        self.vcenter.call()
+        return "cst-bench"
+
+class FakeCustomFieldsManager():
+    def __init__(self, vcenter: FakeVCenter):
+        self.vcenter = vcenter
+
+    # Reading a property off a managed object is a SOAP call too
+    @property
+    def field(self):
+        self.vcenter.call()
+        return self.vcenter.fields
+
+# Real-time performance stats, made up from each VM's number
+class FakePerformanceManager():
+    COUNTERS = [("cpu", "ready", "summation", 2), ("cpu", "usage", "average", 6), ("mem", "usage", "average", 24), ("disk", "maxTotalLatency", "latest", 133)]
+
+    def __init__(self, vcenter: FakeVCenter):
+        self.vcenter = vcenter
+
+    @property
+    def perfCounter(self):
+        self.vcenter.call()
+        return [
+            vim.PerformanceManager.CounterInfo(
+                key=key, groupInfo=vim.ElementDescription(key=group), nameInfo=vim.ElementDescription(key=name), rollupType=rollup,
+            )
+            for group, name, rollup, key in self.COUNTERS
+        ]
+
+    def QueryPerf(self, querySpec):
+        self.vcenter.call()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        results = []
+        for spec in querySpec:
+            i = int(spec.entity._moId.split("-")[1])
+            # Powered off VMs have no real-time samples
+            if not i % 20:
+                results.append(vim.PerformanceManager.EntityMetric(entity=spec.entity))
+                continue
+            sample_info = [vim.PerformanceManager.SampleInfo(timestamp=now - datetime.timedelta(seconds=20 * s), interval=20) for s in reversed(range(spec.maxSample))]
+            series = [
+                vim.PerformanceManager.IntSeries(id=metric_id, value=[(i * metric_id.counterId + s * 7) % 5000 for s in range(spec.maxSample)])
+                for metric_id in spec.metricId
+            ]
+            results.append(vim.PerformanceManager.EntityMetric(entity=spec.entity, sampleInfo=sample_info, value=series))
+        return results
+
+# A stand-in for vim.ServiceInstance with just what the collector touches
+class FakeServiceInstance():
+    def __init__(self, vcenter: FakeVCenter):
+        self.vcenter = vcenter
+        self._stub = None
+        self.content = FakeServiceContent(vcenter)
+
+    def RetrieveContent(self):
+        self.vcenter.call()
+        return self.content
+
+class FakeServiceContent():
+    def __init__(self, vcenter: FakeVCenter):
+        self.rootFolder = vim.Folder("group-d1")
+        self.propertyCollector = FakePropertyCollector(vcenter)
+        self.viewManager = FakeViewManager(vcenter)
+        self.sessionManager = FakeSessionManager(vcenter)
+        self.customFieldsManager = FakeCustomFieldsManager(vcenter)
+        self.perfManager = FakePerformanceManager(vcenter)
+
+# A function to build one of a few realistic device lists
+# Controllers, thin, thick and RDM disks, NICs, a CD-ROM and sometimes a floppy
+def get_fake_devices(variant: int):
+    devices = [
+        vim.vm.device.VirtualLsiLogicSASController(key=1000, busNumber=0),
+        vim.vm.device.VirtualCdrom(key=3000),
+        vim.vm.device.VirtualVideoCard(key=500),
+    ]
+    for disk in range(2 + variant % 3):
+        backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+            fileName=f"[ds{variant}] vm/vm_{disk}.vmdk", diskMode="persistent", thinProvisioned=bool((variant + disk) % 2),
+        )
+        devices.append(vim.vm.device.VirtualDisk(key=2000 + disk, controllerKey=1000, unitNumber=disk, capacityInKB=(40 + disk * 60) * 1024 ** 2, backing=backing))
+    if variant == 5:
+        devices.append(vim.vm.device.ParaVirtualSCSIController(key=1001, busNumber=1))
+        backing = vim.vm.device.VirtualDisk.RawDiskMappingVer1BackingInfo(fileName="[ds5] vm/vm_rdm.vmdk", compatibilityMode="physicalMode", diskMode="independent_persistent")
+        devices.append(vim.vm.device.VirtualDisk(key=2010, controllerKey=1001, unitNumber=0, capacityInKB=500 * 1024 ** 2, backing=backing))
+    for nic in range(1 + variant % 2):
+        if nic:
+            backing = vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo(
+                port=vim.dvs.PortConnection(portgroupKey="dvportgroup-0", switchUuid="50 00 00 00"),
+            )
+        else:
+            backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo(deviceName="VM Network")
+        connectable = vim.vm.device.VirtualDevice.ConnectInfo(connected=True, startConnected=True)
+        devices.append(vim.vm.device.VirtualVmxnet3(key=4000 + nic, macAddress=f"00:50:56:00:{variant:02x}:{nic:02x}", backing=backing, connectable=connectable))
+    if variant == 3:
+        devices.append(vim.vm.device.VirtualFloppy(key=8000))
+    return vim.vm.device.VirtualDevice.Array(devices)
+
+# A function to build one of a few extraConfig lists, about as long as a real VM's
+def get_fake_extra_config(variant: int):
+    options = [vim.option.OptionValue(key=f"guestinfo.bench.key{k}", value="x" * 32) for k in range(40)]
+    if variant % 2:
+        options.append(vim.option.OptionValue(key="disk.enableUUID", value="1"))
+    if variant == 3:
+        options.append(vim.option.OptionValue(key="hbr_filter.destination", value="10.0.0.1"))
+    return vim.option.OptionValue.Array(options)
+
+# A function to point the collector at a FakeVCenter and the scratch database
+# Anything the phases fork inherits these, including pool workers
+def install_fakes(fake_vcenter: FakeVCenter, database_url: str):
+    service_instance = FakeServiceInstance(fake_vcenter)
+    logged_in = set()
+
+    def get_service_instance(vcenter, username, password):
+        # One login per process, like the real one
+        if os.getpid() not in logged_in:
+            fake_vcenter.call()
+            logged_in.add(os.getpid())
+        return service_instance, service_instance.content
+
+    collector.get_service_instance = get_service_instance
+    if not database_url:
+        return service_instance
+    database_functions.get_connection_url = lambda: database_url
+    # Wraps the original, so installing the fakes again for the next size doesn't wrap it twice
+    database_functions.create_engine = lambda url, **kwargs: create_engine(url, connect_args={"cursor_factory": CountingCursor}, **kwargs)
+    return service_instance
+
+# A function to return the peak memory in MB of this process and of the largest process it started
+def get_peak_memory() -> tuple:
+    # ru_maxrss is in KB on Linux
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    )
+
+# A function to run one phase in a new process and measure it
+# setup runs first and isn't timed, its return value is handed to run
+def run_phase(name: str, num_vms: int, run, setup=None) -> dict:
+    receive, send = multiprocessing.Pipe(duplex=False)
+
+    def measure():
+        args = setup() if setup else ()
+        soap_calls.value = 0
+        db_statements.value = 0
+        start = time.perf_counter()
+        # Time to the first VM is counted from here, not from when the benchmark started
+        collector.PROCESS_START = start
+        run(*args)
+        wall = time.perf_counter() - start
+        peak, worker_peak = get_peak_memory()
+        first_write = [value for (metric, labels), value in collector.metrics.collect()["values"].items() if metric == "vmproperties_first_write_seconds"]
+        send.send({
+            "phase":            name,
+            "vms":              num_vms,
+            "wall_seconds":     round(wall, 3),
+            "first_vm_seconds": round(first_write[0], 3) if first_write else None,
+            "soap_calls":       soap_calls.value,
+            "db_statements":    db_statements.value,
+            "peak_rss_mb":      round(peak, 1),
+            "worker_rss_mb":    round(worker_peak, 1),
+        })
+
+    process = multiprocessing.get_context("fork").Process(target=measure)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise SystemExit(f"Phase {name} failed for {num_vms} VMs")
+    return receive.recv()
+
+# A function to time a new interpreter importing the collector, the best of a few tries
+# This is what every run pays before it can log in to vCenter
+def measure_import(tries: int = 5) -> dict:
+    walls = []
+    for i in range(tries):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", "import resource, vm_properties_collector; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+        ).stdout
+        walls.append(time.perf_counter() - start)
+    return {
+        "phase":            "import",
+        "vms":              0,
+        "wall_seconds":     round(min(walls), 3),
+        "first_vm_seconds": None,
+        "soap_calls":       0,
+        "db_statements":    0,
+        "peak_rss_mb":      round(int(output) / 1024, 1),
+        "worker_rss_mb":    0,
+    }
+
+# A function to benchmark every phase for one inventory size
+def benchmark(num_vms: int, latency: float, fault_rate: float, max_workers: int, database_url: str) -> list:
+    fake_vcenter = FakeVCenter(num_vms, latency, fault_rate)
+    service_instance = install_fakes(fake_vcenter, database_url)
+    vcenter = f"bench-{num_vms}.invalid"
+    os.environ["VCENTER"] = vcenter
+    os.environ["MAX_WORKERS"] = str(max_workers)
+    # The fakes are patched into this process, so workers have to be forked from it to see them
+    os.environ["WORKER_START_METHOD"] = "fork"
+
+    # Start from an empty table for this vCenter
+    collector.prepare_vm_tables()
+    delete_missing_rows(get_engine(), VM_TABLE, "vm_moref", vcenter, [], rollup=True)
+
+    def setup_workers():
+        # What main() does before it starts the pool, then every chunk runs here one after another
+        # No digests are handed over, so every row is written like on a first run
+        content = service_instance.RetrieveContent()
+        setup_queue = multiprocessing.Queue()
+        setup_queue.put((
+            collector.get_topology(service_instance),
+            collector.get_custom_attribute_keys(collector.get_custom_field_keys(content.customFieldsManager)),
+        ))
+        collector.init_worker(multiprocessing.Queue(), setup_queue)
+        vm_refs = list(collector.get_vm_uuid_map(service_instance, collector.get_vm_container_view(service_instance)).items())
+        return ([(i, vm_refs[j:j + 50], {}) for i, j in enumerate(range(0, len(vm_refs), 50))],)
+
+    def run_workers(worker_args):
+        for args in worker_args:
+            collector.process_vm_data(args)
+
+    def setup_stats():
+        vm_refs = list(collector.get_vm_uuid_map(service_instance, collector.get_vm_container_view(service_instance)).items())
+        return (service_instance, vm_refs, vcenter)
+
+    def setup_delete():
+        # Drop 1% of the VMs so there is something to delete
+        vm_refs = collector.get_vm_uuid_map(service_instance, collector.get_vm_container_view(service_instance))
+        return ([moid for i, moid in enumerate(vm_refs) if i % 100],)
+
+    results = [
+        run_phase("main", num_vms, collector.main),
+        run_phase("main, nothing changed", num_vms, collector.main),
+        run_phase("process_vm_data", num_vms, run_workers, setup_workers),
+        run_phase("stream", num_vms, collector.stream),
+        run_phase("collect_vm_stats", num_vms, collector.collect_vm_stats, setup_stats),
+        run_phase("delete_vms_from_database", num_vms, collector.delete_vms_from_database, setup_delete),
+    ]
+
+    # Leave nothing behind
+    delete_missing_rows(get_engine(), VM_TABLE, "vm_moref", vcenter, [], rollup=True)
+    with get_engine().begin() as connection:
+        connection.exec_driver_sql(f"DELETE FROM {RUNS_TABLE} WHERE vcenter = %(vcenter)s", {"vcenter": vcenter})
+    return results
+
+# A function to benchmark the phases that don't need a database for one inventory size
+# Each phase gets what the ones before it made in its untimed setup: fetch asks the simulated vCenter for every VM's
+# properties, build turns them into VM objects and digest works out their rows and row digests like a first run
+def benchmark_without_database(num_vms: int, latency: float, fault_rate: float) -> list:
+    fake_vcenter = FakeVCenter(num_vms, latency, fault_rate)
+    service_instance = install_fakes(fake_vcenter, None)
+    vcenter = f"bench-{num_vms}.invalid"
+
+    def setup_fetch():
+        vm_refs = collector.get_vm_uuid_map(service_instance, collector.get_vm_container_view(service_instance))
+        return ([collector.get_vm_by_moid(moid, service_instance) for moid in vm_refs],)
+
+    def run_fetch(vms):
+        # 50 VMs per call like the workers' first chunks, and a chunk that faults is asked for again
+        vm_props = {}
+        for i in range(0, len(vms), 50):
+            while True:
+                try:
+                    vm_props.update(collector.get_vm_properties(service_instance, vms[i:i + 50]))
+                    break
+                except collector.get_vcenter_faults():
+                    pass
+        return vm_props
+
+    def setup_build():
+        content = service_instance.RetrieveContent()
+        return (
+            run_fetch(*setup_fetch()),
+            collector.get_topology(service_instance),
+            collector.get_custom_attribute_keys(collector.get_custom_field_keys(content.customFieldsManager)),
+        )
+
+    def run_build(vm_props, topology, attribute_keys):
+        return collector.build_vm_objs(service_instance, vm_props, topology, attribute_keys, vcenter)
+
+    def setup_digest():
+        return (run_build(*setup_build()), {})
+
+    return [
+        run_phase("fetch", num_vms, run_fetch, setup_fetch),
+        run_phase("build", num_vms, run_build, setup_build),
+        run_phase("digest", num_vms, collector.get_database_rows, setup_digest),
+    ]
+
+# A function to start a throwaway PostgreSQL with pgserver, so the database phases run without a scratch server
+# Its data directory is a temp directory that's deleted when the benchmark exits
+# Returns its URL, or None if pgserver isn't installed
+def start_embedded_database() -> str:
+    try:
+        import pgserver
+    except ImportError:
+        return None
+    server = pgserver.get_server(tempfile.mkdtemp(prefix="vmproperties-bench-"), cleanup_mode="delete")
+    return server.get_uri()
+
+# A function to print results as a table
+def print_results(results: list):
+    print(f"{'VMs':>7} {'phase':<26} {'wall s':>9} {'first VM s':>11} {'SOAP calls':>11} {'DB stmts':>9} {'peak MB':>8} {'worker MB':>10}")
+    for result in results:
+        first_vm = f"{result['first_vm_seconds']:.2f}" if result["first_vm_seconds"] is not None else "-"
+        print(
+            f"{result['vms']:>7} {result['phase']:<26} {result['wall_seconds']:>9.2f} {first_vm:>11} {result['soap_calls']:>11} "
+            f"{result['db_statements']:>9} {result['peak_rss_mb']:>8.0f} {result['worker_rss_mb']:>10.0f}"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the collector against a simulated vCenter")
+    parser.add_argument("--database-url", default=os.environ.get("BENCH_DATABASE_URL"), help="scratch PostgreSQL database to write to (or BENCH_DATABASE_URL)")
+    parser.add_argument("--sizes", default="1000,10000,50000", help="comma separated VM counts to simulate")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay added to every simulated SOAP call")
+    parser.add_argument("--fault-rate", type=float, default=0.0, help="fraction of VM property fetches that fail with HTTP 503")
+    parser.add_argument("--workers", type=int, default=4, help="MAX_WORKERS for main()")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    # Don't fall back to DB_* so a benchmark never writes to the real database by accident
+    # Without a scratch database one is started with pgserver, and without that only the phases that don't write anything are run
+    if not args.database_url:
+        args.database_url = start_embedded_database()
+        if args.database_url:
+            print("No --database-url or BENCH_DATABASE_URL, using a temporary PostgreSQL from pgserver", file=sys.stderr)
+        else:
+            print("No --database-url or BENCH_DATABASE_URL and pgserver isn't installed, only timing the fetch, build and digest phases", file=sys.stderr)
+
+    # The collector logs through the root logger, keep it quiet so the results are readable
+    collector.logger = logging.getLogger()
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "WARNING"), handlers=[logging.StreamHandler(sys.stderr)], force=True)
+
+    results = [measure_import()]
+    print_results(results)
+    print()
+    for size in args.sizes.split(","):
+        if args.database_url:
+            size_results = benchmark(int(size), args.latency_ms / 1000, args.fault_rate, args.workers, args.database_url)
+        else:
+            size_results = benchmark_without_database(int(size), args.latency_ms / 1000, args.fault_rate)
+        results.extend(size_results)
+        print_results(size_results)
+        print()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
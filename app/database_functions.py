@@ -0,0 +1,675 @@
+import io
+import os
+import re
+import logging
+import threading
+import urllib.parse
+from collections import Counter, defaultdict
+from itertools import repeat
+from datetime import datetime, timedelta, timezone
+from dataclasses import fields
+# SQLAlchemy takes a quarter of a second to import, so it's only imported once the database is first used.
+# main() gets the vCenter login and discovery going in the meantime.
+
+# The table all VM rows are written to
+VM_TABLE = "vme_watchman_properties"
+# A VM is identified by its vCenter and moref, which vCenter never hands to two VMs at once.
+# The BIOS UUID can be blank, and clones share it, so it is only stored, not used as the key.
+VM_KEY_COLUMNS = ("vcenter", "vm_moref")
+# Collection runs, and the chunks each run has committed so an interrupted run can be resumed
+RUNS_TABLE = "vme_watchman_runs"
+RUN_BATCHES_TABLE = "vme_watchman_run_batches"
+# One row per virtual disk and per NIC of each VM, removed along with their VM
+DISK_TABLE = "vme_watchman_disks"
+NIC_TABLE = "vme_watchman_nics"
+# The latest performance stats of each VM
+STATS_TABLE = "vme_watchman_stats"
+# Every change to a VM row, one row per changed field, partitioned by month
+HISTORY_TABLE = "vme_watchman_history"
+# Totals per cluster and per datacenter, and VM counts by property value, kept up to date by every write and delete
+# Each level is (totals table, counts table, the columns its rows are grouped on).  Every level's group columns
+# start with the same columns as the first's, so any level's changes are the first level's added up.
+ROLLUP_LEVELS = (
+    ("vme_watchman_cluster_rollup", "vme_watchman_cluster_counts", ("vcenter", "vc_datacenter", "vc_cluster")),
+    ("vme_watchman_datacenter_rollup", "vme_watchman_datacenter_counts", ("vcenter", "vc_datacenter")),
+)
+ROLLUP_SUM_COLUMNS = ("numcpu", "memorymb", "vmdktotalgb", "sizeondiskgb")
+ROLLUP_COUNT_COLUMNS = ("powerstate", "toolsstatus", "hardwareversion")
+# The VM columns the rollups are worked out from, in the order rollup rows carry them
+ROLLUP_COLUMNS = ROLLUP_LEVELS[0][2] + ROLLUP_SUM_COLUMNS + ROLLUP_COUNT_COLUMNS
+# PostgreSQL's reserved key words, which can't be used as column names without quoting them
+RESERVED_WORDS = frozenset((
+    "all", "analyse", "analyze", "and", "any", "array", "as", "asc", "asymmetric", "authorization", "binary", "both",
+    "case", "cast", "check", "collate", "collation", "column", "concurrently", "constraint", "create", "cross",
+    "current_catalog", "current_date", "current_role", "current_schema", "current_time", "current_timestamp",
+    "current_user", "default", "deferrable", "desc", "distinct", "do", "else", "end", "except", "false", "fetch", "for",
+    "foreign", "freeze", "from", "full", "grant", "group", "having", "ilike", "in", "initially", "inner", "intersect",
+    "into", "is", "isnull", "join", "lateral", "leading", "left", "like", "limit", "localtime", "localtimestamp",
+    "natural", "not", "notnull", "null", "offset", "on", "only", "or", "order", "outer", "overlaps", "placing",
+    "primary", "references", "returning", "right", "select", "session_user", "similar", "some", "symmetric",
+    "system_user", "table", "tablesample", "then", "to", "trailing", "true", "union", "unique", "user", "using",
+    "variadic", "verbose", "when", "where", "window", "with",
+))
+
+# One engine, declarative Base and VMModel per process, created the first time they are needed
+_engine = None
+_engine_pid = None
+_Base = None
+_vm_models = {}
+_vm_models_lock = threading.Lock()
+# History partitions this process has already made sure exist
+_history_partitions = set()
+
+# A function to build the database connection URL from environmental variables
+def get_connection_url() -> str:
+    db_user     = os.environ.get('DB_USER')
+    db_password = os.environ.get('DB_PASSWORD')
+    db_host     = os.environ.get('DB_HOST')
+    db_port     = os.environ.get('DB_PORT')
+    db_name     = os.environ.get('DB_NAME')
+
+    # Encode the password
+    encoded_password = urllib.parse.quote(db_password, safe='')
+
+    # Construct the connection URL
+    return f'postgresql://{db_user}:{encoded_password}@{db_host}:{db_port}/{db_name}'
+
+# A function to make a SQLAlchemy engine, importing SQLAlchemy the first time
+def create_engine(url: str, **kwargs):
+    import sqlalchemy
+    return sqlalchemy.create_engine(url, **kwargs)
+
+# A function to return this process's pooled database engine
+# A forked worker must not reuse the parent's connections, so each process gets its own engine
+def get_engine():
+    global _engine, _engine_pid
+    if _engine is not None and _engine_pid != os.getpid():
+        # Drop the parent's pool without closing its connections out from under it
+        _engine.dispose(close=False)
+        _engine = None
+
+    if _engine is None:
+        _engine = create_engine(
+            get_connection_url(),
+            pool_size=int(os.environ.get('DB_POOL_SIZE', 2)),
+            pool_pre_ping=True,
+        )
+        _engine_pid = os.getpid()
+        logging.debug(f"Created database engine for process {_engine_pid}")
+    return _engine
+
+# A function to create a database model for use by SQLAlchemy
+# Dataclass fields with column=False in their metadata are skipped
+# extra_columns adds string columns that aren't on the dataclass, like configured custom attributes
+# Child tables, like the disks of each VM, pass their own table and key, and their VM key points at the VM table
+def create_vm_model_class(Base, vm_dataclass, extra_columns=(), table=VM_TABLE, key_columns=VM_KEY_COLUMNS):
+    from sqlalchemy import Column, Integer, String, Boolean, Float, DateTime, ForeignKeyConstraint
+
+    # Create a dictionary of column definitions
+    columns = {
+        field.name: Column(
+            String if field.type == str else
+            Integer if field.type == int else
+            Float if field.type == float else
+            DateTime(timezone=True) if field.type == datetime else
+            Boolean if field.type == bool else String,
+            default=field.default,
+            primary_key=field.name in key_columns,
+            # The BIOS UUID isn't the key any more, but it's still what people look VMs up by
+            index=table == VM_TABLE and field.name == "vm_uuid",
+        )
+        for field in fields(vm_dataclass)
+        if field.metadata.get("column", True)
+    }
+    for column in extra_columns:
+        columns[column] = Column(String, default="")
+    # Rows go away with their VM
+    if table != VM_TABLE:
+        columns["__table_args__"] = (
+            ForeignKeyConstraint(VM_KEY_COLUMNS, [f"{VM_TABLE}.{column}" for column in VM_KEY_COLUMNS], ondelete="CASCADE"),
+        )
+
+    # Create the VMModel Class
+    VMModel = type(f"{vm_dataclass.__name__}Model", (Base,), {'__tablename__': table, **columns})
+
+    return VMModel
+
+# A function to return the VMModel for a dataclass, building it once per process
+# The table is created the first time if it doesn't exist yet, and any new text or extra columns are added to it
+# Threads in collect_all can get here at the same time, so only one of them builds it
+# The VM table's model has to be built before any child table's
+def get_vm_model(vm_dataclass, extra_columns=(), table=VM_TABLE, key_columns=VM_KEY_COLUMNS):
+    global _Base
+    with _vm_models_lock:
+        if _Base is None:
+            from sqlalchemy.orm import declarative_base
+            _Base = declarative_base()
+        if vm_dataclass not in _vm_models:
+            if table == VM_TABLE:
+                migrate_vm_key(get_engine())
+            VMModel = create_vm_model_class(_Base, vm_dataclass, extra_columns, table, key_columns)
+            _Base.metadata.create_all(get_engine(), tables=[VMModel.__table__])
+            text_columns = [field.name for field in fields(vm_dataclass) if field.type == str and field.metadata.get("column", True)]
+            add_missing_columns(get_engine(), table, text_columns + list(extra_columns))
+            _vm_models[vm_dataclass] = VMModel
+    return _vm_models[vm_dataclass]
+
+# A function to add text columns to an existing table if they aren't there yet
+# The table's columns are checked first, since even an ALTER that does nothing has to lock the table
+def add_missing_columns(engine, table: str, columns):
+    if not columns:
+        return
+    with engine.begin() as connection:
+        existing = {
+            row[0] for row in connection.exec_driver_sql(
+                "SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %(table)s",
+                {"table": table},
+            )
+        }
+        for column in columns:
+            if column not in existing:
+                connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} VARCHAR DEFAULT ''")
+
+# A function to move a VM table from before VMs were keyed on (vcenter, vm_moref) over to the new key
+# The old rows don't know their moref, so they get "uuid:" and their BIOS UUID as a placeholder, which was unique
+# when it was the key.  claim_legacy_rows swaps in the real moref on the first run, so the rows are updated in place.
+def migrate_vm_key(engine):
+    with engine.begin() as connection:
+        exists = connection.exec_driver_sql(
+            "SELECT count(*) FILTER (WHERE column_name = 'vm_moref'), count(*) FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = %(table)s",
+            {"table": VM_TABLE},
+        ).first()
+        if exists[0] or not exists[1]:
+            return
+        logging.info(f"Moving {VM_TABLE} from vm_uuid to a ({', '.join(VM_KEY_COLUMNS)}) key")
+        connection.exec_driver_sql(f"ALTER TABLE {VM_TABLE} ADD COLUMN vm_moref VARCHAR")
+        connection.exec_driver_sql(f"UPDATE {VM_TABLE} SET vm_moref = 'uuid:' || vm_uuid, vcenter = coalesce(vcenter, '')")
+        # The old key was made by whatever created the table, so look up what it's called instead of guessing
+        primary_key = connection.exec_driver_sql(
+            f"SELECT conname FROM pg_constraint WHERE contype = 'p' AND conrelid = '{VM_TABLE}'::regclass"
+        ).scalar()
+        if primary_key:
+            connection.exec_driver_sql(f'ALTER TABLE {VM_TABLE} DROP CONSTRAINT "{primary_key}"')
+        connection.exec_driver_sql(f"ALTER TABLE {VM_TABLE} ADD PRIMARY KEY ({', '.join(VM_KEY_COLUMNS)})")
+        connection.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS ix_{VM_TABLE}_vm_uuid ON {VM_TABLE} (vm_uuid)")
+
+# A function to check if a vCenter still has rows from before the moref key, that haven't been claimed yet
+def has_legacy_rows(engine, table: str, vcenter: str) -> bool:
+    with engine.connect() as connection:
+        return connection.exec_driver_sql(
+            f"SELECT 1 FROM {table} WHERE vcenter = %(vcenter)s AND vm_moref LIKE 'uuid:%%' LIMIT 1",
+            {"vcenter": vcenter},
+        ).first() is not None
+
+# A function to give a vCenter's rows from before the moref key the moref of the VM with their BIOS UUID
+# vm_refs is (moref, uuid) pairs.  When clones share a UUID only one of them gets the old row, and a moref
+# that already has a row of its own is left alone.  Returns how many rows were claimed.
+def claim_legacy_rows(engine, table: str, vcenter: str, vm_refs: list) -> int:
+    vm_refs = [(moref, uuid) for moref, uuid in vm_refs if uuid]
+    if not vm_refs:
+        return 0
+    with engine.begin() as connection:
+        result = connection.exec_driver_sql(
+            f"UPDATE {table} AS t SET vm_moref = live.moref "
+            f"FROM (SELECT DISTINCT ON (uuid) moref, uuid FROM unnest(%(morefs)s::text[], %(uuids)s::text[]) AS ref(moref, uuid) "
+            f"ORDER BY uuid, moref) AS live "
+            f"WHERE t.vcenter = %(vcenter)s AND t.vm_moref = 'uuid:' || live.uuid "
+            f"AND NOT EXISTS (SELECT 1 FROM {table} AS o WHERE o.vcenter = t.vcenter AND o.vm_moref = live.moref)",
+            {"vcenter": vcenter, "morefs": [moref for moref, uuid in vm_refs], "uuids": [uuid for moref, uuid in vm_refs]},
+        )
+        return result.rowcount
+
+# A function to delete a vCenter's rows with the given keys, in one statement
+# With rollup, the deleted rows are taken off the rollup tables in the same transaction
+def delete_rows(engine, table: str, key_column: str, vcenter: str, keys: list, rollup: bool = False) -> int:
+    if not keys:
+        return 0
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(
+            f"DELETE FROM {table} WHERE vcenter = %(vcenter)s AND {key_column} = ANY(%(keys)s)"
+            + (f" RETURNING {', '.join(ROLLUP_COLUMNS)}" if rollup else ""),
+            {"vcenter": vcenter, "keys": list(keys)},
+        )
+        deleted = cursor.rowcount
+        if rollup:
+            changes = defaultdict(Counter)
+            add_rollup_rows(changes, cursor.fetchall(), -1)
+            apply_rollup_changes(cursor, changes)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return deleted
+
+# A function to load the stored digest of every row for a vCenter, in one query
+# Returns key -> digest, so a run can tell which records actually changed
+def load_row_digests(engine, table: str, key_column: str, digest_column: str, vcenter: str) -> dict:
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"SELECT {key_column}, {digest_column} FROM {table} WHERE vcenter = %(vcenter)s", {"vcenter": vcenter})
+        digests = dict(cursor.fetchall())
+        connection.commit()
+    finally:
+        connection.close()
+    return digests
+
+# A function to load some columns of every VM row for a vCenter, in one query
+# Returns moref -> a tuple of the columns' values, in the order they were asked for
+def load_columns_by_moref(engine, table: str, columns: list, vcenter: str) -> dict:
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"SELECT vm_moref, {', '.join(columns)} FROM {table} WHERE vcenter = %(vcenter)s", {"vcenter": vcenter})
+        values = {row[0]: row[1:] for row in cursor.fetchall()}
+        connection.commit()
+    finally:
+        connection.close()
+    return values
+
+# A function to format one value for a PostgreSQL text format COPY
+def format_copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, str):
+        return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+    return str(value)
+
+# A function to stream rows into a file-like buffer for COPY
+def get_copy_buffer(rows) -> io.StringIO:
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(format_copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
+
+# A function to write a batch of rows with one COPY and one INSERT ... ON CONFLICT
+# Rows are copied into a temp staging table, then merged into the real table in a single statement
+# Rows with the same key in one batch are collapsed, since ON CONFLICT can't touch a row twice
+# With history_table, every history_column that differs from the stored row is logged there first, in the same transaction
+# children is a list of (child table, columns, rows).  Each batch row's children are replaced with the given ones
+# in the same transaction, matched on key_columns, so a row and its children are never out of step.
+# With compare_columns, a stored row is only updated if one of those columns changed, and the count returned
+# leaves out the rows that weren't
+# With rollup, the rollup tables are moved by the difference between the written rows and what they replaced,
+# in the same transaction.  The rows being replaced are locked first, so nothing changes them in between.
+def bulk_upsert(engine, table: str, columns: list, key_columns: list, rows: list, history_table: str = None, history_columns: list = (), children=(), compare_columns: list = None, rollup: bool = False) -> int:
+    if not rows:
+        return 0
+
+    staging = f"{table}_staging"
+    column_list = ", ".join(columns)
+    key_list = ", ".join(key_columns)
+    update_list = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns if column not in key_columns)
+    update_where = ""
+    if compare_columns:
+        update_where = (
+            f" WHERE ({', '.join(f't.{column}' for column in compare_columns)}) "
+            f"IS DISTINCT FROM ({', '.join(f'EXCLUDED.{column}' for column in compare_columns)})"
+        )
+
+    if history_table and history_columns:
+        ensure_history_partitions(engine, history_table)
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+        cursor.copy_expert(f"COPY {staging} ({column_list}) FROM STDIN", get_copy_buffer(rows))
+        if history_table and history_columns:
+            cursor.execute(get_history_insert(table, staging, key_columns, history_table, history_columns))
+        if rollup:
+            rollup_list = ", ".join(f"t.{column}" for column in ROLLUP_COLUMNS)
+            join = " AND ".join(f"t.{column} = s.{column}" for column in key_columns)
+            cursor.execute(
+                f"SELECT {', '.join(f't.{column}' for column in key_columns)}, {rollup_list} FROM {table} AS t "
+                f"JOIN (SELECT DISTINCT {key_list} FROM {staging}) AS s ON {join} FOR UPDATE OF t"
+            )
+            replaced = {row[:len(key_columns)]: row[len(key_columns):] for row in cursor.fetchall()}
+        cursor.execute(
+            f"INSERT INTO {table} AS t ({column_list}) "
+            f"SELECT DISTINCT ON ({key_list}) {column_list} FROM {staging} ORDER BY {key_list} "
+            f"ON CONFLICT ({key_list}) DO UPDATE SET {update_list}{update_where}"
+            + (f" RETURNING {', '.join(f't.{column}' for column in key_columns)}, {rollup_list}" if rollup else "")
+        )
+        written = cursor.rowcount
+        if rollup:
+            # Only the rows that were actually written count, a row compare_columns left alone didn't change
+            written_rows = cursor.fetchall()
+            changes = defaultdict(Counter)
+            add_rollup_rows(changes, [row[len(key_columns):] for row in written_rows], 1)
+            add_rollup_rows(changes, [replaced[row[:len(key_columns)]] for row in written_rows if row[:len(key_columns)] in replaced], -1)
+            apply_rollup_changes(cursor, changes)
+        if children:
+            child_join = " AND ".join(f"c.{column} = s.{column}" for column in key_columns)
+            for child_table, child_columns, child_rows in children:
+                cursor.execute(f"DELETE FROM {child_table} AS c USING {staging} AS s WHERE {child_join}")
+                if child_rows:
+                    cursor.copy_expert(f"COPY {child_table} ({', '.join(child_columns)}) FROM STDIN", get_copy_buffer(child_rows))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return written
+
+# A function to delete every row for a vCenter whose key isn't in live_keys, in one statement
+# The live keys are passed as an array and anti-joined server side, so no rows are loaded into Python
+# If more than max_delete_fraction of the vCenter's rows would go, the collection probably came back
+# short, so nothing is deleted and None is returned.  Otherwise returns the deleted keys.
+# With rollup, the deleted rows are taken off the rollup tables in the same transaction
+def delete_missing_rows(engine, table: str, key_column: str, vcenter: str, live_keys: list, max_delete_fraction: float = 1.0, rollup: bool = False):
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"SELECT count(*) FROM {table} WHERE vcenter = %(vcenter)s", {"vcenter": vcenter})
+        total = cursor.fetchone()[0]
+        cursor.execute(
+            f"DELETE FROM {table} AS t WHERE t.vcenter = %(vcenter)s "
+            f"AND NOT EXISTS (SELECT 1 FROM unnest(%(live_keys)s::text[]) AS live(key) WHERE live.key = t.{key_column}) "
+            f"RETURNING t.{key_column}" + "".join(f", t.{column}" for column in ROLLUP_COLUMNS if rollup),
+            {"vcenter": vcenter, "live_keys": list(live_keys)},
+        )
+        deleted_rows = cursor.fetchall()
+        deleted = [row[0] for row in deleted_rows]
+
+        if deleted and len(deleted) > total * max_delete_fraction:
+            connection.rollback()
+            logging.error(
+                f"# {vcenter} # Refusing to delete {len(deleted)} of {total} rows from {table}, "
+                f"more than {max_delete_fraction:.0%} of them.  The collection may be incomplete."
+            )
+            return None
+        if rollup:
+            changes = defaultdict(Counter)
+            add_rollup_rows(changes, [row[1:] for row in deleted_rows], -1)
+            apply_rollup_changes(cursor, changes)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return deleted
+
+# A function to create the rollup tables and fill them from table, if they don't exist yet
+# From then on they're only moved by the rows each write and delete changes, see bulk_upsert.
+# table is locked against writes while they're filled, so no write is missed or counted twice.
+def create_rollup_tables(engine, table: str):
+    with engine.connect() as connection:
+        if connection.exec_driver_sql("SELECT to_regclass(%(table)s)", {"table": ROLLUP_LEVELS[0][0]}).scalar() is not None:
+            return
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+        # Another process may have made them while we waited for the lock
+        if connection.exec_driver_sql("SELECT to_regclass(%(table)s)", {"table": ROLLUP_LEVELS[0][0]}).scalar() is not None:
+            return
+        logging.info(f"Creating the rollup tables from {table}")
+        for totals_table, counts_table, group_columns in ROLLUP_LEVELS:
+            group_definitions = ", ".join(f"{column} VARCHAR NOT NULL" for column in group_columns)
+            sum_definitions = ", ".join(f"{column} BIGINT NOT NULL" for column in ROLLUP_SUM_COLUMNS)
+            group_list = ", ".join(group_columns)
+            connection.exec_driver_sql(
+                f"CREATE TABLE IF NOT EXISTS {totals_table} ("
+                f"{group_definitions}, vms BIGINT NOT NULL, {sum_definitions}, PRIMARY KEY ({group_list}))"
+            )
+            connection.exec_driver_sql(
+                f"CREATE TABLE IF NOT EXISTS {counts_table} ("
+                f"{group_definitions}, property VARCHAR NOT NULL, value VARCHAR NOT NULL, vms BIGINT NOT NULL, "
+                f"PRIMARY KEY ({group_list}, property, value))"
+            )
+        fill_rollup_tables(connection, table)
+
+# A function to work the rollup tables out again from scratch, for when they've drifted from table
+# Only needed if table's rows were changed by something other than this script
+def rebuild_rollup_tables(engine, table: str):
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+        for totals_table, counts_table, group_columns in ROLLUP_LEVELS:
+            connection.exec_driver_sql(f"TRUNCATE {totals_table}, {counts_table}")
+        fill_rollup_tables(connection, table)
+
+# A function to fill empty rollup tables by adding up every row of table, with one GROUP BY per table
+def fill_rollup_tables(connection, table: str):
+    for totals_table, counts_table, group_columns in ROLLUP_LEVELS:
+        groups = ", ".join(f"coalesce({column}, '')" for column in group_columns)
+        positions = ", ".join(str(position) for position in range(1, len(group_columns) + 1))
+        sums = ", ".join(f"coalesce(sum({column}), 0)" for column in ROLLUP_SUM_COLUMNS)
+        values = ", ".join(f"('{column}', coalesce({column}, ''))" for column in ROLLUP_COUNT_COLUMNS)
+        connection.exec_driver_sql(
+            f"INSERT INTO {totals_table} ({', '.join(group_columns)}, vms, {', '.join(ROLLUP_SUM_COLUMNS)}) "
+            f"SELECT {groups}, count(*), {sums} FROM {table} GROUP BY {positions}"
+        )
+        connection.exec_driver_sql(
+            f"INSERT INTO {counts_table} ({', '.join(group_columns)}, property, value, vms) "
+            f"SELECT {groups}, counted.property, counted.value, count(*) FROM {table} "
+            f"CROSS JOIN LATERAL (VALUES {values}) AS counted(property, value) "
+            f"GROUP BY {positions}, counted.property, counted.value"
+        )
+
+# A function to add rows of ROLLUP_COLUMNS values to a set of rollup changes, sign is 1 for rows added and -1 for rows removed
+# changes is column -> Counter of group -> change for vms and each sum column, and "counts" -> Counter of
+# (group, property, value) -> change, all at the first rollup level.  The rows are turned into columns first,
+# so each column is added up in one pass.
+def add_rollup_rows(changes: dict, rows: list, sign: int):
+    if not rows:
+        return
+    columns = list(zip(*rows))
+    group_count = len(ROLLUP_LEVELS[0][2])
+    groups = list(zip(*[[value or "" for value in column] for column in columns[:group_count]]))
+    update = Counter.update if sign > 0 else Counter.subtract
+    update(changes["vms"], groups)
+    for column, values in zip(ROLLUP_SUM_COLUMNS, columns[group_count:]):
+        totals = changes[column]
+        for group, value in zip(groups, values):
+            totals[group] += sign * (value or 0)
+    for column, values in zip(ROLLUP_COUNT_COLUMNS, columns[group_count + len(ROLLUP_SUM_COLUMNS):]):
+        update(changes["counts"], zip(groups, repeat(column), (value or "" for value in values)))
+
+# A function to apply a set of rollup changes to every level's tables, on the cursor of the transaction that made them
+# Groups whose changes add up to nothing are left alone
+def apply_rollup_changes(cursor, changes: dict):
+    for totals_table, counts_table, group_columns in ROLLUP_LEVELS:
+        width = len(group_columns)
+        totals = defaultdict(lambda: [0] * (1 + len(ROLLUP_SUM_COLUMNS)))
+        for position, column in enumerate(("vms",) + ROLLUP_SUM_COLUMNS):
+            for group, change in changes[column].items():
+                totals[group[:width]][position] += change
+        counts = Counter()
+        for (group, column, value), change in changes["counts"].items():
+            counts[(group[:width], column, value)] += change
+        upsert_rollup_rows(
+            cursor, totals_table, group_columns, ("vms",) + ROLLUP_SUM_COLUMNS,
+            [group + tuple(values) for group, values in totals.items() if any(values)],
+        )
+        upsert_rollup_rows(
+            cursor, counts_table, group_columns + ("property", "value"), ("vms",),
+            [group + (column, value, change) for (group, column, value), change in counts.items() if change],
+        )
+
+# A function to add changes to the rows of a rollup table, in one statement, and delete the rows left with no VMs
+# Rows are written in key order, so writers running at the same time lock them in the same order and can't deadlock
+def upsert_rollup_rows(cursor, table: str, key_columns: tuple, value_columns: tuple, rows: list):
+    if not rows:
+        return
+    key_list = ", ".join(key_columns)
+    arrays = ", ".join(["%s::text[]"] * len(key_columns) + ["%s::bigint[]"] * len(value_columns))
+    cursor.execute(
+        f"INSERT INTO {table} AS t ({key_list}, {', '.join(value_columns)}) "
+        f"SELECT * FROM unnest({arrays}) ORDER BY {', '.join(str(position) for position in range(1, len(key_columns) + 1))} "
+        f"ON CONFLICT ({key_list}) DO UPDATE SET {', '.join(f'{column} = t.{column} + EXCLUDED.{column}' for column in value_columns)} "
+        f"RETURNING {key_list}, t.vms",
+        [list(column) for column in zip(*rows)],
+    )
+    empty = [row[:-1] for row in cursor.fetchall() if row[-1] == 0]
+    if empty:
+        cursor.execute(
+            f"DELETE FROM {table} WHERE ({key_list}) IN (SELECT * FROM unnest({', '.join(['%s::text[]'] * len(key_columns))})) AND vms = 0",
+            [list(column) for column in zip(*empty)],
+        )
+
+# A function to create the run tables if they don't exist yet
+def create_run_tables(engine):
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            f"CREATE TABLE IF NOT EXISTS {RUNS_TABLE} ("
+            f"run_id VARCHAR PRIMARY KEY, vcenter VARCHAR NOT NULL, status VARCHAR NOT NULL, "
+            f"vm_count INTEGER, started_at TIMESTAMPTZ NOT NULL DEFAULT now(), finished_at TIMESTAMPTZ)"
+        )
+        connection.exec_driver_sql(
+            f"CREATE TABLE IF NOT EXISTS {RUN_BATCHES_TABLE} ("
+            f"batch_id BIGSERIAL PRIMARY KEY, run_id VARCHAR NOT NULL REFERENCES {RUNS_TABLE} (run_id) ON DELETE CASCADE, "
+            f"status VARCHAR NOT NULL, keys TEXT[] NOT NULL, finished_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+        )
+        connection.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {RUN_BATCHES_TABLE}_run_id ON {RUN_BATCHES_TABLE} (run_id)")
+
+# A function to record the start of a run
+def start_run(engine, run_id: str, vcenter: str):
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            f"INSERT INTO {RUNS_TABLE} (run_id, vcenter, status) VALUES (%(run_id)s, %(vcenter)s, 'running') "
+            f"ON CONFLICT (run_id) DO UPDATE SET status = 'running', finished_at = NULL",
+            {"run_id": run_id, "vcenter": vcenter},
+        )
+
+# A function to find the most recent run for a vCenter that didn't finish, returns None if there isn't one
+def find_unfinished_run(engine, vcenter: str):
+    with engine.connect() as connection:
+        row = connection.exec_driver_sql(
+            f"SELECT run_id FROM {RUNS_TABLE} WHERE vcenter = %(vcenter)s AND status <> 'complete' "
+            f"ORDER BY started_at DESC LIMIT 1",
+            {"vcenter": vcenter},
+        ).first()
+    return row[0] if row else None
+
+# A function to record a chunk of a run as done or failed, with the keys it covered
+def record_run_batch(engine, run_id: str, status: str, keys: list):
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            f"INSERT INTO {RUN_BATCHES_TABLE} (run_id, status, keys) VALUES (%(run_id)s, %(status)s, %(keys)s)",
+            {"run_id": run_id, "status": status, "keys": list(keys)},
+        )
+
+# A function to load every key a run has already committed
+def load_run_done_keys(engine, run_id: str) -> set:
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(
+            f"SELECT DISTINCT unnest(keys) FROM {RUN_BATCHES_TABLE} WHERE run_id = %(run_id)s AND status = 'done'",
+            {"run_id": run_id},
+        )
+        return {row[0] for row in rows}
+
+# A function to record how a run ended
+# A complete run's batches are only needed for resuming, so they are cleared out
+def finish_run(engine, run_id: str, status: str, vm_count: int):
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            f"UPDATE {RUNS_TABLE} SET status = %(status)s, vm_count = %(vm_count)s, finished_at = now() WHERE run_id = %(run_id)s",
+            {"run_id": run_id, "status": status, "vm_count": vm_count},
+        )
+        if status == "complete":
+            connection.exec_driver_sql(f"DELETE FROM {RUN_BATCHES_TABLE} WHERE run_id = %(run_id)s", {"run_id": run_id})
+
+# A function to create a history table, partitioned by month on observed_at, if it doesn't exist yet
+# The index is for looking up one row's changes over time, and is created on every partition
+def create_history_table(engine, table: str, key_columns: list):
+    key_definitions = ", ".join(f"{column} VARCHAR NOT NULL" for column in key_columns)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            f"{key_definitions}, field VARCHAR NOT NULL, old_value TEXT, new_value TEXT, "
+            f"observed_at TIMESTAMPTZ NOT NULL DEFAULT now()) PARTITION BY RANGE (observed_at)"
+        )
+        connection.exec_driver_sql(
+            f"CREATE INDEX IF NOT EXISTS {table}_lookup ON {table} ({', '.join(key_columns)}, field, observed_at)"
+        )
+
+# A function to return the first day of the month a number of months after the one a date is in
+def add_months(when: datetime, months: int) -> datetime:
+    month = when.year * 12 + when.month - 1 + months
+    return datetime(month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+
+# A function to make sure the history partitions for this month and next month exist
+# Next month is created ahead so a write just after midnight on the 1st never has nowhere to go
+# They're created in their own transaction, so a write that rolls back doesn't take them with it
+def ensure_history_partitions(engine, table: str):
+    now = datetime.now(timezone.utc)
+    for months in (0, 1):
+        start = add_months(now, months)
+        partition = f"{table}_{start:%Y%m}"
+        if partition in _history_partitions:
+            continue
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                f"CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{start:%Y-%m-%d} 00:00:00+00') TO ('{add_months(start, 1):%Y-%m-%d} 00:00:00+00')"
+            )
+        _history_partitions.add(partition)
+
+# A function to build the INSERT that logs the changed fields of every staged row that already exists in table
+# Each staged row is compared to the stored one column by column as text, so only real changes are logged
+# New rows have nothing to compare against and aren't logged
+def get_history_insert(table: str, staging: str, key_columns: list, history_table: str, history_columns: list) -> str:
+    key_list = ", ".join(key_columns)
+    join = " AND ".join(f"t.{column} = s.{column}" for column in key_columns)
+    changes = ", ".join(f"('{column}', t.{column}::text, s.{column}::text)" for column in history_columns)
+    return (
+        f"INSERT INTO {history_table} ({key_list}, field, old_value, new_value) "
+        f"SELECT {', '.join(f's.{column}' for column in key_columns)}, change.field, change.old_value, change.new_value "
+        f"FROM (SELECT DISTINCT ON ({key_list}) * FROM {staging} ORDER BY {key_list}) AS s "
+        f"JOIN {table} AS t ON {join} "
+        f"CROSS JOIN LATERAL (VALUES {changes}) AS change(field, old_value, new_value) "
+        f"WHERE change.old_value IS DISTINCT FROM change.new_value"
+    )
+
+# A function to drop every history partition that only holds changes older than retention_days
+# Dropping a whole partition is instant, unlike deleting the rows.  Returns the partitions dropped.
+def drop_history_partitions(engine, table: str, retention_days: int) -> list:
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    dropped = []
+    with engine.begin() as connection:
+        partitions = connection.exec_driver_sql(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = %(table)s",
+            {"table": table},
+        )
+        for (partition,) in partitions.all():
+            # Leave alone anything attached by hand that isn't one of our monthly partitions
+            month = partition[len(table) + 1:]
+            if not partition.startswith(f"{table}_") or not re.fullmatch(r"\d{6}", month):
+                continue
+            start = datetime.strptime(month, "%Y%m").replace(tzinfo=timezone.utc)
+            if add_months(start, 1) <= cutoff:
+                connection.exec_driver_sql(f"DROP TABLE {partition}")
+                _history_partitions.discard(partition)
+                dropped.append(partition)
+    return dropped
+
+# A function to return a row as it was at a point in time, or None if it doesn't exist now
+# The first change logged after that time holds the value from before it, and fields that haven't changed
+# since are what's stored now.  keys is column -> value for every key column.  Values taken from the history are text.
+def load_row_at(engine, table: str, history_table: str, keys: dict, at: datetime):
+    where = " AND ".join(f"{column} = %({column})s" for column in keys)
+    with engine.connect() as connection:
+        row = connection.exec_driver_sql(f"SELECT * FROM {table} WHERE {where}", dict(keys)).mappings().first()
+        if row is None:
+            return None
+        changes = connection.exec_driver_sql(
+            f"SELECT DISTINCT ON (field) field, old_value FROM {history_table} "
+            f"WHERE {where} AND observed_at > %(at)s ORDER BY field, observed_at",
+            {**keys, "at": at},
+        )
+        values = dict(row)
+        values.update(changes.all())
+    return values
@@ -0,0 +1,187 @@
+import os
+import time
+import logging
+import threading
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Metrics for collection runs, kept in this process and exported in the OpenMetrics or Prometheus text format
+# Worker processes hand theirs back with collect() and the parent adds them in with merge(),
+# the same way session_stats gets summed up
+
+# Every metric we export, with its type and help text
+METRICS = {
+    "vmproperties_phase_seconds":               ("counter",   "Time spent in each phase of a collection"),
+    "vmproperties_soap_calls":                  ("counter",   "SOAP calls made to vCenter, by method"),
+    "vmproperties_soap_received_bytes":         ("counter",   "Bytes of SOAP responses received from vCenter"),
+    "vmproperties_soap_request_seconds":        ("histogram", "How long each SOAP call to vCenter took, by method"),
+    "vmproperties_vcenter_logins":              ("counter",   "Full vCenter logins"),
+    "vmproperties_vcenter_clones":              ("counter",   "vCenter sessions cloned from a ticket instead of logging in"),
+    "vmproperties_vms":                         ("counter",   "VMs handled, by what happened to their row"),
+    "vmproperties_last_run_duration_seconds":   ("gauge",     "How long the last collection run took"),
+    "vmproperties_last_run_timestamp_seconds":  ("gauge",     "When the last collection run finished"),
+    "vmproperties_first_write_seconds":         ("gauge",     "How long after the process started the first VMs were written"),
+}
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+# (name, labels) -> value for counters and gauges, and -> [bucket counts..., sum] for histograms
+# labels is a tuple of (label, value) pairs.  Collectors in collect_all share these from several threads.
+_lock = threading.Lock()
+_values = {}
+_histograms = {}
+
+# A function to add to a counter
+def inc(name: str, value: float = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+# A function to set a gauge
+def set_gauge(name: str, value: float, **labels):
+    with _lock:
+        _values[(name, tuple(sorted(labels.items())))] = value
+
+# A function to record one observation in a histogram
+def observe(name: str, value: float, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.setdefault(key, [0] * len(BUCKETS) + [0.0])
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-1] += value
+
+# Times the code inside it and adds the seconds to a phase of a collection
+@contextmanager
+def timer(phase: str, vcenter: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        inc("vmproperties_phase_seconds", time.perf_counter() - start, phase=phase, vcenter=vcenter)
+
+# A function to clear everything, like when a forked worker starts with a copy of its parent's metrics
+def reset():
+    with _lock:
+        _values.clear()
+        _histograms.clear()
+
+# A function to hand back everything recorded since the last call, and start again from zero
+# Pool workers return this with each chunk so the parent can merge() it
+def collect() -> dict:
+    with _lock:
+        snapshot = {"values": dict(_values), "histograms": {key: list(value) for key, value in _histograms.items()}}
+        _values.clear()
+        _histograms.clear()
+    return snapshot
+
+# A function to add a snapshot from collect() into this process's metrics
+def merge(snapshot: dict):
+    with _lock:
+        for key, value in snapshot["values"].items():
+            if METRICS[key[0]][0] == "gauge":
+                _values[key] = value
+            else:
+                _values[key] = _values.get(key, 0) + value
+        for key, value in snapshot["histograms"].items():
+            histogram = _histograms.setdefault(key, [0] * len(BUCKETS) + [0.0])
+            for i, count in enumerate(value):
+                histogram[i] += count
+
+# A function to format labels for a sample line
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        label + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for label, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+# A function to render every metric in the OpenMetrics text format, or with openmetrics=False in the
+# Prometheus text format that the Pushgateway and the node_exporter textfile collector parse.  The samples are
+# the same, but Prometheus names a counter's family after its _total samples and has no # EOF.
+def render(openmetrics: bool = True) -> str:
+    with _lock:
+        values = dict(_values)
+        histograms = {key: list(value) for key, value in _histograms.items()}
+
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        samples = sorted((labels, value) for (metric, labels), value in (histograms if kind == "histogram" else values).items() if metric == name)
+        if not samples:
+            continue
+        family = name if openmetrics or kind != "counter" else f"{name}_total"
+        lines.append(f"# TYPE {family} {kind}")
+        lines.append(f"# HELP {family} {help_text}")
+        for labels, value in samples:
+            if kind == "counter":
+                lines.append(f"{name}_total{format_labels(labels)} {value}")
+            elif kind == "gauge":
+                lines.append(f"{name}{format_labels(labels)} {value}")
+            else:
+                for bound, count in zip(BUCKETS, value):
+                    le = "+Inf" if bound == float("inf") else str(bound)
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {count}")
+                lines.append(f"{name}_count{format_labels(labels)} {value[len(BUCKETS) - 1]}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value[-1]}")
+    if openmetrics:
+        lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+# A function to write the metrics to a file for the node_exporter textfile collector
+# Written to a temp file and renamed, so the collector never sees half a file
+def write_textfile(path: str):
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w") as f:
+        f.write(render(openmetrics=False))
+    os.replace(tmp_file, path)
+
+# A function to push the metrics to a Pushgateway, replacing what was there for this job and instance
+def push(url: str, job: str, instance: str):
+    push_url = f"{url.rstrip('/')}/metrics/job/{urllib.parse.quote(job, safe='')}/instance/{urllib.parse.quote(instance, safe='')}"
+    request = urllib.request.Request(push_url, data=render(openmetrics=False).encode(), method="PUT", headers={"Content-Type": "text/plain; version=0.0.4"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        response.read()
+
+# A function to export the metrics at the end of a batch run
+# METRICS_TEXTFILE writes them to a file, PUSHGATEWAY_URL pushes them.  Neither is required.
+def export(instance: str):
+    textfile = os.environ.get('METRICS_TEXTFILE')
+    pushgateway = os.environ.get('PUSHGATEWAY_URL')
+    try:
+        if textfile:
+            write_textfile(textfile)
+        if pushgateway:
+            push(pushgateway, "vmproperties", instance)
+    except OSError as error:
+        # Metrics going missing shouldn't fail the collection
+        logging.warning(f"Could not export metrics: {error}")
+
+# Answers GET /metrics with the current metrics
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes would flood the log otherwise
+    def log_message(self, format, *args):
+        pass
+
+# A function to serve /metrics from a background thread, for long running modes
+def serve(port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving metrics on port {port}")
+    return server
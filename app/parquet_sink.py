@@ -0,0 +1,83 @@
+import os
+import uuid
+import logging
+from collections import Counter
+from dataclasses import fields
+from datetime import datetime, timezone
+
+# Writes VM records to Parquet files as they're collected, next to the database
+# Files are laid out as <root>/vcenter=<vcenter>/date=<YYYY-MM-DD>/part-<id>.parquet, so Spark, DuckDB and
+# pyarrow.dataset can prune by vCenter and day.  Every process writes its own files and nothing is read back.
+# pyarrow is only imported when a sink is made, so runs that don't write Parquet don't need it.
+
+# A function to build an Arrow schema from a dataclass, typed from its field types
+# Fields with column=False in their metadata are skipped, and extra_columns are added as strings
+def get_arrow_schema(vm_dataclass, extra_columns=()):
+    import pyarrow as pa
+    arrow_types = {str: pa.string(), int: pa.int64(), bool: pa.bool_(), float: pa.float64()}
+    schema_fields = [
+        pa.field(field.name, arrow_types[field.type])
+        for field in fields(vm_dataclass)
+        if field.metadata.get("column", True)
+    ]
+    schema_fields += [pa.field(column, pa.string()) for column in extra_columns]
+    return pa.schema(schema_fields)
+
+# Takes records and to_row, which turns one into a tuple in schema order
+# Records are buffered per partition until there are row_group_size of them, then written as one row group.
+# Files are written under a name starting with a dot, which dataset readers skip, and renamed when closed.
+class ParquetSink():
+    def __init__(self, root: str, vm_dataclass, to_row, extra_columns=(), row_group_size: int = 10000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("PARQUET_DIR is set but pyarrow isn't installed, pip install pyarrow")
+        self.root = root
+        self.to_row = to_row
+        self.schema = get_arrow_schema(vm_dataclass, extra_columns)
+        self.row_group_size = row_group_size
+        # (vcenter, date) -> [writer, tmp path, final path, buffered rows]
+        self.partitions = {}
+
+    # A function to add records to their partitions, returns empty counts since nothing is skipped
+    def write(self, vm_objs: list, digests: dict = None) -> Counter:
+        date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        for vm_obj in vm_objs:
+            partition = self.partitions.get((vm_obj.vcenter, date))
+            if partition is None:
+                partition = self.partitions[(vm_obj.vcenter, date)] = self.open_partition(vm_obj.vcenter, date)
+            partition[3].append(self.to_row(vm_obj))
+            if len(partition[3]) >= self.row_group_size:
+                self.flush(partition)
+        return Counter()
+
+    # A function to start a new file for a partition
+    def open_partition(self, vcenter: str, date: str) -> list:
+        import pyarrow.parquet as pq
+        directory = os.path.join(self.root, f"vcenter={vcenter}", f"date={date}")
+        os.makedirs(directory, exist_ok=True)
+        name = f"part-{uuid.uuid4().hex}.parquet"
+        tmp_path = os.path.join(directory, "." + name)
+        return [pq.ParquetWriter(tmp_path, self.schema), tmp_path, os.path.join(directory, name), []]
+
+    # A function to write a partition's buffered records as one row group
+    # The rows are turned into columns first, so Arrow builds each column in one go
+    def flush(self, partition: list):
+        import pyarrow as pa
+        rows = partition[3]
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        arrays = [pa.array(column, type=schema_field.type) for column, schema_field in zip(columns, self.schema)]
+        partition[0].write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        partition[3] = []
+
+    # A function to finish every file, which writes the Parquet footer, and move them into place
+    def close(self):
+        for partition in self.partitions.values():
+            self.flush(partition)
+            partition[0].close()
+            os.replace(partition[1], partition[2])
+            logging.debug(f"Wrote {partition[2]}")
+        self.partitions = {}
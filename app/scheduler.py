@@ -0,0 +1,41 @@
+import math
+import logging
+
+# Decides how many VMs go in the next chunk and how many chunks can be out at once
+# Additive increase, multiplicative decrease: every chunk that comes back quickly and cleanly grows the batch
+# by batch_step and lets one more chunk run at a time.  A chunk that took longer than target_seconds halves
+# the batch, and a vCenter fault or HTTP 503 halves both, so a struggling vCenter gets less asked of it at once.
+class AdaptiveScheduler():
+    def __init__(self, max_window: int, batch_size: int = 50, min_batch: int = 10, max_batch: int = 500,
+                 batch_step: int = 25, target_seconds: float = 5.0):
+        self.max_window = max_window
+        self.window = max_window
+        self.batch_size = batch_size
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.batch_step = batch_step
+        self.target_seconds = target_seconds
+        self.faults = 0
+
+    # A function to size the next chunk
+    # Near the end of the run chunks get smaller, so the last few spread across every worker
+    # instead of one slow chunk holding up the finish
+    def next_batch(self, remaining: int) -> int:
+        tail = math.ceil(remaining / self.max_window)
+        return max(1, min(self.batch_size, max(self.min_batch, tail), remaining))
+
+    # A function to record a chunk that came back, with how long its vCenter calls took
+    def on_success(self, seconds: float):
+        if seconds > self.target_seconds:
+            self.batch_size = max(self.min_batch, self.batch_size // 2)
+            logging.debug(f"Chunk took {seconds:.1f}s, batch size down to {self.batch_size}")
+            return
+        self.batch_size = min(self.max_batch, self.batch_size + self.batch_step)
+        self.window = min(self.max_window, self.window + 1)
+
+    # A function to record a chunk that failed with a vCenter fault or HTTP 503
+    def on_fault(self):
+        self.faults += 1
+        self.batch_size = max(self.min_batch, self.batch_size // 2)
+        self.window = max(1, self.window // 2)
+        logging.debug(f"vCenter fault, batch size down to {self.batch_size} and {self.window} chunks at once")
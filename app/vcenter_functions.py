@@ -1,13 +1,19 @@
+import os
 import ssl
+import time
 import atexit
 import logging
-from pyVim.connect import SmartConnect, Disconnect
-from pyVmomi import vim, vmodl
-import pyVim.task
+import multiprocessing.util
 import concurrent.futures
+import metrics
+# pyVmomi takes a tenth of a second to import, so like SQLAlchemy it's only imported by the functions that use it.
+# main() starts the database writer in the meantime, and the writer never needs it.
 
 # A function to connect to vCenter, which includes disconnecting atExit
-def connect_vcenter(vcenter: str, username: str, password: str) -> vim.ServiceInstance:
+# If session_id is given, try to pick that session back up before logging in again
+# Long running modes pass disconnect_at_exit=False so the session survives a restart
+def connect_vcenter(vcenter: str, username: str, password: str, session_id: str = None, disconnect_at_exit: bool = True) -> "vim.ServiceInstance":
+    from pyVim.connect import SmartConnect
     service_instance = None
 
     logging.debug("Connecting to {}".format(vcenter))
@@ -15,14 +21,20 @@ def connect_vcenter(vcenter: str, username: str, password: str) -> vim.ServiceIn
     s = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
     s.verify_mode = ssl.CERT_NONE
 
+    if session_id:
+        service_instance = resume_vcenter_session(vcenter, session_id, s)
+
     try:
-        service_instance = SmartConnect(
-            host=vcenter, user=username, pwd=password, sslContext=s
-        )
+        if not service_instance:
+            service_instance = SmartConnect(
+                host=vcenter, user=username, pwd=password, sslContext=s
+            )
+            metrics.inc("vmproperties_vcenter_logins", vcenter=vcenter)
 
         # doing this means you don't need to remember to disconnect your script/objects
         #atexit.register(Disconnect, service_instance) 
-        atexit.register(exit_handler, service_instance, vcenter)
+        if disconnect_at_exit:
+            atexit.register(exit_handler, service_instance, vcenter)
         logging.debug("Connection successful to {}".format(vcenter))
     except IOError as io_error:
         logging.error(io_error)
@@ -31,91 +43,369 @@ def connect_vcenter(vcenter: str, username: str, password: str) -> vim.ServiceIn
     if not service_instance:
         raise SystemExit("Unable to connect to host with supplied credentials.")
 
+    instrument_service_instance(service_instance, vcenter)
     return service_instance
 
+# A function to count and time every SOAP call made on a connection
+# Wraps the stub's InvokeMethod, which every method call and property read goes through,
+# and each response it reads, to count the bytes that came back
+def instrument_service_instance(service_instance: "vim.ServiceInstance", vcenter: str):
+    stub = service_instance._stub
+    invoke_method = stub.InvokeMethod
+
+    def timed_invoke_method(mo, info, args, *rest):
+        start = time.perf_counter()
+        try:
+            return invoke_method(mo, info, args, *rest)
+        finally:
+            metrics.inc("vmproperties_soap_calls", method=info.wsdlName, vcenter=vcenter)
+            # By method, since a WaitForUpdatesEx long poll takes as long as its wait and would drown out the rest
+            metrics.observe("vmproperties_soap_request_seconds", time.perf_counter() - start, method=info.wsdlName, vcenter=vcenter)
+
+    stub.InvokeMethod = timed_invoke_method
+
+    # Only the SOAP stub has pooled HTTP connections to count bytes on
+    if not hasattr(stub, "GetConnection"):
+        return
+    get_connection = stub.GetConnection
+
+    def counted_get_connection():
+        conn = get_connection()
+        if not hasattr(conn, "counted_getresponse"):
+            getresponse = conn.getresponse
+
+            def counted_getresponse(*args, **kwargs):
+                response = getresponse(*args, **kwargs)
+                read = response.read
+
+                def counted_read(*read_args):
+                    data = read(*read_args)
+                    metrics.inc("vmproperties_soap_received_bytes", len(data), vcenter=vcenter)
+                    return data
+
+                response.read = counted_read
+                return response
+
+            conn.getresponse = conn.counted_getresponse = counted_getresponse
+        return conn
+
+    stub.GetConnection = counted_get_connection
+
+# A function to reattach to an existing vCenter session, returns None if it has expired
+def resume_vcenter_session(vcenter: str, session_id: str, ssl_context: ssl.SSLContext):
+    from pyVim.connect import SmartConnect
+    from pyVmomi import vim
+    try:
+        service_instance = SmartConnect(host=vcenter, sessionId=session_id, sslContext=ssl_context)
+        if service_instance.content.sessionManager.currentSession:
+            logging.debug(f"Resumed existing session on {vcenter}")
+            return service_instance
+    except (IOError, vim.fault.NotAuthenticated) as error:
+        logging.debug(f"Could not resume session on {vcenter}: {error}")
+    logging.info(f"Saved session on {vcenter} has expired, logging in again")
+    return None
+
+# The vCenter session for this process, shared by every chunk the process handles
+_service_instance = None
+_service_content = None
+_service_instance_pid = None
+_clone_ticket = None
+
+# Counts of how this process got its sessions, summed up by main() at the end of a run
+session_stats = {"logins": 0, "clones": 0, "reuses": 0}
+
+# A function to clone an existing vCenter session with a ticket from SessionManager.AcquireCloneTicket
+# This skips a full login, returns None if the ticket can't be used
+def clone_vcenter_session(vcenter: str, clone_ticket: str):
+    from pyVim.connect import SmartStubAdapter
+    from pyVmomi import vim
+    s = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    s.verify_mode = ssl.CERT_NONE
+
+    try:
+        stub = SmartStubAdapter(host=vcenter, sslContext=s)
+        service_instance = vim.ServiceInstance("ServiceInstance", stub)
+        service_instance.content.sessionManager.CloneSession(clone_ticket)
+        logging.debug(f"Cloned session on {vcenter}")
+        metrics.inc("vmproperties_vcenter_clones", vcenter=vcenter)
+        instrument_service_instance(service_instance, vcenter)
+        return service_instance
+    except (IOError, vim.fault.InvalidLogin) as error:
+        logging.debug(f"Could not clone session on {vcenter}: {error}")
+        return None
+
+# A function to hand this process a clone ticket to use instead of logging in
+def set_clone_ticket(clone_ticket: str):
+    global _clone_ticket
+    _clone_ticket = clone_ticket
+
+# A function to return this process's vCenter session and its ServiceContent
+# The first call clones a session if we were given a ticket, or logs in, and every later call reuses it
+def get_service_instance(vcenter: str, username: str, password: str) -> tuple:
+    global _service_instance, _service_content, _service_instance_pid, _clone_ticket
+
+    # A forked worker must not share the parent's connection, so only reuse sessions we made ourselves
+    if _service_instance is not None and _service_instance_pid == os.getpid():
+        session_stats["reuses"] += 1
+        return _service_instance, _service_content
+
+    service_instance = None
+    if _clone_ticket:
+        service_instance = clone_vcenter_session(vcenter, _clone_ticket)
+        _clone_ticket = None
+        if service_instance:
+            session_stats["clones"] += 1
+    if not service_instance:
+        service_instance = connect_vcenter(vcenter=vcenter, username=username, password=password, disconnect_at_exit=False)
+        session_stats["logins"] += 1
+
+    # Log out when the process exits.  Pool workers skip atexit, but they do run multiprocessing finalizers
+    multiprocessing.util.Finalize(None, exit_handler, args=(service_instance, vcenter), exitpriority=10)
+
+    _service_instance = service_instance
+    _service_content = service_instance.RetrieveContent()
+    _service_instance_pid = os.getpid()
+    return _service_instance, _service_content
+
+# A function to get one-time tickets that let other processes clone our session
+def acquire_clone_tickets(service_instance: "vim.ServiceInstance", count: int) -> list:
+    session_manager = service_instance.content.sessionManager
+    return [session_manager.AcquireCloneTicket() for i in range(count)]
+
 # Just a function to add some things to atexit
-def exit_handler(service_instance: vim.ServiceInstance, vcenter: str):
+def exit_handler(service_instance: "vim.ServiceInstance", vcenter: str):
+    from pyVim.connect import Disconnect
     Disconnect(service_instance)
     logging.debug(f"Disconnected from {vcenter}")
 
-# A function to return all VMs
-def get_all_vms(service_instance: vim.ServiceInstance):
+# A function to return a container view of all VMs
+# The view can be handed to the PropertyCollector so the VM list never has to be pulled client side
+def get_vm_container_view(service_instance: "vim.ServiceInstance") -> "vim.view.ContainerView":
+    from pyVmomi import vim
     content = service_instance.RetrieveContent()
     container = content.rootFolder        # Starting point to look into
     view_type = [vim.VirtualMachine]      # Object types to look for
     recursive = True                      # Whether we should look into it recursively
     # Create VM view container
     container_view = content.viewManager.CreateContainerView(container, view_type, recursive)
-    return container_view.view
-
-# A function to return a VM uuid 
-def get_vm_uuid(vm: vim.VirtualMachine) -> str:
-    uuid = vm.summary.config.uuid
-    # Sometimes uuids are blank?  Skip blank ones
-    if uuid is not None:
-        return uuid
-
-# A function to find all the VM UUIDs in a vCenter
-def get_all_vm_uuids(all_vms):
-    uuids = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(get_vm_uuid, vm) for vm in all_vms]
-        concurrent.futures.wait(futures)
-        for future in futures:
-            uuid = future.result()
-            if uuid is not None:
-                uuids.append(uuid)
-    return uuids
+    return container_view
 
-# A function to return the datacenter a VM belongs to
-def get_vm_datacenter(vm: vim.VirtualMachine) -> str:
-    # Retrieve the VM's parent folder
-    vm_folder = vm.parent
+# A function to build an ObjectSpec that selects every object in a container view
+def get_view_object_spec(container_view: "vim.view.ContainerView") -> "vmodl.query.PropertyCollector.ObjectSpec":
+    from pyVmomi import vim, vmodl
+    traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+        name="traverseView", type=vim.view.ContainerView, path="view", skip=False
+    )
+    return vmodl.query.PropertyCollector.ObjectSpec(obj=container_view, skip=True, selectSet=[traversal_spec])
+
+# A function to build ObjectSpecs for a list of managed objects
+def get_object_specs(managed_objects, select_set=None) -> list:
+    from pyVmomi import vmodl
+    return [
+        vmodl.query.PropertyCollector.ObjectSpec(obj=managed_object, skip=False, selectSet=select_set or [])
+        for managed_object in managed_objects
+    ]
+
+# A generator that pages through RetrievePropertiesEx results and yields each ObjectContent
+# One round trip returns up to page_size objects with all of the requested properties
+def retrieve_properties(service_instance: "vim.ServiceInstance", object_specs: list, property_specs: list, page_size: int = 1000):
+    from pyVmomi import vmodl
+    # Nothing to ask for, so skip the round trip
+    if not object_specs:
+        return
+
+    property_collector = service_instance.content.propertyCollector
+    # Objects that no longer exist come back with a ManagedObjectNotFound in missingSet instead of failing the whole call
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=object_specs, propSet=property_specs, reportMissingObjectsInResults=True)
+    options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+
+    result = property_collector.RetrievePropertiesEx([filter_spec], options)
+    try:
+        while result:
+            for obj_content in result.objects:
+                yield obj_content
+            if not result.token:
+                break
+            token = result.token
+            result = None
+            result = property_collector.ContinueRetrievePropertiesEx(token)
+    finally:
+        # If the caller stopped early, release the server side result set
+        if result and result.token:
+            property_collector.CancelRetrievePropertiesEx(result.token)
+
+# A function to create a PropertyCollector filter that reports changes to every VM in a container view
+def create_vm_filter(service_instance: "vim.ServiceInstance", container_view: "vim.view.ContainerView", property_paths: list) -> "vmodl.query.PropertyCollector.Filter":
+    from pyVmomi import vim, vmodl
+    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=property_paths)
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[get_view_object_spec(container_view)], propSet=[property_spec])
+    return service_instance.content.propertyCollector.CreateFilter(filter_spec, partialUpdates=True)
+
+# A function to wait for the next set of changes after version
+# An empty version returns the current state of everything in the filters
+# Returns None if nothing changed within max_wait_seconds
+def wait_for_updates(service_instance: "vim.ServiceInstance", version: str, max_wait_seconds: int, max_object_updates: int = 1000):
+    from pyVmomi import vmodl
+    options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=max_wait_seconds, maxObjectUpdates=max_object_updates)
+    return service_instance.content.propertyCollector.WaitForUpdatesEx(version, options)
+
+# A function to check whether an ObjectContent is for an object that no longer exists
+def is_missing_object(obj_content: "vmodl.query.PropertyCollector.ObjectContent") -> bool:
+    from pyVmomi import vmodl
+    return any(isinstance(missing.fault, vmodl.fault.ManagedObjectNotFound) for missing in obj_content.missingSet or [])
+
+# A function to turn a moref id like vm-1234 back into a managed object on this connection
+# No call is made to vCenter, so this is how workers pick up VMs handed to them from discovery
+def get_vm_by_moid(moid: str, service_instance: "vim.ServiceInstance") -> "vim.VirtualMachine":
+    from pyVmomi import vim
+    return vim.VirtualMachine(moid, service_instance._stub)
+
+# A function to turn an ObjectContent into a dict of property path -> value
+def get_properties(obj_content: "vmodl.query.PropertyCollector.ObjectContent") -> dict:
+    return {prop.name: prop.val for prop in obj_content.propSet}
+
+# A function to map the moref of every VM in a container view to its UUID
+# Every VM is in it, a VM with a blank UUID maps to ""
+def get_vm_uuid_map(service_instance: "vim.ServiceInstance", container_view: "vim.view.ContainerView") -> dict:
+    from pyVmomi import vim, vmodl
+    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=["summary.config.uuid"])
+    uuid_map = {}
+    for obj_content in retrieve_properties(service_instance, [get_view_object_spec(container_view)], [property_spec]):
+        if is_missing_object(obj_content):
+            continue
+        uuid_map[obj_content.obj._moId] = get_properties(obj_content).get("summary.config.uuid") or ""
+    return uuid_map
+
+# A function to return the inventory objects that make up where a VM lives, plus networks so NICs on distributed port groups can be named
+def get_topology_types() -> list:
+    from pyVmomi import vim
+    return [vim.Folder, vim.Datacenter, vim.ComputeResource, vim.ClusterComputeResource, vim.HostSystem, vim.Network]
+
+# A function to turn an object's name and parent into a topology entry
+# Entries are plain strings so the index can be handed to worker processes
+def get_topology_entry(managed_object, props: dict) -> tuple:
+    parent = props.get("parent")
+    return managed_object._wsdlName, props.get("name", ""), parent._moId if parent is not None else None
 
-    # Check if the parent folder is the root folder (indicating it's a top-level VM)
-    if isinstance(vm_folder, vim.Datacenter):
-        return vm_folder.name  # The VM belongs to this datacenter
+# A function to build an index of every folder, datacenter, cluster and host in vCenter
+# Maps each moref id to (type, name, parent moref id).  A vCenter only has a few hundred of these,
+# so building it once lets every VM's host, cluster and datacenter be looked up without asking vCenter
+def get_topology(service_instance: "vim.ServiceInstance", container_view: "vim.view.ContainerView" = None) -> dict:
+    from pyVmomi import vim, vmodl
+    if container_view is None:
+        container_view = get_topology_container_view(service_instance)
+    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.ManagedEntity, pathSet=["name", "parent"])
 
-    # If the parent folder is not a datacenter, recursively check its parent
-    elif isinstance(vm_folder, vim.Folder):
-        return get_vm_datacenter(vm_folder)
+    topology = {}
+    for obj_content in retrieve_properties(service_instance, [get_view_object_spec(container_view)], [property_spec]):
+        topology[obj_content.obj._moId] = get_topology_entry(obj_content.obj, get_properties(obj_content))
+    return topology
+
+# A function to return a container view of the folders, datacenters, clusters and hosts
+def get_topology_container_view(service_instance: "vim.ServiceInstance") -> "vim.view.ContainerView":
+    content = service_instance.RetrieveContent()
+    return content.viewManager.CreateContainerView(content.rootFolder, get_topology_types(), True)
+
+# A function to create a PropertyCollector filter that reports renames and moves in the topology
+def create_topology_filter(service_instance: "vim.ServiceInstance", container_view: "vim.view.ContainerView") -> "vmodl.query.PropertyCollector.Filter":
+    from pyVmomi import vim, vmodl
+    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.ManagedEntity, pathSet=["name", "parent"])
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[get_view_object_spec(container_view)], propSet=[property_spec])
+    return service_instance.content.propertyCollector.CreateFilter(filter_spec, partialUpdates=False)
+
+# A function to apply topology filter updates to the index
+def apply_topology_updates(topology: dict, filter_update):
+    for object_update in filter_update.objectSet:
+        moid = object_update.obj._moId
+        if object_update.kind == "leave":
+            topology.pop(moid, None)
+            continue
+        # Start from what we had, so a rename keeps the parent and a move keeps the name
+        kind, name, parent = topology.get(moid, (object_update.obj._wsdlName, "", None))
+        for change in object_update.changeSet:
+            if change.name == "name":
+                name = change.val
+            elif change.name == "parent":
+                parent = change.val._moId if change.val is not None else None
+        topology[moid] = (kind, name, parent)
+
+# A function to add any objects missing from the index, along with everything above them
+# Covers hosts or folders created after the index was built, with one call for all of them
+def update_topology(service_instance: "vim.ServiceInstance", topology: dict, managed_objects):
+    from pyVmomi import vim, vmodl
+    missing = {managed_object._moId: managed_object for managed_object in managed_objects if managed_object._moId not in topology}
+    if not missing:
+        return
+
+    parent_traversal = vmodl.query.PropertyCollector.TraversalSpec(
+        name="traverseParent", type=vim.ManagedEntity, path="parent", skip=False,
+        selectSet=[vmodl.query.PropertyCollector.SelectionSpec(name="traverseParent")]
+    )
+    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.ManagedEntity, pathSet=["name", "parent"])
+    for obj_content in retrieve_properties(service_instance, get_object_specs(missing.values(), [parent_traversal]), [property_spec]):
+        topology[obj_content.obj._moId] = get_topology_entry(obj_content.obj, get_properties(obj_content))
+
+# A function to return the host, cluster and datacenter names of a VM from the topology index
+def get_vm_placement(host_moid: str, parent_moid: str, topology: dict) -> tuple:
+    vm_host = ""
+    vc_cluster = ""
+    if host_moid in topology:
+        kind, vm_host, host_parent = topology[host_moid]
+        if host_parent in topology:
+            vc_cluster = topology[host_parent][1]
+    return vm_host, vc_cluster, get_vm_datacenter(parent_moid, topology)
+
+# A function to return the datacenter a VM belongs to
+# Walks up the topology index instead of walking vm.parent remotely
+def get_vm_datacenter(parent_moid: str, topology: dict) -> str:
+    # Walk up the folders until we hit a datacenter
+    while parent_moid in topology:
+        kind, name, parent_moid = topology[parent_moid]
+        # Check if the parent is a datacenter (indicating we found the VM's datacenter)
+        if kind == "Datacenter":
+            return name
 
     # If the VM's parent is neither a datacenter nor a folder, it may not be in a vCenter hierarchy.
     return "Unknown"  # VM may not belong to a datacenter
 
-# A function to return a given custom attribute
-def get_custom_attribute(virtual_machine: vim.VirtualMachine, cfm: vim.CustomFieldsManager, custom_attribute: str) -> str:
-    fvalue = ""
-    try: 
-        for field in cfm.field:
-            if field.name == custom_attribute:
-                fkey = field.key
-        vm_fields = virtual_machine.customValue
-        
-        for opts in vm_fields:
-            if opts.key == fkey:
-                fvalue = opts.value
-        return fvalue
-    except:
-        # Need something to exist or the database merge fails
-        fvalue =  "None found"
-        return fvalue
-    
-def get_vm_by_uuid(uuid: str, service_instance: vim.ServiceInstance):
-    try:
-        search_index = service_instance.content.searchIndex
-        vm = search_index.FindByUuid(None, uuid, True)
-        if vm:
-            return vm
-    except:
-        logging.error(f"Could not find virtual machine {uuid}")
-        pass
+# A function to map performance counter names to their IDs
+# Names are group.counter.rollup, like cpu.ready.summation.  Counter IDs differ between vCenters but not
+# between calls, and reading perfCounter returns every counter, so do it once per run.
+def get_perf_counter_ids(service_instance: "vim.ServiceInstance", names: list) -> dict:
+    counter_ids = {}
+    for counter in service_instance.content.perfManager.perfCounter or []:
+        name = f"{counter.groupInfo.key}.{counter.nameInfo.key}.{counter.rollupType}"
+        if name in names:
+            counter_ids[name] = counter.key
+    return counter_ids
+
+# A function to fetch recent performance samples for many VMs in one QueryPerf call
+# One PerfQuerySpec per VM, each asking for the same counters summed over every instance (instance="")
+# interval_id 20 is the real-time stats, kept for about an hour
+def query_vm_perf(service_instance: "vim.ServiceInstance", vms: list, counter_ids: list, interval_id: int = 20, max_sample: int = 15) -> list:
+    from pyVmomi import vim
+    metric_ids = [vim.PerformanceManager.MetricId(counterId=counter_id, instance="") for counter_id in counter_ids]
+    query_specs = [
+        vim.PerformanceManager.QuerySpec(entity=vm, metricId=metric_ids, intervalId=interval_id, maxSample=max_sample)
+        for vm in vms
+    ]
+    return service_instance.content.perfManager.QueryPerf(querySpec=query_specs) or []
+
+# A function to map every custom attribute name to its key
+# This is one read of CustomFieldsManager.field, so do it once and hand the result around
+def get_custom_field_keys(cfm: "vim.CustomFieldsManager") -> dict:
+    return {field.name: field.key for field in cfm.field or []}
+
+# A function to return the custom attributes we collect from a VM's customValue list
+# attribute_keys maps each column to the key of its custom attribute, unset attributes come back as ""
+def get_custom_attributes(custom_values, attribute_keys: dict) -> dict:
+    values = {custom_value.key: getattr(custom_value, "value", "") for custom_value in custom_values or []}
+    return {column: values.get(key, "") for column, key in attribute_keys.items()}
 
 # A function to return the datastore a given VM resides on
 # This is lazy and cheap, and returns only the 1st datastore
-def get_vm_datastore(virtual_machine: vim.VirtualMachine) -> str:
+def get_vm_datastore(datastore_url) -> str:
     datastore = "None Found"
-    datastore_url = virtual_machine.config.datastoreUrl
     if datastore_url:
         if datastore_url[0].name:
             datastore = datastore_url[0].name 
@@ -1,31 +1,52 @@
-from pyVim.connect import SmartConnect, Disconnect
-from pyVmomi import vmodl, vim
+import time
+# When this process started, for timing how long it takes to write the first VMs
+PROCESS_START = time.perf_counter()
 from dataclasses import dataclass, field, fields
-from typing import List
-from sqlalchemy import create_engine, Column, Integer, String, MetaData, Table, Boolean
-from sqlalchemy.orm import sessionmaker, declarative_base
-from vme_functions import connect_vcenter, get_all_vms, get_all_vm_uuids, get_custom_attribute, get_vm_datacenter, get_vm_by_uuid, get_vm_datastore
+from vcenter_functions import connect_vcenter, get_vm_container_view, get_custom_field_keys, get_custom_attributes, get_vm_datastore, get_object_specs, retrieve_properties, get_properties, get_topology, get_topology_container_view, create_topology_filter, apply_topology_updates, update_topology, get_vm_placement, create_vm_filter, wait_for_updates, get_vm_uuid_map, get_view_object_spec, get_vm_by_moid, is_missing_object, get_perf_counter_ids, query_vm_perf, get_service_instance, set_clone_ticket, acquire_clone_tickets, session_stats
+import metrics
+from scheduler import AdaptiveScheduler
+from parquet_sink import ParquetSink
+from database_functions import VM_TABLE, VM_KEY_COLUMNS, RESERVED_WORDS, DISK_TABLE, NIC_TABLE, STATS_TABLE, get_engine, get_vm_model, bulk_upsert, delete_missing_rows, delete_rows, load_row_digests, load_columns_by_moref, create_run_tables, start_run, find_unfinished_run, record_run_batch, load_run_done_keys, finish_run, HISTORY_TABLE, create_history_table, ensure_history_partitions, drop_history_partitions, load_row_at, has_legacy_rows, claim_legacy_rows, create_rollup_tables, rebuild_rollup_tables
 import logging
 import sys
-import urllib.parse
-import psycopg2
 import uuid
 import re
-import time
+import math
 import concurrent.futures
+import multiprocessing.util
+import queue
 import os
+import json
+import argparse
+import contextlib
+import http.client
+import operator
+import hashlib
+import resource
+import threading
+from collections import Counter, deque
+from datetime import datetime
 from dotenv import load_dotenv
 # Load environmental variables from the .env file
 load_dotenv()
 
+# Everything logs through the root logger, which is set up when we're run as a script
+logger = logging.getLogger()
+# The format netelk expects
+LOG_FORMAT = "%(asctime)s | %(name)s | %(levelname)s | %(filename)s | %(funcName)s:%(lineno)d | %(message)s"
+
 # A dataclass containing all the info we want about a VM
-@dataclass
+# Slotted, so each record is a fixed set of attributes instead of a per-instance __dict__
+@dataclass(slots=True)
 class VM(): 
     name:                   str = ""
     vcenter:                str = ""
     cloud_name:             str = ""
     dns_name:               str = ""
+    # The moref is the key along with vcenter, the UUIDs are just stored
+    vm_moref:               str = ""
     vm_uuid:                str = ""
+    instance_uuid:          str = ""
     vm_host:                str = ""
     parent_id:              str = ""
     vc_cluster:             str = ""
@@ -75,35 +96,314 @@ class VM():
     diskformatrawvirtual:   int = 0
     diskformatrawphysical:  int = 0
     diskenableuuid:         bool = False
+    # Every virtual disk and NIC, written to their own tables
+    disks:                  list = field(default_factory=list, metadata={"column": False})
+    nics:                   list = field(default_factory=list, metadata={"column": False})
+    # Configured custom attributes that don't have a field of their own, keyed by column
+    custom_attributes:      dict = field(default_factory=dict, metadata={"column": False})
+
+# A dataclass for one virtual disk of a VM
+@dataclass(slots=True)
+class VMDisk():
+    vcenter:                str = ""
+    vm_moref:               str = ""
+    device_key:             int = 0
+    label:                  str = ""
+    capacitygb:             float = 0.0
+    backing:                str = ""
+    diskmode:               str = ""
+    compatibilitymode:      str = ""
+    thinprovisioned:        bool = False
+    datastore:              str = ""
+    filename:               str = ""
+    controller:             str = ""
+    unitnumber:             int = 0
+
+# A dataclass for one network adapter of a VM
+@dataclass(slots=True)
+class VMNic():
+    vcenter:                str = ""
+    vm_moref:               str = ""
+    device_key:             int = 0
+    label:                  str = ""
+    nictype:                str = ""
+    network:                str = ""
+    macaddress:             str = ""
+    connected:              bool = False
+    startconnected:         bool = False
+
+# A dataclass for a VM's recent performance, averaged over the samples QueryPerf returned
+@dataclass(slots=True)
+class VMStats():
+    vcenter:                str = ""
+    vm_moref:               str = ""
+    cpureadypct:            float = 0.0
+    cpuusagepct:            float = 0.0
+    memusagepct:            float = 0.0
+    disklatencyms:          int = 0
+    samples:                int = 0
+    sampledat:              datetime = None
+
+# Each row also stores a digest of its VM_COLUMNS values, so unchanged VMs can be skipped instead of rewritten
+DIGEST_COLUMN = "row_digest"
+
+# Columns a custom attribute can't fill: the ones that identify a VM, the ones the collector keeps itself,
+# and the names SQLAlchemy's table models use for their own attributes
+INTERNAL_COLUMNS = (
+    set(VM_KEY_COLUMNS) | {"vm_uuid", "instance_uuid", DIGEST_COLUMN, "metadata", "registry"}
+    | {field.name for field in fields(VM) if not field.metadata.get("column", True)}
+)
+
+# Custom attributes to collect, as column=attribute name pairs
+# A column that matches a VM field (like cloud_name) fills that field, anything else gets its own column
+def parse_custom_attributes(setting: str) -> dict:
+    custom_attributes = {}
+    for pair in setting.split(","):
+        if not pair.strip():
+            continue
+        column, _, attribute = pair.partition("=")
+        column = column.strip().lower()
+        # PostgreSQL cuts names down to 63 characters
+        if not re.fullmatch(r"[a-z_][a-z0-9_]{0,62}", column) or not attribute.strip():
+            raise SystemExit(f"Invalid CUSTOM_ATTRIBUTES entry: {pair}")
+        if column in INTERNAL_COLUMNS:
+            raise SystemExit(f"Invalid CUSTOM_ATTRIBUTES entry: {pair}, {column} is used by the collector itself")
+        if column in RESERVED_WORDS:
+            raise SystemExit(f"Invalid CUSTOM_ATTRIBUTES entry: {pair}, {column} is a reserved word in SQL")
+        custom_attributes[column] = attribute.strip()
+    return custom_attributes
+
+CUSTOM_ATTRIBUTES = parse_custom_attributes(os.environ.get('CUSTOM_ATTRIBUTES', 'cloud_name=cloud_instance_name'))
+
+# The columns for VM rows.  Dataclass fields come first, then custom attributes that need their own column
+VM_FIELD_COLUMNS = [field.name for field in fields(VM) if field.metadata.get("column", True)]
+CUSTOM_COLUMNS = [column for column in CUSTOM_ATTRIBUTES if column not in VM_FIELD_COLUMNS]
+VM_COLUMNS = VM_FIELD_COLUMNS + CUSTOM_COLUMNS
+# Reads every field column off a VM in VM_FIELD_COLUMNS order in one call
+get_vm_field_values = operator.attrgetter(*VM_FIELD_COLUMNS)
+
+# The columns of the disk and NIC tables, and their values off a record in that order
+DISK_COLUMNS = [field.name for field in fields(VMDisk)]
+NIC_COLUMNS = [field.name for field in fields(VMNic)]
+get_disk_values = operator.attrgetter(*DISK_COLUMNS)
+get_nic_values = operator.attrgetter(*NIC_COLUMNS)
+
+# The performance counters the stats stage reads, as group.counter.rollup
+STATS_COUNTERS = ["cpu.ready.summation", "cpu.usage.average", "mem.usage.average", "disk.maxTotalLatency.latest"]
+STATS_COLUMNS = [field.name for field in fields(VMStats)]
+get_stats_values = operator.attrgetter(*STATS_COLUMNS)
+
+# The columns VM rows have on top of the VM fields
+EXTRA_COLUMNS = CUSTOM_COLUMNS + [DIGEST_COLUMN]
+
+# Changes to these columns are logged to HISTORY_TABLE, and kept for HISTORY_RETENTION_DAYS.  0 turns the history off.
+HISTORY_RETENTION_DAYS = int(os.environ.get('HISTORY_RETENTION_DAYS', 365))
+HISTORY_COLUMNS = [column for column in VM_COLUMNS if column not in VM_KEY_COLUMNS] if HISTORY_RETENTION_DAYS else []
+_history_ready = False
+_history_lock = threading.Lock()
+# Set once this process has made sure the VM, disk and NIC tables exist
+_tables_ready = False
+
+# A function to work out the key of each configured custom attribute
+# Takes the name -> key map from get_custom_field_keys and returns column -> key
+def get_custom_attribute_keys(field_keys: dict) -> dict:
+    attribute_keys = {}
+    for column, attribute in CUSTOM_ATTRIBUTES.items():
+        if attribute not in field_keys:
+            logging.warning(f"Custom attribute {attribute} is not defined in vCenter")
+        attribute_keys[column] = field_keys.get(attribute)
+    return attribute_keys
+
+# Every property path create_vm_obj reads, fetched in one PropertyCollector call per page of VMs
+VM_PROPERTY_PATHS = [
+    "parent",
+    "customValue",
+    "rootSnapshot",
+    "guest.guestFamily",
+    "summary.config.name",
+    "summary.config.uuid",
+    "summary.config.instanceUuid",
+    "summary.config.numCpu",
+    "summary.config.cpuReservation",
+    "summary.config.memorySizeMB",
+    "summary.config.memoryReservation",
+    "summary.config.vmPathName",
+    "summary.config.guestFullName",
+    "summary.config.guestId",
+    "summary.config.numEthernetCards",
+    "summary.config.numVirtualDisks",
+    "summary.runtime.host",
+    "summary.runtime.powerState",
+    "summary.runtime.connectionState",
+    "summary.runtime.dasVmProtection",
+    "summary.runtime.consolidationNeeded",
+    "summary.guest.hostName",
+    "summary.guest.toolsStatus",
+    "summary.guest.ipAddress",
+    "summary.storage.committed",
+    "summary.storage.uncommitted",
+    "config.datastoreUrl",
+    "config.extraConfig",
+    "config.managedBy",
+    "config.cpuAllocation",
+    "config.memoryAllocation",
+    "config.cpuHotAddEnabled",
+    "config.memoryHotAddEnabled",
+    "config.version",
+    "config.tools.toolsVersion",
+    "config.hardware.device",
+]
+
+# The property paths create_vm_obj reads for each column
+COLUMN_PATHS = {
+    "name":                 ["summary.config.name"],
+    "dns_name":             ["summary.guest.hostName"],
+    "vm_uuid":              ["summary.config.uuid"],
+    "instance_uuid":        ["summary.config.instanceUuid"],
+    "vm_host":              ["summary.runtime.host"],
+    "vc_cluster":           ["summary.runtime.host"],
+    "vc_datacenter":        ["parent"],
+    "powerstate":           ["summary.runtime.powerState"],
+    "connectionstate":      ["summary.runtime.connectionState"],
+    "datastorecluster":     ["config.datastoreUrl"],
+    "haprotected":          ["summary.runtime.dasVmProtection"],
+    "numcpu":               ["summary.config.numCpu"],
+    "cpulimit":             ["config.cpuAllocation"],
+    "cpureservation":       ["summary.config.cpuReservation"],
+    "cpushares":            ["config.cpuAllocation"],
+    "cpuhotaddenabled":     ["config.cpuHotAddEnabled"],
+    "memorymb":             ["summary.config.memorySizeMB"],
+    "memlimit":             ["config.memoryAllocation"],
+    "memreservation":       ["summary.config.memoryReservation"],
+    "memshares":            ["config.memoryAllocation"],
+    "memhotaddenabled":     ["config.memoryHotAddEnabled"],
+    "hardwareversion":      ["config.version"],
+    "vmpath":               ["summary.config.vmPathName"],
+    "vmpathname":           ["summary.config.vmPathName"],
+    "snapshot":             ["rootSnapshot"],
+    "consolidationneeded":  ["summary.runtime.consolidationNeeded"],
+    "srmreplicated":        ["config.extraConfig"],
+    "srmplaceholder":       ["config.managedBy"],
+    "toolsstatus":          ["summary.guest.toolsStatus"],
+    "toolsversionstatus":   ["summary.guest.toolsStatus"],
+    "toolsversion":         ["config.tools.toolsVersion"],
+    "guestfamily":          ["guest.guestFamily"],
+    "guestfullname":        ["summary.config.guestFullName"],
+    "osconfigfullname":     ["summary.config.guestFullName"],
+    "osconfigid":           ["summary.config.guestId"],
+    "floppydrive":          ["config.hardware.device"],
+    "networkcount":         ["summary.config.numEthernetCards"],
+    "ipaddress":            ["summary.guest.ipAddress"],
+    "vmdkcount":            ["summary.config.numVirtualDisks"],
+    "vmdktotalgb":          ["summary.storage.committed", "summary.storage.uncommitted"],
+    "sizeondiskgb":         ["summary.storage.committed"],
+    "provisioning":         ["config.hardware.device"],
+    "thindisks":            ["config.hardware.device"],
+    "thinprovisionedgb":    ["config.hardware.device"],
+    "datastorecount":       ["config.datastoreUrl"],
+    "scsicontrollers":      ["config.hardware.device"],
+    "diskformattedflat":    ["config.hardware.device"],
+    "diskformatrawvirtual": ["config.hardware.device"],
+    "diskformatrawphysical":["config.hardware.device"],
+    "diskenableuuid":       ["config.extraConfig"],
+}
+
+# Named sets of columns a run can collect, so a quick refresh doesn't have to fetch everything
+# Each fetches only the paths its columns need, and only its columns are written.  The rest keep their last values.
+# The disk and NIC tables are only written by full.
+PROPERTY_PROFILES = {
+    "minimal":      ["vcenter", "vm_moref", "vm_uuid", "name", "vm_host", "powerstate", "connectionstate"],
+    "placement":    ["vcenter", "vm_moref", "vm_uuid", "name", "vm_host", "powerstate", "connectionstate",
+                     "vc_cluster", "vc_datacenter", "datastorecluster", "datastorecount", "haprotected"],
+    "full":         VM_COLUMNS,
+}
+
+# A property profile, with the columns it writes and the property paths it fetches
+@dataclass(frozen=True)
+class PropertyProfile():
+    name:       str
+    columns:    tuple
+    paths:      tuple
+
+    @property
+    def full(self) -> bool:
+        return self.name == "full"
+
+# A function to look up a property profile by name
+def get_property_profile(name: str) -> PropertyProfile:
+    if name not in PROPERTY_PROFILES:
+        raise SystemExit(f"Unknown property profile {name}, pick one of {', '.join(PROPERTY_PROFILES)}")
+    if name == "full":
+        return PropertyProfile(name, tuple(VM_COLUMNS), tuple(VM_PROPERTY_PATHS))
+    columns = PROPERTY_PROFILES[name]
+    # Custom attributes all come from customValue
+    paths = {path for column in columns for path in (["customValue"] if column in CUSTOM_ATTRIBUTES else COLUMN_PATHS.get(column, []))}
+    return PropertyProfile(name, tuple(columns), tuple(path for path in VM_PROPERTY_PATHS if path in paths))
+
+# A function to work out which profile to collect a vCenter with
+# PROPERTY_PROFILE is a profile name, optionally followed by vcenter=profile pairs, like placement,vc2.example.com=full
+# A profile picked on the command line wins over all of it
+def get_vcenter_profile(vcenter: str, override: str = None) -> PropertyProfile:
+    if override:
+        return get_property_profile(override)
+    name = "full"
+    for item in os.environ.get('PROPERTY_PROFILE', 'full').split(","):
+        key, _, profile = item.strip().rpartition("=")
+        if not key:
+            name = profile or name
+        elif key == vcenter:
+            return get_property_profile(profile)
+    return get_property_profile(name)
+
+# A function to fetch the properties of a list of VMs in bulk
+# paths defaults to everything create_vm_obj reads
+# Returns the properties of each VM keyed by moref
+def get_vm_properties(si: "vim.ServiceInstance", vms: list, paths=VM_PROPERTY_PATHS) -> dict:
+    from pyVmomi import vim, vmodl
+    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=list(paths))
+    # VMs that have gone away since they were handed to us are left out
+    vm_props = {
+        obj_content.obj._moId: get_properties(obj_content)
+        for obj_content in retrieve_properties(si, get_object_specs(vms), [property_spec])
+        if not is_missing_object(obj_content)
+    }
+    return vm_props
+
+# A function to make sure every host and parent folder a set of VMs reference is in the topology index
+# Normally they all are already, this only calls vCenter for ones created since the index was built
+def update_vm_topology(si: "vim.ServiceInstance", topology: dict, vm_props):
+    placement = []
+    for props in vm_props:
+        for path in ("summary.runtime.host", "parent"):
+            if props.get(path) is not None:
+                placement.append(props[path])
+    update_topology(si, topology, placement)
+
+# A function to process the properties of a vim.VirtualMachine into our VM class
+# props comes from get_vm_properties, so this makes no calls to vCenter
+# topology is the index from get_topology, used to resolve the host, cluster and datacenter names
+# attribute_keys is the column -> key map from get_custom_attribute_keys
+# moid is the VM's moref id, which along with vcenter is what its row is keyed on
+def create_vm_obj(props: dict, topology: dict, attribute_keys: dict, vcenter: str, moid: str) -> VM:
 
-# A dataclass that is a list of VMs
-@dataclass
-class VMlist(): 
-    vms: List[VM] =field(default_factory=list)
-
-# A function to process a vim.VirtualMachine into our VM class
-# This also takes a CustomFieldsManager as an argument as a dependency to process any custom attributes
-def create_vm_obj(virtual_machine: vim.VirtualMachine, cfm:vim.CustomFieldsManager) -> VM:
-
-    # Make an easier summary variable, although this ends up not being that useful
-    # Also use this as a check to see if the VM still exists
-    try:
-        summary = virtual_machine.summary
-    except:
-        return
+    # Sometimes the UUID is blank, I don't know how that's possible
+    # It isn't the key, so it's just stored blank
+    vm_uuid = props.get("summary.config.uuid") or ""
 
-    # Check a bunch of device stuff
-    hasfloppy, thin_provisioned_count, flat_disk_count, raw_virtual_count, raw_physical_count, scsi_controller_count = get_vm_device_info(virtual_machine)
+    # Check a bunch of device stuff, and make a record of every disk and NIC on the way
+    hasfloppy, thin_provisioned_count, thin_provisioned_gb, flat_disk_count, raw_virtual_count, raw_physical_count, scsi_controller_count, disks, nics = get_vm_device_info(
+        props.get("config.hardware.device"), moid, vcenter, topology
+    )
 
     # Check if there is a snapshot
     hassnapshot = False
-    if virtual_machine.snapshot:
+    if props.get("rootSnapshot"):
         hassnapshot = True
 
     # Check if HA enabled
     haprotected = False
-    if summary.runtime.dasVmProtection:
-        haprotected = summary.runtime.dasVmProtection.dasProtected
+    if props.get("summary.runtime.dasVmProtection"):
+        haprotected = props["summary.runtime.dasVmProtection"].dasProtected
 
     # Set whether thick or thin
     provisioning = "Thick"
@@ -111,19 +411,17 @@ def create_vm_obj(virtual_machine: vim.VirtualMachine, cfm:vim.CustomFieldsManag
         provisioning = "Thin"
 
     # Count datastores
-    datastore_count = 0
-    for datastore in virtual_machine.config.datastoreUrl:
-        datastore_count += 1
+    datastore_url = props.get("config.datastoreUrl") or []
+    datastore_count = len(datastore_url)
 
     # Get data from vm tools
-    if summary.guest is not None:
-        dns_name    = summary.guest.hostName
-        toolsstatus = summary.guest.toolsStatus
-        ipaddress   = summary.guest.ipAddress
-        guestfamily = virtual_machine.guest.guestFamily
+    dns_name    = props.get("summary.guest.hostName")
+    toolsstatus = props.get("summary.guest.toolsStatus")
+    ipaddress   = props.get("summary.guest.ipAddress")
+    guestfamily = props.get("guest.guestFamily")
 
     # Check extraconfig items
-    extra_config = virtual_machine.config.extraConfig
+    extra_config = props.get("config.extraConfig") or []
 
     # Check host based replication
     srmreplicated = False
@@ -139,121 +437,197 @@ def create_vm_obj(virtual_machine: vim.VirtualMachine, cfm:vim.CustomFieldsManag
 
     # Check if SRM Placeholder
     srmplaceholder = False
-    if virtual_machine.config.managedBy:
+    if props.get("config.managedBy"):
         srmplaceholder = True
 
-    # Sometimes the UUID is blank, I don't know how that's possible
-    # This gives it a fake one
-    vm_uuid = summary.config.uuid
-    if not vm_uuid:
-        random_uuid = uuid.uuid4()
-        vm_uuid = "fake-" + str(random_uuid)
+    # Resolve the host, cluster and datacenter from the topology index
+    host    = props.get("summary.runtime.host")
+    parent  = props.get("parent")
+    vm_host, vc_cluster, vc_datacenter = get_vm_placement(
+        host._moId if host is not None else None,
+        parent._moId if parent is not None else None,
+        topology,
+    )
+
+    cpu_allocation      = props.get("config.cpuAllocation")
+    memory_allocation   = props.get("config.memoryAllocation")
+    committed           = props.get("summary.storage.committed") or 0
+    uncommitted         = props.get("summary.storage.uncommitted") or 0
+    vm_path             = props.get("summary.config.vmPathName") or ""
 
     # Create the VM object
     vm = VM(
-        name                    = summary.config.name,
-        vcenter                 = (os.environ.get('VCENTER')),
-        cloud_name              = (get_custom_attribute(virtual_machine, cfm, "cloud_instance_name")),
+        name                    = props.get("summary.config.name"),
+        vcenter                 = vcenter,
         dns_name                = dns_name,
+        vm_moref                = moid,
         vm_uuid                 = vm_uuid,
-        vm_host                 = summary.runtime.host.name,
+        instance_uuid           = props.get("summary.config.instanceUuid") or "",
+        vm_host                 = vm_host,
         #parent_id=
-        vc_cluster              = summary.runtime.host.parent.name,
-        vc_datacenter           = (get_vm_datacenter(virtual_machine)),
-        powerstate              = summary.runtime.powerState,
-        connectionstate         = summary.runtime.connectionState,
-        datastorecluster        = (get_vm_datastore(virtual_machine)),
+        vc_cluster              = vc_cluster,
+        vc_datacenter           = vc_datacenter,
+        powerstate              = props.get("summary.runtime.powerState"),
+        connectionstate         = props.get("summary.runtime.connectionState"),
+        datastorecluster        = (get_vm_datastore(datastore_url)),
         haprotected             = haprotected,
-        numcpu                  = summary.config.numCpu,
-        cpulimit                = virtual_machine.config.cpuAllocation.limit,
-        cpureservation          = summary.config.cpuReservation,
-        cpushares               = virtual_machine.config.cpuAllocation.shares.level,
-        cpuhotaddenabled        = virtual_machine.config.cpuHotAddEnabled,
-        memorymb                = summary.config.memorySizeMB,
-        memlimit                = virtual_machine.config.memoryAllocation.limit,
-        memreservation          = summary.config.memoryReservation,
-        memshares               = virtual_machine.config.memoryAllocation.shares.level,
-        memhotaddenabled        = virtual_machine.config.memoryHotAddEnabled,
-        hardwareversion         = virtual_machine.config.version,
+        numcpu                  = props.get("summary.config.numCpu"),
+        cpulimit                = cpu_allocation.limit if cpu_allocation else None,
+        cpureservation          = props.get("summary.config.cpuReservation"),
+        cpushares               = cpu_allocation.shares.level if cpu_allocation and cpu_allocation.shares else None,
+        cpuhotaddenabled        = props.get("config.cpuHotAddEnabled"),
+        memorymb                = props.get("summary.config.memorySizeMB"),
+        memlimit                = memory_allocation.limit if memory_allocation else None,
+        memreservation          = props.get("summary.config.memoryReservation"),
+        memshares               = memory_allocation.shares.level if memory_allocation and memory_allocation.shares else None,
+        memhotaddenabled        = props.get("config.memoryHotAddEnabled"),
+        hardwareversion         = props.get("config.version"),
         #targethardwareversion:  int = 0
         #hardwareneedsupgrade:   bool = False
-        vmpath                  = summary.config.vmPathName,
-        vmpathname              = (get_vm_path_name(summary.config.vmPathName)),
+        vmpath                  = vm_path,
+        vmpathname              = (get_vm_path_name(vm_path)),
         snapshot                = hassnapshot,
-        consolidationneeded     = summary.runtime.consolidationNeeded,
+        consolidationneeded     = props.get("summary.runtime.consolidationNeeded"),
         #sanreplicated:      bool = False
         srmreplicated           = srmreplicated,
         srmplaceholder          = srmplaceholder,
         toolsstatus             = toolsstatus,
         toolsversionstatus      = toolsstatus,
-        toolsversion            = virtual_machine.config.tools.toolsVersion,
+        toolsversion            = props.get("config.tools.toolsVersion"),
         guestfamily             = guestfamily,
-        guestfullname           = summary.config.guestFullName,
-        osconfigfullname        = summary.config.guestFullName,
-        osconfigid              = summary.config.guestId,
+        guestfullname           = props.get("summary.config.guestFullName"),
+        osconfigfullname        = props.get("summary.config.guestFullName"),
+        osconfigid              = props.get("summary.config.guestId"),
         floppydrive             = hasfloppy,
-        networkcount            = summary.config.numEthernetCards,
+        networkcount            = props.get("summary.config.numEthernetCards"),
         ipaddress               = ipaddress,
-        vmdkcount               = summary.config.numVirtualDisks,
-        vmdktotalgb             = (round((summary.storage.committed + summary.storage.uncommitted)/ (1024 * 1024 * 1024))),
-        sizeondiskgb            = (round(summary.storage.committed / (1024 * 1024 * 1024))),
+        vmdkcount               = props.get("summary.config.numVirtualDisks"),
+        vmdktotalgb             = (round((committed + uncommitted)/ (1024 * 1024 * 1024))),
+        sizeondiskgb            = (round(committed / (1024 * 1024 * 1024))),
         provisioning            = provisioning,
         thindisks               = thin_provisioned_count,
-        #thinprovisionedgb:  int = 0
+        thinprovisionedgb       = thin_provisioned_gb,
         datastorecount          = datastore_count,
         scsicontrollers         = scsi_controller_count,
         diskformattedflat       = flat_disk_count,
         diskformatrawvirtual    = raw_virtual_count,
         diskformatrawphysical   = raw_physical_count,
-        diskenableuuid          = diskenableuuid
+        diskenableuuid          = diskenableuuid,
+        disks                   = disks,
+        nics                    = nics,
     )
+
+    # Fill in the custom attributes from the customValue we already fetched
+    for column, value in get_custom_attributes(props.get("customValue"), attribute_keys).items():
+        if column in VM_FIELD_COLUMNS:
+            setattr(vm, column, value)
+        else:
+            vm.custom_attributes[column] = value
     return vm
 
 # A function to return some data about the devices on a VM
-def get_vm_device_info(virtual_machine: vim.VirtualMachine) -> tuple:
+# Also builds a VMDisk for every virtual disk and a VMNic for every network adapter, from the same device list
+def get_vm_device_info(devices, vm_moref: str = "", vcenter: str = "", topology: dict = None) -> tuple:
+    from pyVmomi import vim
+    hasfloppy = False
+    thin_provisioned_count = 0
+    thin_provisioned_gb = 0
+    flat_disk_count = 0
+    raw_virtual_count = 0
+    raw_physical_count = 0
+    scsi_controller_count = 0
+    disks = []
+    nics = []
+    devices = devices or []
+
+    # Disks name their controller by key, so find those first
+    controllers = {device.key: get_device_label(device) for device in devices if isinstance(device, vim.vm.device.VirtualController)}
 
     # Loop through the devices once
-    try:
-        for device in virtual_machine.config.hardware.device:
-            # Check for Floppy
-            hasfloppy = False
-            if isinstance(device, vim.VirtualFloppy):
-                hasfloppy = True
-
-            # Count kinds of disks
-            thin_provisioned_count = 0
-            flat_disk_count = 0
-            raw_virtual_count = 0
-            raw_physical_count = 0
-            if isinstance(device, vim.vm.device.VirtualDisk):
-                try:
-                    if device.backing and device.backing.thinProvisioned:
-                        thin_provisioned_count += 1
-                except AttributeError:
-                    pass
+    for device in devices:
+        # Check for Floppy
+        if isinstance(device, vim.VirtualFloppy):
+            hasfloppy = True
+
+        # Count SCSI Controllers
+        elif isinstance(device, vim.vm.device.VirtualSCSIController):
+            scsi_controller_count += 1
+
+        # Count kinds of disks, and how much is thin provisioned
+        elif isinstance(device, vim.vm.device.VirtualDisk):
+            disk = get_vm_disk(device, controllers)
+            disk.vm_moref = vm_moref
+            disk.vcenter = vcenter
+            disks.append(disk)
+            if disk.thinprovisioned:
+                thin_provisioned_count += 1
+                thin_provisioned_gb += disk.capacitygb
+            if disk.compatibilitymode == "virtualMode":
+                raw_virtual_count += 1
+            elif disk.compatibilitymode == "physicalMode":
+                raw_physical_count += 1
+            elif isinstance(device.backing, vim.vm.device.VirtualDisk.FlatVer2BackingInfo):
+                flat_disk_count += 1
+
+        elif isinstance(device, vim.vm.device.VirtualEthernetCard):
+            nic = get_vm_nic(device, topology or {})
+            nic.vm_moref = vm_moref
+            nic.vcenter = vcenter
+            nics.append(nic)
+
+    return hasfloppy, thin_provisioned_count, round(thin_provisioned_gb), flat_disk_count, raw_virtual_count, raw_physical_count, scsi_controller_count, disks, nics
+
+# A function to return a device's label, like "Hard disk 1", or its type if it doesn't have one
+def get_device_label(device) -> str:
+    if device.deviceInfo and device.deviceInfo.label:
+        return device.deviceInfo.label
+    return device._wsdlName
+
+# A function to make a VMDisk from a VirtualDisk device
+# The datastore comes from the file name, like "[datastore1] vm/vm.vmdk", so it needs no extra lookup
+def get_vm_disk(device, controllers: dict) -> VMDisk:
+    backing = device.backing
+    capacity = device.capacityInBytes or (device.capacityInKB or 0) * 1024
+    file_name = getattr(backing, "fileName", None) or ""
+    datastore = re.match(r"\[(.*?)\]", file_name)
+    return VMDisk(
+        device_key          = device.key,
+        label               = get_device_label(device),
+        capacitygb          = round(capacity / (1024 * 1024 * 1024), 2),
+        # VirtualDiskFlatVer2BackingInfo becomes FlatVer2
+        backing             = backing._wsdlName.removeprefix("VirtualDisk").removesuffix("BackingInfo") if backing else "",
+        diskmode            = getattr(backing, "diskMode", None) or "",
+        compatibilitymode   = getattr(backing, "compatibilityMode", None) or "",
+        thinprovisioned     = bool(getattr(backing, "thinProvisioned", False)),
+        datastore           = datastore.group(1) if datastore else "",
+        filename            = file_name,
+        controller          = controllers.get(device.controllerKey, ""),
+        unitnumber          = device.unitNumber or 0,
+    )
 
-                try:
-                    if device.backing and device.backing.compatibilityMode:
-                        if device.backing.compatibilityMode == "virtualMode":
-                            raw_virtual_count += 1
-                        elif device.backing.compatibilityMode == "physicalMode":
-                            raw_physical_count += 1
-                        else:
-                            flat_disk_count += 1
-                except AttributeError:
-                    pass
-            # Count SCSI Controllers
-            scsi_controller_count = 0
-            if isinstance(device, vim.vm.device.VirtualSCSIController):
-                scsi_controller_count += 1
-    except AttributeError:
-        hasfloppy = False
-        thin_provisioned_count = 0
-        flat_disk_count = 0
-        raw_virtual_count = 0
-        raw_physical_count = 0
-        scsi_controller_count = 0
-    return hasfloppy, thin_provisioned_count, flat_disk_count, raw_virtual_count, raw_physical_count, scsi_controller_count
+# A function to make a VMNic from a VirtualEthernetCard device
+# Distributed port groups are named from the topology index, standard networks carry their name in the backing
+def get_vm_nic(device, topology: dict) -> VMNic:
+    from pyVmomi import vim
+    backing = device.backing
+    network = ""
+    if isinstance(backing, vim.vm.device.VirtualEthernetCard.NetworkBackingInfo):
+        network = backing.deviceName or ""
+    elif isinstance(backing, vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo) and backing.port:
+        portgroup = backing.port.portgroupKey or ""
+        network = topology.get(portgroup, (None, portgroup, None))[1]
+    elif isinstance(backing, vim.vm.device.VirtualEthernetCard.OpaqueNetworkBackingInfo):
+        network = backing.opaqueNetworkId or ""
+    connectable = device.connectable
+    return VMNic(
+        device_key      = device.key,
+        label           = get_device_label(device),
+        nictype         = device._wsdlName,
+        network         = network,
+        macaddress      = device.macAddress or "",
+        connected       = bool(connectable and connectable.connected),
+        startconnected  = bool(connectable and connectable.startConnected),
+    )
 
 
 # A function to pull the uuid-style path of the datastore path
@@ -273,241 +647,1366 @@ def get_vm_path_name(path: str) -> str:
 
 
 
-# A function to create a database model for use by SQLAlchemy
-def create_vm_model_class(Base, vm_dataclass: VM):
-
-    # Create a dictionary of column definitions
-    columns = {
-        field.name: Column(
-            String if field.type == str else
-            Integer if field.type == int else
-            Boolean if field.type == bool else String,
-            default=field.default,
-            primary_key=True if field.name == 'vm_uuid' else False,  # Add a primary key for 'vm_uuid' field
-
-        )
-        for field in fields(vm_dataclass)
-    }
-
-    # Create the VMModel Class
-    VMModel = type('VMModel', (Base,), {'__tablename__': 'vme_watchman_properties', **columns})
-
-    return VMModel
-
+# A function to fetch a chunk of VMs from vCenter and turn them into VM objects
+# vm_refs is a list of (moref id, uuid) pairs from discovery
+# paths is what to fetch for each VM, from the run's property profile
+def collect_vm_chunk(si: "vim.ServiceInstance", vm_refs: list, topology: dict, attribute_keys: dict, vcenter: str, paths=VM_PROPERTY_PATHS) -> list:
+    # Turn the moref ids back into VMs on our connection, no searching needed
+    vms = [get_vm_by_moid(moid, si) for moid, uuid in vm_refs]
+
+    # Fetch everything we need about these VMs in bulk
+    # A VM that was removed or re-registered since discovery is left out.  A re-registered VM has a new moref,
+    # so it's a new row on the next run, and its old row is deleted then.
+    with metrics.timer("fetch", vcenter):
+        vm_props = get_vm_properties(si, vms, paths)
+
+    return build_vm_objs(si, vm_props, topology, attribute_keys, vcenter)
+
+# A function to turn fetched VM properties, keyed by moref, into VM objects
+# Fills in any hosts or folders that are newer than the topology index first
+def build_vm_objs(si: "vim.ServiceInstance", vm_props: dict, topology: dict, attribute_keys: dict, vcenter: str) -> list:
+    with metrics.timer("build", vcenter):
+        update_vm_topology(si, topology, vm_props.values())
+        return [create_vm_obj(props, topology, attribute_keys, vcenter, moid) for moid, props in vm_props.items()]
+
+# A function to stream every VM in a container view as batches of VM objects
+# Properties are paged with RetrievePropertiesEx/ContinueRetrievePropertiesEx, batch_size VMs per page,
+# and each page is turned into records before the next one is asked for, so memory doesn't grow with the inventory
+def stream_vm_batches(si: "vim.ServiceInstance", container_view: "vim.view.ContainerView", topology: dict, attribute_keys: dict, vcenter: str, batch_size: int, paths=VM_PROPERTY_PATHS):
+    from pyVmomi import vim, vmodl
+    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=list(paths))
+    vm_props = {}
+    # Fetch time is counted from here to each full page, leaving out the time spent waiting on the writer
+    fetch_start = time.perf_counter()
+    for obj_content in retrieve_properties(si, [get_view_object_spec(container_view)], [property_spec], page_size=batch_size):
+        # A VM deleted while we were paging is left out
+        if is_missing_object(obj_content):
+            continue
+        vm_props[obj_content.obj._moId] = get_properties(obj_content)
+        if len(vm_props) >= batch_size:
+            metrics.inc("vmproperties_phase_seconds", time.perf_counter() - fetch_start, phase="fetch", vcenter=vcenter)
+            yield build_vm_objs(si, vm_props, topology, attribute_keys, vcenter)
+            vm_props = {}
+            fetch_start = time.perf_counter()
+    metrics.inc("vmproperties_phase_seconds", time.perf_counter() - fetch_start, phase="fetch", vcenter=vcenter)
+    if vm_props:
+        yield build_vm_objs(si, vm_props, topology, attribute_keys, vcenter)
+
+# A function to return the errors that mean vCenter is struggling, so the scheduler should back off and retry the chunk
+def get_vcenter_faults() -> tuple:
+    from pyVmomi import vmodl
+    return (vmodl.MethodFault, http.client.HTTPException, OSError)
+
+# A function to collect a chunk of VMs and write them to the database, or hand them to the writer process if there is one
+# args is a worker id, a list of (moref id, uuid) pairs from discovery and the stored digests of those VMs
+# Returns this process's session counters, the write counts, the chunk's metrics, how long the vCenter calls took,
+# and the fault if vCenter failed the chunk, in which case nothing was written.  The writer process counts its own writes.
 def process_vm_data(args):
-    worker_id, uuids = args
+    global worker_setup
+    worker_id, vm_refs, digests = args
     # Env vars
     vcenter     = os.environ.get('VCENTER')
     user        = os.environ.get('VSPHERE_USER')
     password    = os.environ.get('VSPHERE_PASSWORD')
 
-    # Connect to vCenter using vme_function
-    si = connect_vcenter(vcenter=vcenter, username=user, password=password)
+    # The topology index and custom attribute keys come once, with this process's first chunk
+    # The tables were made before they were handed out, so this process doesn't check them again
+    if worker_setup is not None:
+        topology, attribute_keys = worker_setup.get()
+        worker_topology.update(topology)
+        worker_attribute_keys.update(attribute_keys)
+        mark_tables_ready()
+        worker_setup = None
+
+    # Get this process's vCenter session, only the first chunk in each process logs in
+    si, content = get_service_instance(vcenter=vcenter, username=user, password=password)
+
+    # Wait for one of the run's vCenter request slots, then fetch the whole chunk
+    try:
+        with worker_request_slots:
+            fetch_start = time.perf_counter()
+            vm_objs = collect_vm_chunk(si, vm_refs, worker_topology, worker_attribute_keys, vcenter, worker_profile.paths)
+            fetch_seconds = time.perf_counter() - fetch_start
+    except get_vcenter_faults() as error:
+        logging.warning(f"# {vcenter} # Worker {worker_id} got a vCenter fault for {len(vm_refs)} VMs: {error}")
+        return os.getpid(), dict(session_stats), Counter(), metrics.collect(), None, str(error)
+
+    # With a writer process, the digests are still checked here and Parquet files written from here,
+    # and only the rows that need writing go to the writer
+    if worker_write_queue is not None:
+        with metrics.timer("write", vcenter):
+            write_to_sinks(worker_sinks, vm_objs, digests)
+            counts, rows = get_database_rows(vm_objs, digests, worker_profile)
+        with metrics.timer("queue", vcenter):
+            send_to_writer(vm_refs, counts, rows)
+        return os.getpid(), dict(session_stats), Counter(), metrics.collect(), fetch_seconds, None
 
-    # Custom Fields Manager to be used later
-    content = si.RetrieveContent()
-    cfm = content.customFieldsManager
-
-    # Empty list of VM objects
-    vms = []
-    # Multithread finding each VM by UUID
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(get_vm_by_uuid, uuid, si) for uuid in uuids]
-        concurrent.futures.wait(futures)
-        for future in futures:
-            vm = future.result()
-            vms.append(vm)
-
-     # Connect to the database and get the VMModel and db session       
-    logging.debug(f"# {vcenter} # Worker {worker_id} connecting to database")
-    VMModel, session, engine = connect_database()
-    i = 0
     timer = time.perf_counter()
-    # For each VM, create a VM Object and insert it into the db
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures2 = [executor.submit(create_vm_obj, vm, cfm) for vm in vms]
-        concurrent.futures.wait(futures2)
-        for future2 in futures2:
-            vm_obj = future2.result()
-            vm_model = VMModel(**vars(vm_obj))
-            session.merge(vm_model)
-            i+=1
-
-    # Commit DB changes and disconnect                
-    session.commit()
-    engine.dispose()
-    logging.debug(f"# {vcenter} # Worker {worker_id} disconnected from database")
+    # Write the new and changed ones to the db in one go
+    logging.debug(f"# {vcenter} # Worker {worker_id} writing to database")
+    with metrics.timer("write", vcenter):
+        counts = write_to_sinks(worker_sinks, vm_objs, digests)
     timer2 = time.perf_counter()
     batchtime  = timer2 - timer
-    logging.debug(f"# {vcenter} # Worker {worker_id} processed {i} VMs in {batchtime:.2f} seconds")
+    logging.debug(f"# {vcenter} # Worker {worker_id} processed {len(vm_objs)} VMs in {batchtime:.2f} seconds, {counts['unchanged']} unchanged")
+
+    # The vCenter session stays open for the next chunk, it is logged out when the process exits
+    # Hand back this process's session counters, the write counts and the metrics for this chunk so main() can add them up
+    return os.getpid(), dict(session_stats), counts, metrics.collect(), fetch_seconds, None
+
+# The topology index and custom attribute keys main() looked up, handed to each worker process once when the pool starts
+worker_topology = {}
+worker_attribute_keys = {}
+# Shared by every worker so only VCENTER_MAX_REQUESTS chunks are fetching from vCenter at once
+worker_request_slots = contextlib.nullcontext()
+# Where each worker writes its chunks, and what it collects, set up when the pool starts
+worker_sinks = []
+worker_profile = None
+# Where the worker picks up the topology index and custom attribute keys, on its first chunk
+worker_setup = None
+# Where the worker puts its chunks for the writer process, and set if the writer has died, when main() runs one
+worker_write_queue = None
+worker_writer_stopped = None
+
+# A function to put a chunk's rows from get_database_rows on the writer process's queue, waiting while it's full
+# Gives up if main() finds the writer has died, since nothing would ever take them off
+def send_to_writer(vm_refs: list, counts: Counter, rows: dict):
+    item = ("chunk", [moid for moid, uuid in vm_refs], counts, rows)
+    while True:
+        try:
+            worker_write_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            if worker_writer_stopped.is_set():
+                raise RuntimeError("The database writer stopped")
+
+# A function for a worker to drop chunks it couldn't hand over when it exits, if the writer has died
+# Otherwise the process would wait forever for the writer to take them
+def abandon_writes():
+    if worker_writer_stopped.is_set():
+        worker_write_queue.cancel_join_thread()
+
+# Runs once in each worker process when the pool starts, which main() does before discovery
+# Takes a clone ticket so the worker can share main()'s login instead of doing its own, then logs in with it while
+# main() is still busy.  setup_queue gets the topology index and custom attribute
+# keys once discovery is done, so nothing has to be looked up per VM.
+# With write_queue the worker hands its rows to a writer process and never connects to the database itself.
+def init_worker(ticket_queue, setup_queue, request_slots=None, profile=None, write_queue=None, writer_stopped=None):
+    global worker_request_slots, worker_profile, worker_setup, worker_write_queue, worker_writer_stopped
+    # Start from zero, not from a copy of the parent's metrics
+    metrics.reset()
+    # A forked worker has its parent's logging already, any other kind starts without it
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "DEBUG"), format=LOG_FORMAT, handlers=[logging.StreamHandler(sys.stdout)])
+    worker_setup = setup_queue
+    if request_slots is not None:
+        worker_request_slots = request_slots
+    # Each worker writes its own Parquet files, finished off when the process exits like its vCenter session
+    worker_profile = profile or get_property_profile("full")
+    worker_sinks[:] = get_sinks(worker_profile, database=write_queue is None)
+    multiprocessing.util.Finalize(None, close_sinks, args=(worker_sinks,), exitpriority=10)
+    worker_write_queue = write_queue
+    worker_writer_stopped = writer_stopped
+    if write_queue is not None:
+        multiprocessing.util.Finalize(None, abandon_writes, exitpriority=10)
+    try:
+        set_clone_ticket(ticket_queue.get(timeout=5))
+    except queue.Empty:
+        pass
+
+    # If either of these fails, the first chunk tries again and reports it
+    try:
+        get_service_instance(vcenter=os.environ.get('VCENTER'), username=os.environ.get('VSPHERE_USER'), password=os.environ.get('VSPHERE_PASSWORD'))
+        if write_queue is None:
+            with get_engine().connect():
+                pass
+    except Exception as error:
+        logging.warning(f"# {os.environ.get('VCENTER')} # Worker {os.getpid()} couldn't warm up: {error}")
+
+# The writer process main() runs, the only one that writes a run's VMs to the database
+# Workers put the rows of each chunk they collect on write_queue, which holds at most WRITER_QUEUE_DEPTH chunks, so
+# collection waits for the database instead of piling up in memory.  The writer gathers chunks until they cover
+# WRITER_BATCH_SIZE VMs or the oldest has waited WRITER_FLUSH_SECONDS, and writes them in one transaction.
+# Each batch's chunks are recorded as done against the run once they're committed, so --resume picks up from there.
+class DatabaseWriter():
+    def __init__(self, context, vcenter: str, profile: PropertyProfile):
+        self.vcenter = vcenter
+        self.write_queue = context.Queue(maxsize=int(os.environ.get('WRITER_QUEUE_DEPTH', 8)))
+        self.setup_queue = context.Queue()
+        self.result_queue = context.Queue()
+        self.stopped = context.Event()
+        # The chunks and VMs handed to the writer so far, counted by schedule_chunks
+        self.chunks = 0
+        self.vms = 0
+        self.process = context.Process(
+            target=run_writer, name="database-writer", daemon=True,
+            args=(
+                self.setup_queue, self.write_queue, self.result_queue, vcenter, profile,
+                int(os.environ.get('WRITER_BATCH_SIZE', 2000)), float(os.environ.get('WRITER_FLUSH_SECONDS', 0.5)), PROCESS_START,
+            ),
+        )
 
-    # Disconnect the vCenter session we created.  I don't think atexit worked for these processes
-    Disconnect(si)
-    logging.debug(f"# {vcenter} # Worker {worker_id} disconnected from vCenter")
+    # Started before discovery, so it connects to the database in the meantime
+    def start(self):
+        self.process.start()
+
+    # A function to put a message on the writer's queue, waiting while it's full
+    # Returns False if the writer has died, since nothing would ever take it off
+    def send(self, message) -> bool:
+        while self.check():
+            try:
+                self.write_queue.put(message, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # A function to wait for the writer's answer, or None if it exits first
+    def receive(self):
+        while True:
+            alive = self.process.is_alive()
+            try:
+                return self.result_queue.get(timeout=1)
+            except queue.Empty:
+                if not alive:
+                    logger.error(f"# {self.vcenter} # The database writer exited with code {self.process.exitcode}")
+                    self.check()
+                    return None
+
+    # A function to have the writer start the run once discovery has found the VMs
+    # Returns the run ID, the stored digest of every VM and the morefs a resumed run already committed
+    def begin(self, vm_refs: list, resume: bool = False) -> tuple:
+        self.setup_queue.put((vm_refs, resume))
+        started = self.receive()
+        if started is None:
+            raise RuntimeError("The database writer exited before the run started")
+        return started
+
+    # A function to record a chunk against the run, passed to schedule_chunks for the ones main() gives up on
+    # It goes through the writer so it's in line with the batches it commits
+    def record(self, ref_chunk: list, status: str):
+        self.send(("batch", status, [moid for moid, uuid in ref_chunk]))
+
+    # A function to check the writer is still running, and tell the workers to stop waiting on it if not
+    def check(self) -> bool:
+        if self.process.is_alive():
+            return True
+        self.stopped.set()
+        self.write_queue.cancel_join_thread()
+        return False
+
+    # A function to wait for the writer to write everything it was handed, then finish the run
+    # moref_list is every VM the vCenter has now, and lost is how many of them main() couldn't collect.
+    # Returns the write counts and how many VMs weren't written altogether
+    def finish(self, moref_list: list, lost: int) -> tuple:
+        # Tell it how many chunks it was handed, so it knows when it has them all
+        self.send(("finish", self.chunks, moref_list, lost))
+        result = self.receive()
+        if result is None:
+            return Counter(), lost + self.vms
+        counts, lost, writer_metrics = result
+        self.process.join()
+        metrics.merge(writer_metrics)
+        return counts, lost
+
+# The writer process, see DatabaseWriter.  It holds the run's only database connection.
+# Makes the tables during discovery, then starts the run when main() puts the VMs on setup_queue and hands back
+# their digests.  Reads ("chunk", morefs, counts, rows) and ("batch", status, morefs) off write_queue until main()
+# puts ("finish", chunks, moref_list, lost) and it has had that many chunks, then deletes the VMs that are gone and
+# finishes the run.  Puts its write counts, how many VMs weren't written and its metrics on result_queue.
+def run_writer(setup_queue, write_queue, result_queue, vcenter: str, profile: PropertyProfile, batch_size: int, flush_seconds: float, process_start: float):
+    global PROCESS_START
+    # The first write is timed from when main() started, not this process
+    PROCESS_START = process_start
+    metrics.reset()
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "DEBUG"), format=LOG_FORMAT, handlers=[logging.StreamHandler(sys.stdout)])
+    # The tables are made while main() is still waiting on vCenter
+    prepare_database()
+    engine = get_engine()
+
+    vm_refs, resume = setup_queue.get()
+    adopt_legacy_rows(None, None, vcenter, vm_refs)
+    digests = load_vm_digests(vcenter)
+    logger.info(f"# {vcenter} # Loaded {len(digests)} stored row digests")
+    run_id, done_morefs = open_run(engine, vcenter, resume)
+    result_queue.put((run_id, digests, done_morefs))
+    del vm_refs, digests, done_morefs
+
+    counts = Counter(inserted=0, updated=0, unchanged=0)
+    lost = 0
+    errors = []
+    batch_counts = Counter()
+    batch_rows = {}
+    batch_morefs = []
+    received = 0
+    expected = None
+    moref_list = []
+    deadline = None
+    first_written = False
+
+    def flush():
+        nonlocal batch_counts, batch_rows, batch_morefs, lost, first_written
+        if not batch_morefs:
+            return
+        if errors:
+            # Keep draining so the workers don't block, there's no point writing more
+            lost += len(batch_morefs)
+        else:
+            try:
+                with metrics.timer("write", vcenter):
+                    counts.update(write_rows_to_database(batch_counts, batch_rows, profile))
+                record_run_batch(engine, run_id, "done", batch_morefs)
+                if not first_written:
+                    record_first_write(vcenter, len(batch_morefs))
+                    first_written = True
+                logging.debug(f"# {vcenter} # Wrote {len(batch_rows)} of {len(batch_morefs)} VMs in one batch")
+            except Exception as error:
+                logger.error(f"# {vcenter} # Database write failed: {error}")
+                errors.append(error)
+                lost += len(batch_morefs)
+        batch_counts = Counter()
+        batch_rows = {}
+        batch_morefs = []
+
+    while expected is None or received < expected:
+        timeout = None if deadline is None else max(0, deadline - time.perf_counter())
+        try:
+            item = write_queue.get(timeout=timeout)
+        except queue.Empty:
+            flush()
+            deadline = None
+            continue
+        # main() puts how many chunks it handed out once they're all collected
+        if item[0] == "finish":
+            kind, expected, moref_list, collection_lost = item
+            lost += collection_lost
+            continue
+        if item[0] == "batch":
+            kind, status, morefs = item
+            try:
+                record_run_batch(engine, run_id, status, morefs)
+            except Exception as error:
+                logger.error(f"# {vcenter} # Couldn't record {len(morefs)} VMs as {status}: {error}")
+                errors.append(error)
+            continue
+        received += 1
+        kind, morefs, chunk_counts, rows = item
+        batch_morefs.extend(morefs)
+        batch_counts.update(chunk_counts)
+        batch_rows.update(rows)
+        if deadline is None:
+            deadline = time.perf_counter() + flush_seconds
+        # The first chunk is written straight away, so the first VMs don't wait on the rest of a batch
+        if len(batch_morefs) >= batch_size or not first_written:
+            flush()
+            deadline = None
+    flush()
+
+    # Delete VMs that no longer exist from database, but only once every VM of the run has been committed
+    # A run with lost chunks is left as failed, and --resume retries just those
+    if lost:
+        logger.error(f"# {vcenter} # Not deleting stale VMs because {lost} VMs couldn't be collected or written, run {run_id} can be resumed")
+        try:
+            finish_run(engine, run_id, "failed", len(moref_list))
+        except Exception as error:
+            logger.error(f"# {vcenter} # Couldn't mark run {run_id} as failed: {error}")
+    else:
+        logger.debug(f"# {vcenter} # Deleting VMs from database")
+        counts["deleted"] = delete_vms_from_database(moref_list, vcenter)
+        finish_run(engine, run_id, "complete", len(moref_list))
+        prune_history(vcenter)
+    result_queue.put((counts, lost, metrics.collect()))
+
+# A function to start a run for a vCenter, or with resume pick up its last one that didn't finish
+# Returns the run ID and the morefs that run already committed
+def open_run(engine, vcenter: str, resume: bool = False) -> tuple:
+    run_id = find_unfinished_run(engine, vcenter) if resume else None
+    done_morefs = set()
+    if run_id:
+        # VMs are matched by moref, the same key their rows have
+        done_morefs = load_run_done_keys(engine, run_id)
+        logger.info(f"# {vcenter} # Resuming run {run_id}, {len(done_morefs)} VMs already committed")
+    else:
+        if resume:
+            logger.info(f"# {vcenter} # No unfinished run to resume, starting a new one")
+        run_id = uuid.uuid4().hex
+        logger.info(f"# {vcenter} # Starting run {run_id}")
+    start_run(engine, run_id, vcenter)
+    return run_id, done_morefs
+
+# A function to pick how worker processes are started, from WORKER_START_METHOD
+# fork is quickest, and the workers start with everything this process has imported.  forkserver starts them
+# from a server process that imported the collector, pyVmomi and SQLAlchemy once, without this one's connections.
+def get_worker_context():
+    start_method = os.environ.get('WORKER_START_METHOD', 'fork')
+    context = multiprocessing.get_context(start_method)
+    if start_method == "forkserver":
+        context.set_forkserver_preload(["__main__", "pyVmomi", "pyVim.connect", "sqlalchemy.orm", "psycopg2"])
+    return context
+
+# A function to start every worker process now, instead of when the first chunk goes out
+# With fork they all start on the first submit.  Other start methods start one per submit while none are idle,
+# and these return straight away, so none are idle yet.
+def start_workers(executor, count: int):
+    for i in range(count):
+        executor.submit(os.getpid)
+
+# A function to create the tables a run writes to, if they don't exist yet
+# The writer process runs this during discovery, since importing SQLAlchemy and the DDL take a while
+def prepare_database():
+    prepare_vm_tables()
+    prepare_history_table()
+    create_run_tables(get_engine())
     
     
-# Return a database model and session
-def connect_database():
-        # Environmental variables
-        db_user     = os.environ.get('DB_USER')
-        db_password = os.environ.get('DB_PASSWORD')
-        db_host     = os.environ.get('DB_HOST')
-        db_port     = os.environ.get('DB_PORT')
-        db_name     = os.environ.get('DB_NAME')
-
-        # Encode the password
-        encoded_password = urllib.parse.quote(db_password, safe='')
-
-        # Construct the connection URL 
-        connection_url = f'postgresql://{db_user}:{encoded_password}@{db_host}:{db_port}/{db_name}'
-
-        # Create the SQLAlchemy engine
-        engine = create_engine(connection_url)
-
-        # Create a SQLAlchemy base class
-        Base = declarative_base()
-
-        # Create a session
-        Session = sessionmaker(bind=engine)
-        session = Session()
-
-        # Create a metadata object
-        # This doesn't seem to be used, but maybe it's required?
-        metadata = MetaData()
-
-        # Create the dynamic VMModel class
-        VMModel = create_vm_model_class(Base, VM)
-
-        return VMModel, session, engine
-
-
-def delete_vms_from_database(uuid_list):
-        
-        # Environmental variables
-        db_user     = os.environ.get('DB_USER')
-        db_password = os.environ.get('DB_PASSWORD')
-        db_host     = os.environ.get('DB_HOST')
-        db_port     = os.environ.get('DB_PORT')
-        db_name     = os.environ.get('DB_NAME')
-        vcenter     = os.environ.get('VCENTER')
+# Delete VMs from the DB that no longer exist
+# DELETE_MAX_FRACTION guards against wiping rows when the collection came back short
+# moref_list is the moref of every VM the vCenter has now.  Returns how many VMs were deleted
+def delete_vms_from_database(moref_list, vcenter: str = None) -> int:
+        vcenter         = vcenter or os.environ.get('VCENTER')
+        max_fraction    = float(os.environ.get('DELETE_MAX_FRACTION', 0.5))
 
         logger.debug(f"# {vcenter} # Connecting to database to delete rows")
 
-        # Encode the password
-        encoded_password = urllib.parse.quote(db_password, safe='')
-
-        # Construct the connection URL 
-        connection_url = f'postgresql://{db_user}:{encoded_password}@{db_host}:{db_port}/{db_name}'
+        # Make sure the tables exist before the first delete
+        prepare_vm_tables()
+        with metrics.timer("delete", vcenter):
+            deleted = delete_missing_rows(get_engine(), VM_TABLE, "vm_moref", vcenter, moref_list, max_fraction, rollup=True)
+        if deleted is None:
+            return 0
+        logger.info(f"# {vcenter} # Deleted {len(deleted)} VMs from the database")
+        return len(deleted)
+
+# A function to make sure the history table and this month's partitions exist, once per process
+# Runs before the worker pool starts, so workers don't all try to create the partitions at once
+def prepare_history_table():
+    global _history_ready
+    with _history_lock:
+        if HISTORY_COLUMNS and not _history_ready:
+            create_history_table(get_engine(), HISTORY_TABLE, list(VM_KEY_COLUMNS))
+            ensure_history_partitions(get_engine(), HISTORY_TABLE)
+            _history_ready = True
+
+# A function to drop history older than HISTORY_RETENTION_DAYS, a month's partition at a time
+def prune_history(vcenter: str):
+    if not HISTORY_COLUMNS:
+        return
+    for partition in drop_history_partitions(get_engine(), HISTORY_TABLE, HISTORY_RETENTION_DAYS):
+        logger.info(f"# {vcenter} # Dropped history partition {partition}, older than {HISTORY_RETENTION_DAYS} days")
+
+# A function to return a VM's row as it was at a point in time, from its current row and its history
+def get_vm_at(vcenter: str, vm_moref: str, at) -> dict:
+    return load_row_at(get_engine(), VM_TABLE, HISTORY_TABLE, {"vcenter": vcenter, "vm_moref": vm_moref}, at)
+
+# A function to make sure the VM, disk, NIC and rollup tables exist, once per process
+def prepare_vm_tables():
+    global _tables_ready
+    if not _tables_ready:
+        get_vm_model(VM, EXTRA_COLUMNS)
+        get_vm_model(VMDisk, table=DISK_TABLE, key_columns=VM_KEY_COLUMNS + ("device_key",))
+        get_vm_model(VMNic, table=NIC_TABLE, key_columns=VM_KEY_COLUMNS + ("device_key",))
+        create_rollup_tables(get_engine(), VM_TABLE)
+        _tables_ready = True
+
+# A function for a worker to skip making sure the tables exist, when its parent already has
+def mark_tables_ready():
+    global _tables_ready, _history_ready
+    _tables_ready = _history_ready = True
+
+# A function to load the stored digest of every VM row for a vCenter, as moref -> digest
+def load_vm_digests(vcenter: str) -> dict:
+    # Make sure the tables and digest column exist before the first read
+    prepare_vm_tables()
+    prepare_history_table()
+    return load_row_digests(get_engine(), VM_TABLE, "vm_moref", DIGEST_COLUMN, vcenter)
+
+# A function to hand rows from before VMs were keyed on moref to the VMs they belong to, so they're updated in place
+# vm_refs is (moref id, uuid) pairs from discovery, they're looked up here if there are old rows and none were given.
+# Only the first run after upgrading finds anything to do.
+def adopt_legacy_rows(si: "vim.ServiceInstance", container_view: "vim.view.ContainerView", vcenter: str, vm_refs: list = None):
+    prepare_vm_tables()
+    if not has_legacy_rows(get_engine(), VM_TABLE, vcenter):
+        return
+    if vm_refs is None:
+        vm_refs = list(get_vm_uuid_map(si, container_view).items())
+    claimed = claim_legacy_rows(get_engine(), VM_TABLE, vcenter, vm_refs)
+    logger.info(f"# {vcenter} # Matched {claimed} rows from before the moref key to their VMs by UUID")
 
-        # Create the SQLAlchemy engine
-        engine = create_engine(connection_url)
 
-        # Create a SQLAlchemy base class
-        Base = declarative_base()
+# resume picks up the last run for this vCenter that didn't finish, and only collects the VMs it hadn't committed yet
+# profile names the property profile to collect, otherwise PROPERTY_PROFILE decides
+# collect_stats adds performance stats for every VM once the collection is complete
+def main(resume: bool = False, profile: str = None, collect_stats: bool = False):
+    start_time = time.perf_counter()
+    # Environmental vars
+    vcenter     = os.environ.get('VCENTER')
+    user        = os.environ.get('VSPHERE_USER')
+    password    = os.environ.get('VSPHERE_PASSWORD')
 
-        # Create a session
-        Session = sessionmaker(bind=engine)
-        session = Session()
+    max_workers = int(os.environ.get('MAX_WORKERS', os.cpu_count()))
+    max_requests = int(os.environ.get('VCENTER_MAX_REQUESTS', 4))
+    profile     = get_vcenter_profile(vcenter, profile)
+    logger.info(f"# {vcenter} # Collecting the {profile.name} profile, {len(profile.paths)} properties per VM")
 
-        # Create a metadata object
-        # This doesn't seem to be used, but maybe it's required?
-        metadata = MetaData()
+    # Start the database writer first, so it makes the tables while we import pyVmomi and log in
+    context = get_worker_context()
+    writer = DatabaseWriter(context, vcenter, profile)
+    writer.start()
 
-        # Create the dynamic VMModel class
-        VMModel = create_vm_model_class(Base, VM)
+    # Connect to vCenter using vme_function
+    si, content = get_service_instance(vcenter=vcenter, username=user, password=password)
+
+    # Start the workers before discovery, so they log in in the meantime
+    # Give each worker a ticket to clone our session, so the whole run costs one login
+    ticket_queue = context.Queue()
+    for ticket in acquire_clone_tickets(si, max_workers):
+        ticket_queue.put(ticket)
+    # One copy of the topology index and custom attribute keys per worker, put there once discovery is done
+    # A worker that never gets a chunk never takes its copy, so don't wait for them to be read at exit
+    setup_queue = context.Queue()
+    setup_queue.cancel_join_thread()
 
-        # Delete VMs from the DB that no longer exist
-        # Fetch all records from the VM table for the target vCenter
-        db_vms_to_delete = session.query(VMModel).filter_by(vcenter=vcenter).all()
+    # Use concurrent.futures.ProcessPoolExecutor instead of multiprocessing.pool.map
+    # Each worker process keeps its vCenter session for every chunk it handles
+    request_slots = context.BoundedSemaphore(max_requests)
+    # The workers only talk to vCenter, and put what they collect on the writer's queue
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=init_worker, initargs=(ticket_queue, setup_queue, request_slots, profile, writer.write_queue, writer.stopped)) as executor:
+        start_workers(executor, max_workers)
+
+        # The writer makes the database tables while discovery waits on vCenter
+        with metrics.timer("discovery", vcenter):
+            # Get a container view of all VMs
+            container_view = get_vm_container_view(si)
+
+            # Index the folders, datacenters, clusters and hosts once for the whole run
+            topology = get_topology(si)
+            logger.info(f"# {vcenter} # Indexed {len(topology)} folders, datacenters, clusters and hosts")
+
+            # Look up the custom attribute keys once for the whole run
+            attribute_keys = get_custom_attribute_keys(get_custom_field_keys(content.customFieldsManager))
+
+            # Get the moref and UUID of every VM
+            logger.debug(f"# {vcenter} # Gathering morefs")
+            vm_refs     = list(get_vm_uuid_map(si, container_view).items())
+        for i in range(max_workers):
+            setup_queue.put((topology, attribute_keys))
+        moref_list  = [moid for moid, uuid in vm_refs]
+        vm_count    = len(moref_list)
+        logger.info(f"# {vcenter} # Found {vm_count} VMs")
+        # Stats are collected for every VM, even ones a resumed run doesn't have to collect again
+        all_vm_refs = vm_refs
+
+        # The writer loads what every VM looked like when we last wrote it, in one query, and starts the run
+        # Every run gets an ID, and each chunk it commits is recorded against it
+        run_id, digests, done_morefs = writer.begin(vm_refs, resume)
+        if done_morefs:
+            vm_refs = [(moid, uuid) for moid, uuid in vm_refs if moid not in done_morefs]
+
+        # Chunks aren't split up front any more, schedule_chunks sizes each one as it goes out
+        scheduler = AdaptiveScheduler(
+            max_window      = max_workers,
+            batch_size      = int(os.environ.get('BATCH_SIZE', 50)),
+            max_batch       = int(os.environ.get('MAX_BATCH_SIZE', 500)),
+            target_seconds  = float(os.environ.get('BATCH_TARGET_SECONDS', 5)),
+        )
 
-        # Create a set of primary keys from the uuid list
-        vm_keys = {uuid for uuid in uuid_list}
+        '''
+        # Set the number of processes we will use
+        num_processes = 4
+        # Create a multiprocessing pool 
+        with multiprocessing.Pool(processes=num_processes) as pool:
+            # Use the pool to execute the process_vm_data function in parallel 
+            # The chunks of UUIDs should be automatically divided among the processes
+            pool.map(process_vm_data, worker_args)
+
+        # Close the pool 
+        pool.close()
+        pool.join()
+        '''
+
+        counts, worker_stats, lost = schedule_chunks(executor, scheduler, vm_refs, digests, vcenter, writer.record, writer)
+
+    # Wait for the writer to commit the last of them, delete the VMs that are gone and finish the run
+    writer_counts, lost = writer.finish(moref_list, lost)
+    counts.update(writer_counts)
+
+    # Add up how every process got its vCenter session
+    worker_stats[os.getpid()] = session_stats
+    totals = {key: sum(stats[key] for stats in worker_stats.values()) for key in session_stats}
+    logger.info(f"# {vcenter} # vCenter sessions: {totals['logins']} logins, {totals['clones']} cloned, reused {totals['reuses']} times")
+    logger.info(f"# {vcenter} # Scheduler: {scheduler.faults} vCenter faults, finished at {scheduler.batch_size} VMs per chunk")
+
+    # Stats are only worth collecting for a complete run, and the writer has closed its connection by now
+    if collect_stats and not lost:
+        collect_vm_stats(si, all_vm_refs, vcenter)
+    log_run_summary(vcenter, counts)
 
-        # Iterate over the database records for the target vCenter
-        i = 0
-        for db_vm in db_vms_to_delete:
-            if db_vm.vm_uuid not in vm_keys:
-                # If the primary key is not in vm_keys, delete the record
-                session.delete(db_vm)
-                i += 1
+    # Track the total time and some other stats
+    end_time = time.perf_counter()
+    elapsed_time = time.strftime("%H:%M:%S", time.gmtime(end_time - start_time))
+    logger.info(f"# {vcenter} # --- TOTAL duration: {elapsed_time} for {vm_count} VMs ---")
+    per_vm = (end_time - start_time) / vm_count
+    logger.info(f"# {vcenter} # --- {per_vm:.2f} Seconds per VM ---")
 
-        # Commit the changes
-        session.commit()
-        engine.dispose()
-        logger.info(f"# {vcenter} # Deleted {i} VMs from the database")
+    record_run_duration(vcenter, end_time - start_time)
+    metrics.export(vcenter)
 
+    return 0
 
-def main():
+# Collect every VM from one process with flat memory use
+# stream_vm_batches pages VMs out of vCenter while a writer thread puts each batch in the database.
+# The queue between them holds at most STREAM_QUEUE_DEPTH batches, so if the database falls behind
+# the next page isn't fetched until the writer catches up.
+def stream(profile: str = None):
     start_time = time.perf_counter()
     # Environmental vars
     vcenter     = os.environ.get('VCENTER')
     user        = os.environ.get('VSPHERE_USER')
     password    = os.environ.get('VSPHERE_PASSWORD')
+    batch_size  = int(os.environ.get('STREAM_BATCH_SIZE', 500))
+    queue_depth = int(os.environ.get('STREAM_QUEUE_DEPTH', 2))
+    profile     = get_vcenter_profile(vcenter, profile)
+
+    si, content = get_service_instance(vcenter=vcenter, username=user, password=password)
+    with metrics.timer("discovery", vcenter):
+        container_view = get_vm_container_view(si)
+        topology = get_topology(si)
+        attribute_keys = get_custom_attribute_keys(get_custom_field_keys(content.customFieldsManager))
+    adopt_legacy_rows(si, container_view, vcenter)
+    digests = load_vm_digests(vcenter)
+
+    write_queue = queue.Queue(maxsize=queue_depth)
+    counts = Counter(inserted=0, updated=0, unchanged=0)
+    errors = []
+    first_written = []
+    sinks = get_sinks(profile)
+
+    def writer():
+        while True:
+            vm_objs = write_queue.get()
+            if vm_objs is None:
+                return
+            if errors:
+                # Keep draining so the collector doesn't block, there's no point writing more
+                continue
+            try:
+                with metrics.timer("write", vcenter):
+                    counts.update(write_to_sinks(sinks, vm_objs, digests))
+                if not first_written:
+                    record_first_write(vcenter, len(vm_objs))
+                    first_written.append(True)
+            except Exception as error:
+                logger.error(f"# {vcenter} # Database write failed: {error}")
+                errors.append(error)
+
+    writer_thread = threading.Thread(target=writer, name="database-writer")
+    writer_thread.start()
+
+    # Only the morefs are kept for the whole run, for deleting stale rows at the end
+    moref_list = []
+    try:
+        for vm_objs in stream_vm_batches(si, container_view, topology, attribute_keys, vcenter, batch_size, profile.paths):
+            if errors:
+                break
+            moref_list.extend(vm_obj.vm_moref for vm_obj in vm_objs)
+            write_queue.put(vm_objs)
+    finally:
+        write_queue.put(None)
+        writer_thread.join()
+        close_sinks(sinks)
+
+    if errors:
+        logger.error(f"# {vcenter} # Not deleting stale VMs because the collection didn't finish")
+        return 1
+
+    counts["deleted"] = delete_vms_from_database(moref_list)
+    prune_history(vcenter)
+    log_run_summary(vcenter, counts)
+
+    elapsed_time = time.strftime("%H:%M:%S", time.gmtime(time.perf_counter() - start_time))
+    logger.info(f"# {vcenter} # --- TOTAL duration: {elapsed_time} for {len(moref_list)} VMs, peak memory {get_peak_memory_mb():.0f}MB ---")
+    record_run_duration(vcenter, time.perf_counter() - start_time)
+    metrics.export(vcenter)
+    return 0
 
-    # Connect to vCenter using vme_function
-    si = connect_vcenter(vcenter=vcenter, username=user, password=password)
+# A function to record how long after this process started the first VMs were written
+def record_first_write(vcenter: str, count: int):
+    seconds = time.perf_counter() - PROCESS_START
+    metrics.set_gauge("vmproperties_first_write_seconds", seconds, vcenter=vcenter)
+    logger.info(f"# {vcenter} # First {count} VMs written {seconds:.2f} seconds after start")
+
+# A function to record how long a run took and when it finished, for alerting on slow or missing runs
+def record_run_duration(vcenter: str, seconds: float):
+    metrics.set_gauge("vmproperties_last_run_duration_seconds", seconds, vcenter=vcenter)
+    metrics.set_gauge("vmproperties_last_run_timestamp_seconds", time.time(), vcenter=vcenter)
+
+# A function to return this process's peak resident memory in MB
+def get_peak_memory_mb() -> float:
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# A function to hand VMs out to the worker pool in chunks until every one is collected
+# Workers pull the next chunk as soon as they finish one, so a slow chunk only holds up its own worker.
+# The scheduler sets how big each chunk is and how many are out at once from how the last ones went.
+# A chunk vCenter faults on is split in half and retried, up to CHUNK_MAX_RETRIES times.
+# checkpoint, if given, is called with each chunk and "done" once it's written, or "failed" once it's given up on
+# With writer, the workers hand their chunks to that DatabaseWriter, which records them as done itself once they're written
+# Returns the write counts, each worker's session counters and how many VMs couldn't be collected
+def schedule_chunks(executor, scheduler: AdaptiveScheduler, vm_refs: list, digests: dict, vcenter: str, checkpoint=None, writer: DatabaseWriter = None) -> tuple:
+    max_retries = int(os.environ.get('CHUNK_MAX_RETRIES', 3))
+    pending = deque(vm_refs)
+    retries = deque()
+    in_flight = {}
+    worker_stats = {}
+    counts = Counter()
+    lost = 0
+    worker_id = 0
+    first_written = False
+
+    while pending or retries or in_flight:
+        # Send out chunks until the scheduler's window is full
+        while len(in_flight) < scheduler.window and (pending or retries):
+            if retries:
+                ref_chunk, attempt = retries.popleft()
+            else:
+                ref_chunk = [pending.popleft() for i in range(scheduler.next_batch(len(pending)))]
+                attempt = 0
+            chunk_digests = {moid: digests[moid] for moid, uuid in ref_chunk if moid in digests}
+            in_flight[executor.submit(process_vm_data, (worker_id, ref_chunk, chunk_digests))] = (ref_chunk, attempt)
+            worker_id += 1
+
+        # Keep an eye on the writer while waiting, workers can't hand anything over if it's gone
+        done, not_done = concurrent.futures.wait(in_flight, timeout=1 if writer else None, return_when=concurrent.futures.FIRST_COMPLETED)
+        if writer and not writer.check() and (pending or retries):
+            logger.error(f"# {vcenter} # The database writer stopped, not collecting the rest of the VMs")
+            lost += len(pending) + sum(len(ref_chunk) for ref_chunk, attempt in retries)
+            pending.clear()
+            retries.clear()
+        for future in done:
+            ref_chunk, attempt = in_flight.pop(future)
+            try:
+                pid, stats, chunk_counts, chunk_metrics, fetch_seconds, fault = future.result()
+            except Exception as error:
+                logger.error(f"# {vcenter} # A worker failed: {error}")
+                lost += len(ref_chunk)
+                if checkpoint:
+                    checkpoint(ref_chunk, "failed")
+                continue
+            worker_stats[pid] = stats
+            counts.update(chunk_counts)
+            metrics.merge(chunk_metrics)
+
+            if not fault:
+                scheduler.on_success(fetch_seconds)
+                if writer:
+                    writer.chunks += 1
+                    writer.vms += len(ref_chunk)
+                    continue
+                if not first_written:
+                    record_first_write(vcenter, len(ref_chunk))
+                    first_written = True
+                if checkpoint:
+                    checkpoint(ref_chunk, "done")
+                continue
+            scheduler.on_fault()
+            if attempt >= max_retries:
+                logger.error(f"# {vcenter} # Giving up on {len(ref_chunk)} VMs after {attempt + 1} tries: {fault}")
+                lost += len(ref_chunk)
+                if checkpoint:
+                    checkpoint(ref_chunk, "failed")
+                continue
+            # Smaller pieces are more likely to get through, and can go to different workers
+            half = max(1, len(ref_chunk) // 2)
+            for piece in (ref_chunk[:half], ref_chunk[half:]):
+                if piece:
+                    retries.append((piece, attempt + 1))
+
+    return counts, worker_stats, lost
+
+# A function to turn a VM object into a row in VM_COLUMNS order
+def vm_to_row(vm_obj: VM) -> tuple:
+    if not CUSTOM_COLUMNS:
+        return get_vm_field_values(vm_obj)
+    custom_attributes = vm_obj.custom_attributes
+    return get_vm_field_values(vm_obj) + tuple(custom_attributes.get(column, "") for column in CUSTOM_COLUMNS)
+
+# A function to return a function that turns a VM object into a row of just a profile's columns
+def get_profile_row(profile: PropertyProfile):
+    get_columns = operator.itemgetter(*(VM_COLUMNS.index(column) for column in profile.columns))
+    return lambda vm_obj: get_columns(vm_to_row(vm_obj))
+
+# A function to work out a stable digest of a row's values
+# Only str, int, float, bool, None and tuples of them go in a row, and their repr doesn't change between runs or processes
+def get_row_digest(row: tuple) -> str:
+    return hashlib.blake2b(repr(row).encode(), digest_size=16).hexdigest()
+
+# A function to write a list of VM objects to the database
+# digests is moref -> stored digest, for the vCenter the VMs came from.  VMs whose digest matches are skipped, the rest go in
+# with one COPY and one upsert, and digests is updated to match what was written.
+# Returns counts of inserted, updated and unchanged VMs
+def write_vms_to_database(vm_objs: list, digests: dict, profile: PropertyProfile = None) -> Counter:
+    counts, rows = get_database_rows(vm_objs, digests, profile)
+    counts = write_rows_to_database(counts, rows, profile)
+    if profile is None or profile.full:
+        digests.update((vm_moref, row[-1]) for vm_moref, (row, disk_rows, nic_rows) in rows.items())
+    else:
+        for vm_moref in rows:
+            digests.setdefault(vm_moref, None)
+    return counts
+
+# A function to turn VM objects into the rows write_rows_to_database writes
+# Kept apart from the write so workers can do it and hand just the rows to the writer process.
+# Returns the counts known so far and moref -> rows.  For the full profile that's only the VMs whose digest changed,
+# as (row with its digest, disk rows, NIC rows).  If a VM comes up twice the last one wins, for the children too.
+# For a smaller profile the digests only cover whole rows, so every VM's profile row is written and PostgreSQL works
+# out which changed.  Their digests are cleared, so the next full run writes them whole again.
+def get_database_rows(vm_objs: list, digests: dict, profile: PropertyProfile = None) -> tuple:
+    if profile is not None and not profile.full:
+        get_row = get_profile_row(profile)
+        rows = {vm_obj.vm_moref: get_row(vm_obj) + (None,) for vm_obj in vm_objs}
+        # Until they're written, every VM that isn't new counts as unchanged
+        return Counter(inserted=sum(vm_moref not in digests for vm_moref in rows), unchanged=len(vm_objs)), rows
+
+    counts = Counter(inserted=0, updated=0, unchanged=0)
+    rows = {}
+    for vm_obj in vm_objs:
+        row = vm_to_row(vm_obj)
+        disk_rows = [get_disk_values(disk) for disk in vm_obj.disks]
+        nic_rows = [get_nic_values(nic) for nic in vm_obj.nics]
+        # The disks and NICs are part of the digest, so a VM whose only change is a disk still gets written
+        digest = get_row_digest(row + tuple(disk_rows) + tuple(nic_rows))
+        stored = digests.get(vm_obj.vm_moref)
+        if stored == digest:
+            counts["unchanged"] += 1
+            continue
+        counts["updated" if vm_obj.vm_moref in digests else "inserted"] += 1
+        rows[vm_obj.vm_moref] = (row + (digest,), disk_rows, nic_rows)
+    return counts, rows
+
+# A function to write rows from get_database_rows in one transaction, returns the counts with the write's added in
+# The rows of several get_database_rows calls can be merged, as long as their counts are added up too
+def write_rows_to_database(counts: Counter, rows: dict, profile: PropertyProfile = None) -> Counter:
+    # Make sure the tables exist before the first write
+    prepare_vm_tables()
+    prepare_history_table()
+    if profile is not None and not profile.full:
+        written = bulk_upsert(
+            get_engine(), VM_TABLE, list(profile.columns) + [DIGEST_COLUMN], list(VM_KEY_COLUMNS), list(rows.values()),
+            HISTORY_TABLE, [column for column in HISTORY_COLUMNS if column in profile.columns],
+            compare_columns=[column for column in profile.columns if column not in VM_KEY_COLUMNS], rollup=True,
+        )
+        return Counter(inserted=counts["inserted"], updated=written - counts["inserted"], unchanged=counts["unchanged"] - written)
+
+    # Changed fields of updated rows go to the history, the disks and NICs of every written VM are
+    # replaced and the rollups are moved by what changed, all in the same transaction as the upsert
+    bulk_upsert(
+        get_engine(), VM_TABLE, VM_COLUMNS + [DIGEST_COLUMN], list(VM_KEY_COLUMNS),
+        [row for row, disk_rows, nic_rows in rows.values()],
+        HISTORY_TABLE, HISTORY_COLUMNS,
+        children=[
+            (DISK_TABLE, DISK_COLUMNS, [disk_row for row, disk_rows, nic_rows in rows.values() for disk_row in disk_rows]),
+            (NIC_TABLE, NIC_COLUMNS, [nic_row for row, disk_rows, nic_rows in rows.values() for nic_row in nic_rows]),
+        ],
+        rollup=True,
+    )
+    return counts
+
+# Writes VM records to vme_watchman_properties
+# A sink has write(vm_objs, digests), which returns inserted/updated/unchanged counts, and close().
+# ParquetSink in parquet_sink.py is the other one.
+class PostgresSink():
+    def __init__(self, profile: PropertyProfile = None):
+        self.profile = profile
+
+    def write(self, vm_objs: list, digests: dict) -> Counter:
+        return write_vms_to_database(vm_objs, digests, self.profile)
+
+    def close(self):
+        pass
+
+# A function to make the sinks a run writes to
+# The database is one of them unless database is False, for workers that hand their rows to a writer process.
+# PARQUET_DIR adds a Parquet file set too.  The Parquet files are full snapshots, so runs with a smaller property
+# profile only write to the database.
+def get_sinks(profile: PropertyProfile = None, database: bool = True) -> list:
+    sinks = [PostgresSink(profile)] if database else []
+    parquet_dir = os.environ.get('PARQUET_DIR')
+    if parquet_dir and (profile is None or profile.full):
+        row_group_size = int(os.environ.get('PARQUET_ROW_GROUP_SIZE', 10000))
+        sinks.append(ParquetSink(parquet_dir, VM, vm_to_row, CUSTOM_COLUMNS, row_group_size))
+    return sinks
+
+# A function to write VM records to every sink, returns the counts they reported added together
+def write_to_sinks(sinks: list, vm_objs: list, digests: dict) -> Counter:
+    counts = Counter(inserted=0, updated=0, unchanged=0)
+    for sink in sinks:
+        counts.update(sink.write(vm_objs, digests))
+    return counts
+
+# A function to close every sink
+def close_sinks(sinks: list):
+    for sink in sinks:
+        sink.close()
+
+# A function to log the inserted, updated, unchanged and deleted counts for a run
+# They are added to the metrics too
+def log_run_summary(vcenter: str, counts: Counter):
+    for outcome in ("inserted", "updated", "unchanged", "deleted"):
+        metrics.inc("vmproperties_vms", counts[outcome], outcome=outcome, vcenter=vcenter)
+    logger.info(
+        f"# {vcenter} # Inserted {counts['inserted']}, updated {counts['updated']}, "
+        f"unchanged {counts['unchanged']}, deleted {counts['deleted']} VMs"
+    )
 
-    # Get a container view of all VMs
-    all_vms = get_all_vms(si)
+# A function to delete a list of a vCenter's VMs from the database by moref
+def delete_vms_by_moref(moref_list: list, vcenter: str):
+    prepare_vm_tables()
+    delete_rows(get_engine(), VM_TABLE, "vm_moref", vcenter, moref_list, rollup=True)
+
+# A function to turn one VM's QueryPerf result into a VMStats
+# counter_names maps counter ID -> name.  cpu.ready is milliseconds per sample summed over every vCPU, so it's
+# turned into the share of each sample spent ready.  The usage counters come in hundredths of a percent.
+# cpu.ready.summation adds up the ready time of every vCPU, so it's divided by numcpu to get a share of the VM's time
+def get_vm_stats(entity_metric, counter_names: dict, vm_moref: str, vcenter: str, numcpu: int = 1) -> VMStats:
+    stats = VMStats(vcenter=vcenter, vm_moref=vm_moref, samples=len(entity_metric.sampleInfo or []))
+    interval = 20
+    if entity_metric.sampleInfo:
+        stats.sampledat = entity_metric.sampleInfo[-1].timestamp
+        interval = entity_metric.sampleInfo[-1].interval or interval
+    for series in entity_metric.value or []:
+        # -1 means vCenter has no value for that sample
+        values = [value for value in series.value or [] if value >= 0]
+        if not values:
+            continue
+        average = sum(values) / len(values)
+        name = counter_names.get(series.id.counterId)
+        if name == "cpu.ready.summation":
+            stats.cpureadypct = round(average / (interval * 1000) / max(numcpu or 1, 1) * 100, 2)
+        elif name == "cpu.usage.average":
+            stats.cpuusagepct = round(average / 100, 2)
+        elif name == "mem.usage.average":
+            stats.memusagepct = round(average / 100, 2)
+        elif name == "disk.maxTotalLatency.latest":
+            stats.disklatencyms = max(values)
+    return stats
+
+# Collect recent CPU ready, CPU and memory usage and disk latency for every VM into STATS_TABLE
+# The counter IDs are looked up once, then STATS_BATCH_SIZE VMs go in each QueryPerf call.  vCenter answers at most
+# config.vpxd.stats.maxQueryMetrics (256 by default) VM and counter pairs per call, and each VM asks for 4.
+# Only VMs that have a row get stats, and a batch vCenter faults on is skipped.  Returns how many VMs got stats.
+def collect_vm_stats(si: "vim.ServiceInstance", vm_refs: list, vcenter: str) -> int:
+    batch_size  = int(os.environ.get('STATS_BATCH_SIZE', 64))
+    max_sample  = int(os.environ.get('STATS_SAMPLES', 15))
+
+    with metrics.timer("stats", vcenter):
+        counter_ids = get_perf_counter_ids(si, STATS_COUNTERS)
+        for name in STATS_COUNTERS:
+            if name not in counter_ids:
+                logger.warning(f"# {vcenter} # Performance counter {name} is not defined in vCenter")
+        if not counter_ids:
+            return 0
+        counter_names = {counter_id: name for name, counter_id in counter_ids.items()}
+
+        # Stats rows point at their VM's row, so leave out VMs that don't have one
+        # The vCPU count comes from the same rows, for working out CPU ready per vCPU.  Powered off VMs have no
+        # real-time stats, so they're left out too, unless the profile didn't collect the power state.
+        get_vm_model(VMStats, table=STATS_TABLE)
+        prepare_vm_tables()
+        stored = load_columns_by_moref(get_engine(), VM_TABLE, ["numcpu", "powerstate"], vcenter)
+        numcpus = {moid: numcpu for moid, (numcpu, powerstate) in stored.items() if powerstate in ("poweredOn", "", None)}
+        moids = [moid for moid, uuid in vm_refs if moid in numcpus]
+
+        written = 0
+        for i in range(0, len(moids), batch_size):
+            vms = [get_vm_by_moid(moid, si) for moid in moids[i:i + batch_size]]
+            try:
+                results = query_vm_perf(si, vms, list(counter_ids.values()), max_sample=max_sample)
+            except get_vcenter_faults() as error:
+                logger.warning(f"# {vcenter} # Skipping stats for {len(vms)} VMs: {error}")
+                continue
+            rows = [
+                get_stats_values(get_vm_stats(result, counter_names, result.entity._moId, vcenter, numcpus[result.entity._moId]))
+                for result in results
+                # A VM that was powered off since the run comes back without samples
+                if result.entity._moId in numcpus and result.sampleInfo
+            ]
+            bulk_upsert(get_engine(), STATS_TABLE, STATS_COLUMNS, list(VM_KEY_COLUMNS), rows)
+            written += len(rows)
+
+    logger.info(f"# {vcenter} # Collected stats for {written} VMs in {math.ceil(len(moids) / batch_size)} QueryPerf calls")
+    return written
+
+# A function to load the saved watch state, returns an empty dict if there isn't any
+def load_watch_state(state_file: str) -> dict:
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# A function to save the watch state
+# It holds a live session id, so keep it readable by us only
+def save_watch_state(state_file: str, state: dict):
+    tmp_file = state_file + ".tmp"
+    with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_file, state_file)
+
+# The paths the watch filter collects, for telling a whole property from a nested one in a change
+VM_PROPERTY_SET = frozenset(VM_PROPERTY_PATHS)
+
+# A function to tell whether apply_vm_updates can merge a change into a VM's cached properties
+# Only a collected path that was set or unset as a whole can be.  Anything else, like an element added to the
+# device list or a nested path such as config.hardware.device[4000].backing, means refetching that VM.
+def is_incremental_change(change) -> bool:
+    return change.op in ("assign", "remove") and change.name in VM_PROPERTY_SET
+
+# A function to apply one WaitForUpdatesEx update set to the database
+# Topology changes are applied to the index first, so VMs in the same update see them
+# New VMs come with all their properties, and removed VMs are deleted.  vm_cache holds the properties of every VM
+# we've seen, and a changed VM's changes are merged into it, so only VMs with changes that can't be merged are
+# refetched, in bulk.
+# digests is kept in step with the database so a VM that changed in ways we don't store isn't rewritten
+# Returns counts of inserted, updated, unchanged and deleted VMs
+def apply_vm_updates(si: "vim.ServiceInstance", update_set, uuid_map: dict, topology: dict, topology_filter, attribute_keys: dict, vcenter: str, digests: dict, vm_cache: dict) -> Counter:
+    vm_props = {}
+    modified = []
+    removed = []
+    for filter_update in update_set.filterSet:
+        if filter_update.filter._moId == topology_filter._moId:
+            apply_topology_updates(topology, filter_update)
+            continue
+        for object_update in filter_update.objectSet:
+            moid = object_update.obj._moId
+            if object_update.kind == "enter":
+                vm_props[moid] = {change.name: change.val for change in object_update.changeSet}
+            elif object_update.kind == "modify":
+                if moid in vm_cache and all(is_incremental_change(change) for change in object_update.changeSet):
+                    props = vm_props.setdefault(moid, vm_cache[moid])
+                    for change in object_update.changeSet:
+                        if change.op == "assign":
+                            props[change.name] = change.val
+                        else:
+                            props.pop(change.name, None)
+                else:
+                    modified.append(object_update.obj)
+            elif object_update.kind == "leave":
+                vm_cache.pop(moid, None)
+                if moid in uuid_map:
+                    del uuid_map[moid]
+                    removed.append(moid)
+
+    if modified:
+        with metrics.timer("fetch", vcenter):
+            vm_props.update(get_vm_properties(si, modified))
+    vm_cache.update(vm_props)
+
+    vm_objs = build_vm_objs(si, vm_props, topology, attribute_keys, vcenter)
+    for vm_obj in vm_objs:
+        uuid_map[vm_obj.vm_moref] = vm_obj.vm_uuid
+
+    with metrics.timer("write", vcenter):
+        counts = write_vms_to_database(vm_objs, digests)
+    if removed:
+        with metrics.timer("delete", vcenter):
+            delete_vms_by_moref(removed, vcenter)
+        for moid in removed:
+            digests.pop(moid, None)
+    counts["deleted"] = len(removed)
+    return counts
+
+# Keep the database in sync with vCenter until we are stopped
+# The first WaitForUpdatesEx call returns every VM, after that only changes come back
+# The session, filter and version are saved after each update so a restart can carry on where it left off
+def watch():
+    from pyVmomi import vim, vmodl
+    # Environmental vars
+    vcenter     = os.environ.get('VCENTER')
+    user        = os.environ.get('VSPHERE_USER')
+    password    = os.environ.get('VSPHERE_PASSWORD')
+    state_file  = os.environ.get('WATCH_STATE_FILE', 'watch_state.json')
+    max_wait    = int(os.environ.get('WATCH_MAX_WAIT_SECONDS', 60))
+    metrics_port = int(os.environ.get('METRICS_PORT', 9137))
 
-    # Get all UUIDs
-    logger.debug(f"# {vcenter} # Gathering UUIDs")
-    uuid_list   = get_all_vm_uuids(all_vms)
-    uuid_len    = len(uuid_list)
-    logger.info(f"# {vcenter} # Found {uuid_len} UUIDS")
+    # Scrape /metrics on this port while we run, METRICS_PORT=0 turns it off
+    if metrics_port:
+        metrics.serve(metrics_port)
 
-    
-    # Split the UUID list into chunks for each process.
-    #chunk_size  = len(uuid_list) // num_processes
-    chunk_size  = 50
-    uuid_chunks = [uuid_list[i:i + chunk_size] for i in range(0, len(uuid_list), chunk_size)] # Thanks ChatGPT
-
-
-    logger.info(f"# {vcenter} # Split UUIDS into {len(uuid_chunks)} chunks")
-
-    # Thanks again, ChatGPT.  Creates worker_args as i (a number for a worker id), and a list of uuids
-    worker_args = [(i, uuid_chunk) for i, uuid_chunk in enumerate(uuid_chunks)] 
-
-    '''
-    # Set the number of processes we will use
-    num_processes = 4
-    # Create a multiprocessing pool 
-    with multiprocessing.Pool(processes=num_processes) as pool:
-        # Use the pool to execute the process_vm_data function in parallel 
-        # The chunks of UUIDs should be automatically divided among the processes
-        pool.map(process_vm_data, worker_args)
-
-    # Close the pool 
-    pool.close()
-    pool.join()
-    '''
-    
-    # Use concurrent.futures.ProcessPoolExecutor instead of multiprocessing.pool.map
-    # Removed the max workers limit, so the script will use all available processors
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        # Use executor.map to execute tasks in parallel
-        executor.map(process_vm_data, worker_args)
+    state = load_watch_state(state_file)
+    if state.get("vcenter") != vcenter:
+        state = {}
+
+    # Connect to vCenter, reusing the saved session if it is still alive
+    si = connect_vcenter(vcenter=vcenter, username=user, password=password, session_id=state.get("session_id"), disconnect_at_exit=False)
+    content = si.RetrieveContent()
+    attribute_keys = get_custom_attribute_keys(get_custom_field_keys(content.customFieldsManager))
+
+    version = ""
+    if state and si._stub.GetSessionId() == state.get("session_id"):
+        # Our filter lives in the session, so pick it back up along with the version we had reached
+        container_view = vim.view.ContainerView(state["view"], si._stub)
+        prop_filter = vmodl.query.PropertyCollector.Filter(state["filter"], si._stub)
+        topology_view = vim.view.ContainerView(state["topology_view"], si._stub)
+        topology_filter = vmodl.query.PropertyCollector.Filter(state["topology_filter"], si._stub)
+        topology = get_topology(si, topology_view)
+        version = state["version"]
+        uuid_map = get_vm_uuid_map(si, container_view)
+        # Nothing is cached yet, so each VM's first change refetches it
+        vm_cache = {}
+        adopt_legacy_rows(si, container_view, vcenter, list(uuid_map.items()))
+        digests = load_vm_digests(vcenter)
+        initial = False
+        logger.info(f"# {vcenter} # Resuming watch from version {version}")
+
+    next_prune = time.monotonic()
+    while True:
+        if not version:
+            # Full collection, every VM in the view comes back as new
+            container_view = get_vm_container_view(si)
+            prop_filter = create_vm_filter(si, container_view, VM_PROPERTY_PATHS)
+            # Index the topology up front, then keep it current from its own filter
+            topology_view = get_topology_container_view(si)
+            topology = get_topology(si, topology_view)
+            topology_filter = create_topology_filter(si, topology_view)
+            uuid_map = {}
+            vm_cache = {}
+            adopt_legacy_rows(si, container_view, vcenter)
+            digests = load_vm_digests(vcenter)
+            initial = True
+            logger.info(f"# {vcenter} # Starting full collection")
+
+        # Drop old history once a day, since watch mode never gets to the end of a run
+        if time.monotonic() >= next_prune:
+            prune_history(vcenter)
+            next_prune = time.monotonic() + 24 * 60 * 60
+
+        try:
+            update_set = wait_for_updates(si, version, max_wait)
+        except (vmodl.query.InvalidCollectorVersion, vmodl.fault.ManagedObjectNotFound) as error:
+            logger.warning(f"# {vcenter} # Saved watch state is no longer valid, starting over: {error}")
+            for stale_filter in (prop_filter, topology_filter):
+                try:
+                    stale_filter.Destroy()
+                except vmodl.fault.ManagedObjectNotFound:
+                    pass
+            version = ""
+            continue
+        if update_set is None:
+            continue
+
+        timer = time.perf_counter()
+        counts = apply_vm_updates(si, update_set, uuid_map, topology, topology_filter, attribute_keys, vcenter, digests, vm_cache)
+        version = update_set.version
+
+        # Once the full collection is in, clear out anything that went away while we weren't watching
+        if initial and not update_set.truncated:
+            counts["deleted"] += delete_vms_from_database(list(uuid_map))
+            initial = False
+        log_run_summary(vcenter, counts)
+        logger.debug(f"# {vcenter} # Applied update in {time.perf_counter() - timer:.2f} seconds")
+
+        save_watch_state(state_file, {
+            "vcenter":          vcenter,
+            "session_id":       si._stub.GetSessionId(),
+            "view":             container_view._moId,
+            "filter":           prop_filter._moId,
+            "topology_view":    topology_view._moId,
+            "topology_filter":  topology_filter._moId,
+            "version":          version,
+        })
+
+# A function to collect one vCenter as part of collect_all
+# Every pyVmomi call runs on a thread, so the event loop keeps the other vCenters moving in the meantime
+# Chunks are sized by an AdaptiveScheduler from the same settings as main(), with up to concurrency of them
+# fetched from this vCenter at once, and finished chunks go onto write_queue.
+# A chunk vCenter faults on is split in half and retried, up to CHUNK_MAX_RETRIES times.  After that, or on any
+# other error, the chunks still being fetched are cancelled and the error is raised, so nothing is deleted.
+# Each queue item carries this vCenter's stored digests, so the writer can skip unchanged VMs
+# Returns the morefs that were found, for deleting stale rows
+async def collect_vcenter(vcenter: str, user: str, password: str, write_queue: "asyncio.Queue", concurrency: int, profile: str = None) -> list:
+    import asyncio
+    start_time = time.perf_counter()
+    profile = get_vcenter_profile(vcenter, profile)
+    si = await asyncio.to_thread(connect_vcenter, vcenter=vcenter, username=user, password=password)
+    content = await asyncio.to_thread(si.RetrieveContent)
+
+    with metrics.timer("discovery", vcenter):
+        # Index the topology and custom attribute keys once for this vCenter
+        topology = await asyncio.to_thread(get_topology, si)
+        attribute_keys = get_custom_attribute_keys(await asyncio.to_thread(get_custom_field_keys, content.customFieldsManager))
+
+        # Get the moref and UUID of every VM
+        container_view = await asyncio.to_thread(get_vm_container_view, si)
+        vm_refs = list((await asyncio.to_thread(get_vm_uuid_map, si, container_view)).items())
+    logger.info(f"# {vcenter} # Found {len(vm_refs)} VMs")
+    await asyncio.to_thread(adopt_legacy_rows, si, container_view, vcenter, vm_refs)
+    digests = await asyncio.to_thread(load_vm_digests, vcenter)
+
+    scheduler = AdaptiveScheduler(
+        max_window      = concurrency,
+        batch_size      = int(os.environ.get('BATCH_SIZE', 50)),
+        max_batch       = int(os.environ.get('MAX_BATCH_SIZE', 500)),
+        target_seconds  = float(os.environ.get('BATCH_TARGET_SECONDS', 5)),
+    )
+    max_retries = int(os.environ.get('CHUNK_MAX_RETRIES', 3))
+    pending = deque(vm_refs)
+    retries = deque()
+    in_flight = 0
+    # Woken whenever a chunk comes back, since that can free a slot or queue up retries
+    chunk_done = asyncio.Condition()
+
+    def can_take():
+        return (pending or retries) and in_flight < scheduler.window
+
+    def finished():
+        return not pending and not retries and not in_flight
+
+    # concurrency of these run at once, each taking the next chunk until every VM is collected
+    async def collect_chunks():
+        nonlocal in_flight
+        while True:
+            async with chunk_done:
+                await chunk_done.wait_for(lambda: can_take() or finished())
+                if finished():
+                    return
+                if retries:
+                    ref_chunk, attempt = retries.popleft()
+                else:
+                    ref_chunk = [pending.popleft() for i in range(scheduler.next_batch(len(pending)))]
+                    attempt = 0
+                in_flight += 1
+            try:
+                timer = time.perf_counter()
+                vm_objs = await asyncio.to_thread(collect_vm_chunk, si, ref_chunk, topology, attribute_keys, vcenter, profile.paths)
+                # The build is timed too, but it's small next to the vCenter calls
+                scheduler.on_success(time.perf_counter() - timer)
+            except get_vcenter_faults() as fault:
+                scheduler.on_fault()
+                if attempt >= max_retries:
+                    logger.error(f"# {vcenter} # Giving up on {len(ref_chunk)} VMs after {attempt + 1} tries: {fault}")
+                    raise
+                # Smaller pieces are more likely to get through
+                half = max(1, len(ref_chunk) // 2)
+                retries.extend((piece, attempt + 1) for piece in (ref_chunk[:half], ref_chunk[half:]) if piece)
+                vm_objs = None
+            finally:
+                async with chunk_done:
+                    in_flight -= 1
+                    chunk_done.notify_all()
+            if vm_objs is not None:
+                await write_queue.put((vcenter, vm_objs, digests, profile))
 
-    # Delete VMs that no longer exist from database
-    logger.debug(f"# {vcenter} # Deleting VMs from database")
-    delete_vms_from_database(uuid_list)
+    try:
+        async with asyncio.TaskGroup() as task_group:
+            for i in range(concurrency):
+                task_group.create_task(collect_chunks())
+    except ExceptionGroup as error:
+        # The first chunk to fail cancelled the rest, so that's the one to report
+        raise error.exceptions[0]
+
+    elapsed_time = time.strftime("%H:%M:%S", time.gmtime(time.perf_counter() - start_time))
+    logger.info(f"# {vcenter} # --- Collected {len(vm_refs)} VMs in {elapsed_time} ---")
+    record_run_duration(vcenter, time.perf_counter() - start_time)
+    return [moid for moid, uuid in vm_refs]
+
+# The one database writer for collect_all, writes each chunk as it arrives until it gets None
+# Returns the inserted, updated and unchanged counts per vCenter and whether every write worked
+async def database_writer(write_queue: "asyncio.Queue") -> tuple:
+    import asyncio
+    counts = {}
+    failed = False
+    # One set of sinks per property profile, since vCenters can be collected with different ones
+    sinks = {}
+    while True:
+        item = await write_queue.get()
+        if item is None:
+            for profile_sinks in sinks.values():
+                await asyncio.to_thread(close_sinks, profile_sinks)
+            return counts, not failed
+        vcenter, vm_objs, digests, profile = item
+        try:
+            if profile.name not in sinks:
+                sinks[profile.name] = get_sinks(profile)
+            with metrics.timer("write", vcenter):
+                chunk_counts = await asyncio.to_thread(write_to_sinks, sinks[profile.name], vm_objs, digests)
+            counts.setdefault(vcenter, Counter()).update(chunk_counts)
+        except Exception as error:
+            # Keep draining the queue so the collectors don't block, but don't delete anything afterwards
+            logger.error(f"Database write failed: {error}")
+            failed = True
+
+# Collect several vCenters from one process
+# One event loop drives all of them, with a bounded pool of threads for the blocking pyVmomi calls,
+# VCENTER_CONCURRENCY requests in flight per vCenter and a single shared database writer
+# asyncio is only imported for this, single vCenter runs don't need it
+async def collect_all(vcenters: list, profile: str = None):
+    import asyncio
+    start_time = time.perf_counter()
+    user        = os.environ.get('VSPHERE_USER')
+    password    = os.environ.get('VSPHERE_PASSWORD')
+    concurrency = int(os.environ.get('VCENTER_CONCURRENCY', 4))
 
-    # Track the total time and some other stats
-    end_time = time.perf_counter()
-    elapsed_time = time.strftime("%H:%M:%S", time.gmtime(end_time - start_time))
-    logger.info(f"# {vcenter} # --- TOTAL duration: {elapsed_time} for {uuid_len} VMs ---")
-    per_vm = (end_time - start_time) / uuid_len
-    logger.info(f"# {vcenter} # --- {per_vm:.2f} Seconds per VM ---")
+    # Enough threads for every vCenter's requests plus the writer, and no more
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=len(vcenters) * concurrency + 1)
+    )
 
-    return 0
+    # A bounded queue, so collectors wait for the writer instead of piling up records
+    write_queue = asyncio.Queue(maxsize=len(vcenters) * concurrency)
+    writer = asyncio.create_task(database_writer(write_queue))
+
+    async def collect_safely(vcenter):
+        # One vCenter failing shouldn't stop the others
+        try:
+            return await collect_vcenter(vcenter, user, password, write_queue, concurrency, profile)
+        except (Exception, SystemExit) as error:
+            logger.error(f"# {vcenter} # Collection failed: {error}")
+            return None
+
+    results = await asyncio.gather(*(collect_safely(vcenter) for vcenter in vcenters))
+    await write_queue.put(None)
+    counts, writes_ok = await writer
+
+    # Delete stale VMs only for vCenters whose collection and writes both finished
+    total = 0
+    for vcenter, moref_list in zip(vcenters, results):
+        vcenter_counts = counts.get(vcenter, Counter())
+        if moref_list is not None and writes_ok:
+            vcenter_counts["deleted"] = await asyncio.to_thread(delete_vms_from_database, moref_list, vcenter)
+        log_run_summary(vcenter, vcenter_counts)
+        total += vcenter_counts["inserted"] + vcenter_counts["updated"] + vcenter_counts["unchanged"]
+
+    elapsed_time = time.strftime("%H:%M:%S", time.gmtime(time.perf_counter() - start_time))
+    logger.info(f"--- TOTAL duration: {elapsed_time} for {total} VMs across {len(vcenters)} vCenters ---")
+    await asyncio.to_thread(prune_history, "all")
+    metrics.export("all")
 
 # Start program
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect VM properties from vCenter into PostgreSQL")
+    parser.add_argument("--watch", action="store_true", help="keep running and apply changes as vCenter reports them")
+    parser.add_argument("--stream", action="store_true", help="collect from one process in pages, with memory use that doesn't grow with the inventory")
+    parser.add_argument("--resume", action="store_true", help="pick up the last unfinished run and only collect the VMs it hadn't committed")
+    parser.add_argument("--stats", action="store_true", help="also collect recent CPU, memory and disk latency stats for every VM")
+    parser.add_argument("--profile", choices=list(PROPERTY_PROFILES), help="property profile to collect, instead of PROPERTY_PROFILE")
+    parser.add_argument("--rebuild-rollups", action="store_true", help="work the cluster and datacenter rollup tables out again from the VM table, then exit")
+    args = parser.parse_args()
 
     # Format logging so netelk sees it correctly
-    logger = logging.getLogger()
-    format = "%(asctime)s | %(name)s | %(levelname)s | %(filename)s | %(funcName)s:%(lineno)d | %(message)s"
-    logging.basicConfig(level=os.environ.get("LOGLEVEL", "DEBUG"), format=format, handlers=[logging.StreamHandler(sys.stdout)], force=True)
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "DEBUG"), format=LOG_FORMAT, handlers=[logging.StreamHandler(sys.stdout)], force=True)
 
     # Run main
-    main()
+    # VCENTERS (comma separated) collects every listed vCenter from this one process
+    vcenters = [vcenter.strip() for vcenter in os.environ.get('VCENTERS', '').split(',') if vcenter.strip()]
+    if args.rebuild_rollups:
+        prepare_vm_tables()
+        rebuild_rollup_tables(get_engine(), VM_TABLE)
+        logger.info("Rebuilt the rollup tables")
+    elif args.watch:
+        watch()
+    elif args.stream:
+        sys.exit(stream(args.profile))
+    elif vcenters:
+        import asyncio
+        asyncio.run(collect_all(vcenters, args.profile))
+    else:
+        main(resume=args.resume, profile=args.profile, collect_stats=args.stats)